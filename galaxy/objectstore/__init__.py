@@ -11,6 +11,7 @@ import random
 import shutil
 import threading
 import time
+from multiprocessing.pool import ThreadPool
 from xml.etree import ElementTree
 
 import yaml
@@ -31,8 +32,25 @@ from galaxy.util.path import (
     safe_relpath,
 )
 from galaxy.util.sleeper import Sleeper
+from .caching import (
+    DEFAULT_LOCATION_CACHE_SIZE,
+    LocationCache,
+    MappedFileCache,
+)
+from .placement import PlacementEngine
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 without the scandir backport, list names and stat lazily
+    def scandir(path):
+        return [_PathEntry(os.path.join(path, name)) for name in os.listdir(path)]
 
 NO_SESSION_ERROR_MESSAGE = "Attempted to 'create' object store entity in configuration with no database session present."
+# Seconds between the checks of the backends free space by the distributed object store
+FILESYSTEM_MONITOR_INTERVAL = 120
+# Arguments of the object store methods that change where an object is located
+LOCATION_KWDS = ('base_dir', 'dir_only', 'extra_dir', 'extra_dir_at_root', 'alt_name', 'obj_dir')
 
 log = logging.getLogger(__name__)
 
@@ -114,6 +132,15 @@ class ObjectStore(object):
         """Return True if the object identified by `obj` exists, False otherwise."""
         raise NotImplementedError()
 
+    def exists_many(self, objs, **kwargs):
+        """
+        Return a list of booleans telling whether each object in `objs` exists.
+
+        Accepts the same keyword arguments as `exists`. Stores that can probe
+        many objects at once more cheaply than one at a time override this.
+        """
+        return [self.exists(obj, **kwargs) for obj in objs]
+
     def file_ready(self, obj, base_dir=None, dir_only=False, extra_dir=None, extra_dir_at_root=False, alt_name=None, obj_dir=False):
         """
         Check if a file corresponding to a dataset is ready to be used.
@@ -147,6 +174,15 @@ class ObjectStore(object):
         """
         raise NotImplementedError()
 
+    def size_many(self, objs, **kwargs):
+        """
+        Return a list with the size of each object in `objs`.
+
+        Accepts the same keyword arguments as `size`, objects that do not
+        exist have a size of 0.
+        """
+        return [self.size(obj, **kwargs) for obj in objs]
+
     def delete(self, obj, entire_dir=False, base_dir=None, extra_dir=None, extra_dir_at_root=False, alt_name=None, obj_dir=False):
         """
         Delete the object identified by `obj`.
@@ -173,6 +209,18 @@ class ObjectStore(object):
         """
         raise NotImplementedError()
 
+    def get_data_view(self, obj, start=0, count=-1, **kwargs):
+        """
+        Like `get_data` but return a read-only `memoryview` of the raw bytes.
+
+        Stores able to avoid copying the data (e.g. by memory mapping the
+        file) override this, the default reads the file from `get_filename`.
+        Accepts the same keyword arguments as `get_data`.
+        """
+        with open(self.get_filename(obj, **kwargs), 'rb') as data_file:
+            data_file.seek(start)
+            return memoryview(data_file.read(count))
+
     def get_filename(self, obj, base_dir=None, dir_only=False, extra_dir=None, extra_dir_at_root=False, alt_name=None, obj_dir=False):
         """
         Get the expected filename with absolute path for object with id `obj.id`.
@@ -211,6 +259,10 @@ class ObjectStore(object):
         """Return the percentage indicating how full the store is."""
         raise NotImplementedError()
 
+    def get_store_space(self):
+        """Return the total and free bytes of the store as a tuple."""
+        raise NotImplementedError()
+
     @classmethod
     def parse_xml(clazz, config_xml):
         """Parse an XML description of a configuration for this object store.
@@ -276,6 +328,7 @@ class DiskObjectStore(ObjectStore):
         """
         super(DiskObjectStore, self).__init__(config, config_dict)
         self.file_path = config_dict.get("files_dir") or config.file_path
+        self.mapped_files = MappedFileCache()
 
     @classmethod
     def parse_xml(clazz, config_xml):
@@ -387,6 +440,58 @@ class DiskObjectStore(ObjectStore):
                 return True
         return os.path.exists(self._construct_path(obj, **kwargs))
 
+    def exists_many(self, objs, **kwargs):
+        """Override `ObjectStore`'s stub, listing each directory shared by several objects once."""
+        return [entry is not None for entry in self._scan_many(objs, **kwargs)]
+
+    def size_many(self, objs, **kwargs):
+        """Override `ObjectStore`'s stub, listing each directory shared by several objects once."""
+        sizes = []
+        for obj, entry in zip(objs, self._scan_many(objs, **kwargs)):
+            if entry is None:
+                sizes.append(0)
+                continue
+            try:
+                sizes.append(entry.stat().st_size)
+            except OSError:
+                sizes.append(0)
+        return sizes
+
+    def _scan_many(self, objs, **kwargs):
+        """
+        Return a list with, for each object, a `os.DirEntry` like object for
+        its file or `None` if it does not exist.
+
+        Objects whose files share a directory are resolved with a single
+        directory listing, lone objects with a single `stat`.
+        """
+        paths = [self._construct_path(obj, **kwargs) for obj in objs]
+        by_dir = {}
+        for path in paths:
+            by_dir.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+        found = {}
+        for dir_path, names in by_dir.items():
+            if len(names) == 1:
+                path = os.path.join(dir_path, next(iter(names)))
+                if os.path.lexists(path):
+                    found[path] = _PathEntry(path)
+                continue
+            try:
+                for entry in scandir(dir_path):
+                    if entry.name in names:
+                        found[entry.path] = entry
+            except OSError:
+                # Directory does not exist (yet), none of its objects do
+                pass
+        entries = [found.get(path) for path in paths]
+        if self.check_old_style:
+            for i, (obj, entry) in enumerate(zip(objs, entries)):
+                if entry is None:
+                    old_style_path = self._construct_path(obj, old_style=True, **kwargs)
+                    if os.path.exists(old_style_path):
+                        entries[i] = _PathEntry(old_style_path)
+        return entries
+
     def create(self, obj, **kwargs):
         """Override `ObjectStore`'s stub by creating any files and folders on disk."""
         if not self.exists(obj, **kwargs):
@@ -448,6 +553,20 @@ class DiskObjectStore(ObjectStore):
         data_file.close()
         return content
 
+    def get_data_view(self, obj, start=0, count=-1, **kwargs):
+        """
+        Override `ObjectStore`'s stub; return a view of a memory map of the file.
+
+        Views should not be held while the dataset may be rewritten in place,
+        reading a mapping of a truncated file faults.
+        """
+        return self.mapped_files.view(self.get_filename(obj, **kwargs), start, count)
+
+    def shutdown(self):
+        """Release the memory mapped files."""
+        self.mapped_files.close()
+        super(DiskObjectStore, self).shutdown()
+
     def get_filename(self, obj, **kwargs):
         """
         Override `ObjectStore`'s stub.
@@ -496,6 +615,11 @@ class DiskObjectStore(ObjectStore):
         st = os.statvfs(self.file_path)
         return (float(st.f_blocks - st.f_bavail) / st.f_blocks) * 100
 
+    def get_store_space(self):
+        """Override `ObjectStore`'s stub by returning the file system's total and available bytes."""
+        st = os.statvfs(self.file_path)
+        return st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
+
 
 class NestedObjectStore(ObjectStore):
 
@@ -503,23 +627,46 @@ class NestedObjectStore(ObjectStore):
     Base for ObjectStores that use other ObjectStores.
 
     Example: DistributedObjectStore, HierarchicalObjectStore
+
+    The backend each object was found in (or that it was found in none) is
+    remembered in a bounded cache so lookups of objects without a valid
+    `object_store_id` do not check every backend again. The backends are
+    checked concurrently if `probe_threads` is more than 1.
     """
 
-    def __init__(self, config, config_xml=None):
+    def __init__(self, config, config_dict=None):
         """Extend `ObjectStore`'s constructor."""
         super(NestedObjectStore, self).__init__(config)
+        config_dict = config_dict or {}
         self.backends = {}
+        self.location_cache_size = int(config_dict.get("location_cache_size", DEFAULT_LOCATION_CACHE_SIZE))
+        self.location_cache = LocationCache(self.location_cache_size)
+        self.probe_threads = int(config_dict.get("probe_threads", 1))
+        self._probe_pool = None
+        self._probe_pool_lock = threading.Lock()
 
     def shutdown(self):
         """For each backend, shuts them down."""
         for store in self.backends.values():
             store.shutdown()
+        if self._probe_pool is not None:
+            self._probe_pool.terminate()
         super(NestedObjectStore, self).shutdown()
 
+    def to_dict(self):
+        as_dict = super(NestedObjectStore, self).to_dict()
+        as_dict["location_cache_size"] = self.location_cache_size
+        as_dict["probe_threads"] = self.probe_threads
+        return as_dict
+
     def exists(self, obj, **kwargs):
         """Determine if the `obj` exists in any of the backends."""
         return self._call_method('exists', obj, False, False, **kwargs)
 
+    def exists_many(self, objs, **kwargs):
+        """Determine which of the `objs` exist in any of the backends."""
+        return [store_id is not None for store_id in self._locate_many(objs, **kwargs)]
+
     def file_ready(self, obj, **kwargs):
         """Determine if the file for `obj` is ready to be used by any of the backends."""
         return self._call_method('file_ready', obj, False, False, **kwargs)
@@ -527,6 +674,7 @@ class NestedObjectStore(ObjectStore):
     def create(self, obj, **kwargs):
         """Create a backing file in a random backend."""
         random.choice(list(self.backends.values())).create(obj, **kwargs)
+        self._invalidate_location(obj)
 
     def empty(self, obj, **kwargs):
         """For the first backend that has this `obj`, determine if it is empty."""
@@ -536,14 +684,34 @@ class NestedObjectStore(ObjectStore):
         """For the first backend that has this `obj`, return its size."""
         return self._call_method('size', obj, 0, False, **kwargs)
 
+    def size_many(self, objs, **kwargs):
+        """For each of the `objs`, return its size in the first backend that has it."""
+        sizes = [0] * len(objs)
+        by_store = {}
+        for i, store_id in enumerate(self._locate_many(objs, **kwargs)):
+            if store_id is not None:
+                by_store.setdefault(store_id, []).append(i)
+        for store_id, indices in by_store.items():
+            store_sizes = self.backends[store_id].size_many([objs[i] for i in indices], **kwargs)
+            for i, size in zip(indices, store_sizes):
+                sizes[i] = size
+        return sizes
+
     def delete(self, obj, **kwargs):
         """For the first backend that has this `obj`, delete it."""
-        return self._call_method('delete', obj, False, False, **kwargs)
+        try:
+            return self._call_method('delete', obj, False, False, **kwargs)
+        finally:
+            self._invalidate_location(obj)
 
     def get_data(self, obj, **kwargs):
         """For the first backend that has this `obj`, get data from it."""
         return self._call_method('get_data', obj, ObjectNotFound, True, **kwargs)
 
+    def get_data_view(self, obj, **kwargs):
+        """For the first backend that has this `obj`, get a view of its data."""
+        return self._call_method('get_data_view', obj, ObjectNotFound, True, **kwargs)
+
     def get_filename(self, obj, **kwargs):
         """For the first backend that has this `obj`, get its filename."""
         return self._call_method('get_filename', obj, ObjectNotFound, True, **kwargs)
@@ -567,12 +735,93 @@ class NestedObjectStore(ObjectStore):
         except AttributeError:
             return str(obj)
 
+    def _location_key(self, obj, **kwargs):
+        variant = tuple(sorted((k, v) for k, v in kwargs.items() if k in LOCATION_KWDS))
+        return (obj.__class__.__name__, self._get_object_id(obj)), variant
+
+    def _invalidate_location(self, obj):
+        self.location_cache.invalidate((obj.__class__.__name__, self._get_object_id(obj)))
+
+    def _locate(self, obj, **kwargs):
+        """
+        Return the key of the first backend that has `obj`, or `None`.
+
+        A cached location is confirmed with the single backend it names,
+        falling back to checking all backends if the object is gone.
+        """
+        key = self._location_key(obj, **kwargs)
+        hit, store_id = self.location_cache.get(key)
+        if hit:
+            if store_id is None or self.backends[store_id].exists(obj, **kwargs):
+                return store_id
+            self.location_cache.invalidate(key[0])
+        store_id = self._probe_backends(obj, **kwargs)
+        self.location_cache.set(key, store_id)
+        return store_id
+
+    def _probe_backends(self, obj, **kwargs):
+        if self.probe_threads > 1 and len(self.backends) > 1:
+            items = list(self.backends.items())
+            found = self._get_probe_pool().map(lambda item: item[1].exists(obj, **kwargs), items)
+            for (key, store), exists in zip(items, found):
+                if exists:
+                    return key
+            return None
+        for key, store in self.backends.items():
+            if store.exists(obj, **kwargs):
+                return key
+        return None
+
+    def _get_probe_pool(self):
+        with self._probe_pool_lock:
+            if self._probe_pool is None:
+                self._probe_pool = ThreadPool(min(self.probe_threads, len(self.backends)))
+            return self._probe_pool
+
+    def _locate_many(self, objs, **kwargs):
+        """
+        Return, for each of the `objs`, the key of the first backend that has
+        it or `None`. Cached locations are confirmed in batch with the backend
+        they name, then each backend is probed once for all objects not found
+        in the backends before it.
+        """
+        store_ids = [None] * len(objs)
+        keys = [self._location_key(obj, **kwargs) for obj in objs]
+        cached = {}
+        remaining = []
+        for i, key in enumerate(keys):
+            hit, store_id = self.location_cache.get(key)
+            if not hit:
+                remaining.append(i)
+            elif store_id is not None:
+                cached.setdefault(store_id, []).append(i)
+        for store_id, indices in cached.items():
+            found = self.backends[store_id].exists_many([objs[i] for i in indices], **kwargs)
+            for i, exists in zip(indices, found):
+                if exists:
+                    store_ids[i] = store_id
+                else:
+                    self.location_cache.invalidate(keys[i][0])
+                    remaining.append(i)
+        probed = remaining
+        for key, store in self.backends.items():
+            if not remaining:
+                break
+            found = store.exists_many([objs[i] for i in remaining], **kwargs)
+            for i, exists in zip(remaining, found):
+                if exists:
+                    store_ids[i] = key
+            remaining = [i for i in remaining if store_ids[i] is None]
+        for i in probed:
+            self.location_cache.set(keys[i], store_ids[i])
+        return store_ids
+
     def _call_method(self, method, obj, default, default_is_exception,
             **kwargs):
         """Check all children object stores for the first one with the dataset."""
-        for key, store in self.backends.items():
-            if store.exists(obj, **kwargs):
-                return store.__getattribute__(method)(obj, **kwargs)
+        store_id = self._locate(obj, **kwargs)
+        if store_id is not None:
+            return self.backends[store_id].__getattribute__(method)(obj, **kwargs)
         if default_is_exception:
             raise default('objectstore, _call_method failed: %s on %s, kwargs: %s'
                           % (method, self._repr_object_for_exception(obj), str(kwargs)))
@@ -587,7 +836,9 @@ class DistributedObjectStore(NestedObjectStore):
 
     When getting objects the first store where the object exists is used.
     When creating objects they are created in a store selected randomly, but
-    with weighting.
+    with weighting. When monitoring the file system, the configured weights
+    are scaled by the free space of the backends and their recent write
+    throughput (see :class:`galaxy.objectstore.placement.PlacementEngine`).
     """
     store_type = 'distributed'
 
@@ -609,8 +860,7 @@ class DistributedObjectStore(NestedObjectStore):
         super(DistributedObjectStore, self).__init__(config, config_dict)
 
         self.backends = {}
-        self.weighted_backend_ids = []
-        self.original_weighted_backend_ids = []
+        self.weights = {}
         self.max_percent_full = {}
         self.global_max_percent_full = config_dict.get("global_max_percent_full", 0)
         random.seed()
@@ -625,14 +875,12 @@ class DistributedObjectStore(NestedObjectStore):
             disk_config_dict = dict(files_dir=file_path, extra_dirs=extra_dirs)
             self.backends[backened_id] = DiskObjectStore(config, disk_config_dict)
             self.max_percent_full[backened_id] = maxpctfull
+            self.weights[backened_id] = weight
             log.debug("Loaded disk backend '%s' with weight %s and file_path: %s" % (backened_id, weight, file_path))
 
-            for i in range(0, weight):
-                # The simplest way to do weighting: add backend ids to a
-                # sequence the number of times equalling weight, then randomly
-                # choose a backend from that sequence at creation
-                self.weighted_backend_ids.append(backened_id)
-        self.original_weighted_backend_ids = self.weighted_backend_ids
+        self.placement = PlacementEngine(self.backends, self.weights, self.max_percent_full,
+                                         global_max_percent_full=self.global_max_percent_full,
+                                         poll_interval=FILESYSTEM_MONITOR_INTERVAL)
 
         self.sleeper = None
         if fsmon and (self.global_max_percent_full or [_ for _ in self.max_percent_full.values() if _ != 0.0]):
@@ -654,6 +902,7 @@ class DistributedObjectStore(NestedObjectStore):
             'global_max_percent_full': float(backends_root.get('maxpctfull', 0)),
             'backends': backends,
         }
+        config_dict.update(_parse_location_attributes(backends_root))
 
         for elem in [e for e in backends_root if e.tag == 'backend']:
             id = elem.get('id')
@@ -710,7 +959,7 @@ class DistributedObjectStore(NestedObjectStore):
             backend_as_dict = backend.to_dict()
             backend_as_dict["id"] = backend_id
             backend_as_dict["max_percent_full"] = self.max_percent_full[backend_id]
-            backend_as_dict["weight"] = len([i for i in self.original_weighted_backend_ids if i == backend_id])
+            backend_as_dict["weight"] = self.weights[backend_id]
             backends.append(backend_as_dict)
         as_dict["backends"] = backends
         return as_dict
@@ -723,22 +972,16 @@ class DistributedObjectStore(NestedObjectStore):
 
     def __filesystem_monitor(self):
         while self.running:
-            new_weighted_backend_ids = self.original_weighted_backend_ids
-            for id, backend in self.backends.items():
-                maxpct = self.max_percent_full[id] or self.global_max_percent_full
-                pct = backend.get_store_usage_percent()
-                if pct > maxpct:
-                    new_weighted_backend_ids = [_ for _ in new_weighted_backend_ids if _ != id]
-            self.weighted_backend_ids = new_weighted_backend_ids
-            self.sleeper.sleep(120)  # Test free space every 2 minutes
+            # Between polls the placement engine accounts for the objects it allocated
+            self.placement.poll()
+            self.sleeper.sleep(FILESYSTEM_MONITOR_INTERVAL)
 
     def create(self, obj, **kwargs):
         """The only method in which obj.object_store_id may be None."""
         if obj.object_store_id is None or not self.exists(obj, **kwargs):
             if obj.object_store_id is None or obj.object_store_id not in self.backends:
-                try:
-                    obj.object_store_id = random.choice(self.weighted_backend_ids)
-                except IndexError:
+                obj.object_store_id = self.placement.allocate()
+                if obj.object_store_id is None:
                     raise ObjectInvalid('objectstore.create, could not generate '
                                         'obj.object_store_id: %s, kwargs: %s'
                                         % (str(obj), str(kwargs)))
@@ -749,6 +992,7 @@ class DistributedObjectStore(NestedObjectStore):
                 log.debug("Using preferred backend '%s' for creation of %s %s"
                           % (obj.object_store_id, obj.__class__.__name__, obj.id))
             self.backends[obj.object_store_id].create(obj, **kwargs)
+            self._invalidate_location(obj)
 
     def _call_method(self, method, obj, default, default_is_exception, **kwargs):
         object_store_id = self.__get_store_id_for(obj, **kwargs)
@@ -760,6 +1004,34 @@ class DistributedObjectStore(NestedObjectStore):
         else:
             return default
 
+    def _locate_many(self, objs, **kwargs):
+        """
+        Objects with a valid `object_store_id` are located without probing,
+        the others are located in batch and assigned to the backend they are
+        found in.
+        """
+        store_ids = [None] * len(objs)
+        unknown = []
+        for i, obj in enumerate(objs):
+            if obj.object_store_id is not None and obj.object_store_id in self.backends:
+                store_ids[i] = obj.object_store_id
+            else:
+                if obj.object_store_id is not None:
+                    log.warning('The backend object store ID (%s) for %s object with ID %s is invalid'
+                                % (obj.object_store_id, obj.__class__.__name__, obj.id))
+                unknown.append(i)
+        if unknown:
+            found = super(DistributedObjectStore, self)._locate_many([objs[i] for i in unknown], **kwargs)
+            for i, id in zip(unknown, found):
+                if id is not None:
+                    obj = objs[i]
+                    log.warning('%s object with ID %s found in backend object store with ID %s'
+                                % (obj.__class__.__name__, obj.id, id))
+                    obj.object_store_id = id
+                    _create_object_in_session(obj)
+                    store_ids[i] = id
+        return store_ids
+
     def __get_store_id_for(self, obj, **kwargs):
         if obj.object_store_id is not None:
             if obj.object_store_id in self.backends:
@@ -770,14 +1042,13 @@ class DistributedObjectStore(NestedObjectStore):
         # if this instance has been switched from a non-distributed to a
         # distributed object store, or if the object's store id is invalid,
         # try to locate the object
-        for id, store in self.backends.items():
-            if store.exists(obj, **kwargs):
-                log.warning('%s object with ID %s found in backend object store with ID %s'
-                            % (obj.__class__.__name__, obj.id, id))
-                obj.object_store_id = id
-                _create_object_in_session(obj)
-                return id
-        return None
+        id = self._locate(obj, **kwargs)
+        if id is not None:
+            log.warning('%s object with ID %s found in backend object store with ID %s'
+                        % (obj.__class__.__name__, obj.id, id))
+            obj.object_store_id = id
+            _create_object_in_session(obj)
+        return id
 
 
 class HierarchicalObjectStore(NestedObjectStore):
@@ -810,7 +1081,9 @@ class HierarchicalObjectStore(NestedObjectStore):
             backend_config_dict["type"] = store_type
             backends_list.append(backend_config_dict)
 
-        return {"backends": backends_list}
+        config_dict = {"backends": backends_list}
+        config_dict.update(_parse_location_attributes(config_xml.find('backends')))
+        return config_dict
 
     def to_dict(self):
         as_dict = super(HierarchicalObjectStore, self).to_dict()
@@ -823,14 +1096,33 @@ class HierarchicalObjectStore(NestedObjectStore):
 
     def exists(self, obj, **kwargs):
         """Check all child object stores."""
-        for store in self.backends.values():
-            if store.exists(obj, **kwargs):
-                return True
-        return False
+        return self._locate(obj, **kwargs) is not None
 
     def create(self, obj, **kwargs):
         """Call the primary object store."""
         self.backends[0].create(obj, **kwargs)
+        self._invalidate_location(obj)
+
+
+def _parse_location_attributes(backends_elem):
+    """Parse the location cache options of the `backends` element of nested object stores."""
+    attributes = {}
+    if backends_elem.get('location_cache_size') is not None:
+        attributes['location_cache_size'] = int(backends_elem.get('location_cache_size'))
+    if backends_elem.get('probe_threads') is not None:
+        attributes['probe_threads'] = int(backends_elem.get('probe_threads'))
+    return attributes
+
+
+class _PathEntry(object):
+    """Minimal stand-in for `os.DirEntry` for a path that was not listed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def stat(self):
+        return os.stat(self.path)
 
 
 def type_to_object_store_class(store, fsmon=False):
@@ -25,8 +25,18 @@ from galaxy.util import (
     directory_hash_id,
     umask_fix_perms
 )
-from galaxy.util.path import safe_relpath
+from galaxy.util.path import (
+    safe_makedirs,
+    safe_relpath,
+)
 from galaxy.util.sleeper import Sleeper
+from .caching import (
+    BatchProbeMixin,
+    BlockCache,
+    download_atomically,
+    RangedReadMixin,
+    SingleFlight,
+)
 from ..objectstore import (
     convert_bytes,
     ObjectStore
@@ -81,7 +91,7 @@ def parse_config_xml(config_xml):
         raise
 
 
-class AzureBlobObjectStore(ObjectStore):
+class AzureBlobObjectStore(BatchProbeMixin, RangedReadMixin, ObjectStore):
     """
     Object store that stores objects as blobs in an Azure Blob Container. A local
     cache exists that is used as an intermediate location for files between
@@ -93,6 +103,8 @@ class AzureBlobObjectStore(ObjectStore):
         super(AzureBlobObjectStore, self).__init__(config, config_dict)
 
         self.transfer_progress = 0
+        self._pull_flights = SingleFlight()
+        self.block_cache = BlockCache()
 
         auth_dict = config_dict["auth"]
         container_dict = config_dict["container"]
@@ -236,26 +248,45 @@ class AzureBlobObjectStore(ObjectStore):
             return False
         return exists
 
+    def _list_remote_sizes(self, prefix):
+        try:
+            # The delimiter keeps blobs of nested extra files directories out
+            return dict((blob.name, blob.properties.content_length)
+                        for blob in self.service.list_blobs(self.container_name, prefix=prefix, delimiter='/')
+                        if isinstance(blob, Blob))
+        except AzureHttpError:
+            log.exception("Trouble listing Azure blobs with prefix '%s'", prefix)
+            return None
+
+    def _fetch_remote_range(self, rel_path, start, end):
+        return self.service.get_blob_to_bytes(self.container_name, rel_path, start_range=start, end_range=end).content
+
     def _in_cache(self, rel_path):
         """ Check if the given dataset is in the local cache. """
         cache_path = self._get_cache_path(rel_path)
         return os.path.exists(cache_path)
 
     def _pull_into_cache(self, rel_path):
+        # Concurrent cache misses for the same key share a single download
+        return self._pull_flights.do(rel_path, self._pull_into_cache_once, rel_path)
+
+    def _pull_into_cache_once(self, rel_path):
+        if self._in_cache(rel_path):
+            # Pulled by a concurrent caller that finished in the meantime
+            return True
         # Ensure the cache directory structure exists (e.g., dataset_#_files/)
         rel_path_dir = os.path.dirname(rel_path)
-        if not os.path.exists(self._get_cache_path(rel_path_dir)):
-            os.makedirs(self._get_cache_path(rel_path_dir))
-        # Now pull in the file
-        file_ok = self._download(rel_path)
+        safe_makedirs(self._get_cache_path(rel_path_dir))
+        # Now pull in the file, readers never see it until it is complete
+        file_ok = download_atomically(lambda path: self._download(rel_path, path), self._get_cache_path(rel_path))
         self._fix_permissions(self._get_cache_path(rel_path_dir))
         return file_ok
 
     def _transfer_cb(self, complete, total):
         self.transfer_progress = float(complete) / float(total) * 100  # in percent
 
-    def _download(self, rel_path):
-        local_destination = self._get_cache_path(rel_path)
+    def _download(self, rel_path, local_destination=None):
+        local_destination = local_destination or self._get_cache_path(rel_path)
         try:
             log.debug("Pulling '%s' into cache to %s", rel_path, local_destination)
             if self.cache_size > 0 and self._get_size_in_azure(rel_path) > self.cache_size:
@@ -300,6 +331,7 @@ class AzureBlobObjectStore(ObjectStore):
                 end_time = datetime.now()
                 log.debug("Pushed cache file '%s' to blob '%s' (%s bytes transfered in %s sec)",
                           source_file, rel_path, os.path.getsize(source_file), end_time - start_time)
+            self.block_cache.invalidate(rel_path)
             return True
 
         except AzureHttpError:
@@ -436,6 +468,7 @@ class AzureBlobObjectStore(ObjectStore):
                 return True
             else:
                 # Delete from cache first
+                self.block_cache.invalidate(rel_path)
                 os.unlink(self._get_cache_path(rel_path))
                 # Delete from S3 as well
                 if self._in_azure(rel_path):
@@ -452,13 +485,14 @@ class AzureBlobObjectStore(ObjectStore):
         rel_path = self._construct_path(obj, **kwargs)
         # Check cache first and get file if not there
         if not self._in_cache(rel_path):
+            if count >= 0:
+                # Serve ranges, e.g. dataset peeks, without pulling the whole object
+                content = self._get_remote_data(rel_path, start, count)
+                if content is not None:
+                    return content
             self._pull_into_cache(rel_path)
         # Read the file content from cache
-        data_file = open(self._get_cache_path(rel_path), 'r')
-        data_file.seek(start)
-        content = data_file.read(count)
-        data_file.close()
-        return content
+        return self._get_cached_data(rel_path, start, count)
 
     def get_filename(self, obj, **kwargs):
         rel_path = self._construct_path(obj, **kwargs)
@@ -0,0 +1,707 @@
+"""
+Caching utilities for the object stores, mostly for managing the local
+staging caches used by the cloud object stores (S3, Swift, Cloud, Azure).
+"""
+import logging
+import mmap
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from galaxy.util import sqlite
+
+log = logging.getLogger(__name__)
+
+CACHE_INDEX_FILENAME = ".cache_index.sqlite"
+PARTIAL_DOWNLOAD_SUFFIX = ".part"
+# Number of remote prefix listings run concurrently by BatchProbeMixin
+DEFAULT_PROBE_THREADS = 8
+# Number of files DiskObjectStore keeps memory mapped for get_data_view
+DEFAULT_MAX_MAPPED_FILES = 128
+# Granularity and capacity of the in memory cache of ranged remote reads
+DEFAULT_RANGE_BLOCK_SIZE = 64 * 1024
+DEFAULT_RANGE_CACHE_SIZE = 32 * 1024 * 1024
+# Capacity of the nested object stores cache of object locations and the
+# number of seconds objects found in no backend are remembered as missing
+DEFAULT_LOCATION_CACHE_SIZE = 10000
+DEFAULT_LOCATION_NEGATIVE_TTL = 10
+# Seconds within which repeated accesses to a cached file update its access
+# time in the cache index only once, and the number of files this is tracked for
+DEFAULT_TOUCH_INTERVAL = 60
+MAX_TRACKED_TOUCHES = 100000
+
+CACHE_INDEX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS cache_entries (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        atime REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_cache_entries_atime ON cache_entries (atime)",
+    """CREATE TABLE IF NOT EXISTS cache_totals (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        size INTEGER NOT NULL
+    )""",
+    "INSERT OR IGNORE INTO cache_totals (id, size) VALUES (0, 0)",
+    # Keep the running total in the same transaction as the entry changes so
+    # several Galaxy processes sharing one staging directory agree on it.
+    """CREATE TRIGGER IF NOT EXISTS cache_entries_insert AFTER INSERT ON cache_entries BEGIN
+        UPDATE cache_totals SET size = size + NEW.size WHERE id = 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS cache_entries_delete AFTER DELETE ON cache_entries BEGIN
+        UPDATE cache_totals SET size = size - OLD.size WHERE id = 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS cache_entries_update AFTER UPDATE OF size ON cache_entries BEGIN
+        UPDATE cache_totals SET size = size - OLD.size + NEW.size WHERE id = 0;
+    END""",
+]
+
+
+class CacheIndex(object):
+    """Persistent, access-ordered index of the files in an object store cache.
+
+    Object stores record files as they are pulled into, pushed from, read out
+    of or deleted from the cache, so the cache monitor can learn the total
+    cache size and the least recently used files without walking the
+    staging directory. Paths are stored relative to ``staging_path``.
+    Accesses to a file recorded less than ``touch_interval`` seconds ago are
+    not written to the index again, cache hits are then free of SQLite writes.
+    """
+
+    def __init__(self, staging_path, index_path=None, touch_interval=DEFAULT_TOUCH_INTERVAL):
+        self.staging_path = staging_path
+        self.touch_interval = touch_interval
+        # Maps paths to the access time last written for them
+        self._touched = {}
+        self.index_path = index_path or os.path.join(staging_path, CACHE_INDEX_FILENAME)
+        new_index = not os.path.exists(self.index_path)
+        if not os.path.exists(os.path.dirname(self.index_path)):
+            os.makedirs(os.path.dirname(self.index_path))
+        self._lock = threading.Lock()
+        self._connection = sqlite.connect(self.index_path, check_same_thread=False)
+        with self._lock, self._connection:
+            for statement in CACHE_INDEX_SCHEMA:
+                self._connection.execute(statement)
+        if new_index:
+            self.rebuild()
+
+    def rebuild(self):
+        """Re-populate the index from the files currently in the staging directory.
+
+        This is the only operation that walks the cache, it is needed once when
+        the index is first created for a pre-existing cache.
+        """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.staging_path):
+            # Hidden directories hold object store bookkeeping, not cached files
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                if filepath.startswith(self.index_path) or _is_partial_download(filename):
+                    continue
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((os.path.relpath(filepath, self.staging_path), stat.st_size, stat.st_atime))
+        with self._lock, self._connection:
+            self._touched.clear()
+            self._connection.execute("DELETE FROM cache_entries")
+            self._connection.executemany("INSERT INTO cache_entries (path, size, atime) VALUES (?, ?, ?)", entries)
+        log.debug("Rebuilt cache index %s with %d entries", self.index_path, len(entries))
+
+    def touch(self, rel_path, size=None):
+        """Record an access to ``rel_path``, adding it to the index if needed.
+
+        If ``size`` is ``None`` it is read from the cached file when the entry
+        is new and left untouched otherwise.
+        """
+        rel_path = os.path.normpath(rel_path)
+        now = time.time()
+        with self._lock:
+            if size is None and self._touched.get(rel_path, -self.touch_interval) + self.touch_interval > now:
+                return
+            if len(self._touched) >= MAX_TRACKED_TOUCHES:
+                self._touched.clear()
+            self._touched[rel_path] = now
+            with self._connection:
+                if size is None:
+                    cursor = self._connection.execute("UPDATE cache_entries SET atime = ? WHERE path = ?", (now, rel_path))
+                    if cursor.rowcount:
+                        return
+                    try:
+                        size = os.path.getsize(os.path.join(self.staging_path, rel_path))
+                    except OSError:
+                        del self._touched[rel_path]
+                        return
+                else:
+                    cursor = self._connection.execute("UPDATE cache_entries SET atime = ?, size = ? WHERE path = ?",
+                                                      (now, size, rel_path))
+                    if cursor.rowcount:
+                        return
+                self._connection.execute("INSERT INTO cache_entries (path, size, atime) VALUES (?, ?, ?)",
+                                         (rel_path, size, now))
+
+    def remove(self, rel_path):
+        rel_path = os.path.normpath(rel_path)
+        with self._lock, self._connection:
+            self._touched.pop(rel_path, None)
+            self._connection.execute("DELETE FROM cache_entries WHERE path = ?", (rel_path,))
+
+    def remove_dir(self, rel_path):
+        """Remove every entry located below the directory ``rel_path``."""
+        prefix = os.path.normpath(rel_path) + os.sep
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._lock, self._connection:
+            for path in [p for p in self._touched if p.startswith(prefix)]:
+                del self._touched[path]
+            self._connection.execute("DELETE FROM cache_entries WHERE path LIKE ? ESCAPE '\\'", (escaped + "%",))
+
+    def total_size(self):
+        with self._lock:
+            row = self._connection.execute("SELECT size FROM cache_totals WHERE id = 0").fetchone()
+        return row[0]
+
+    def pop_least_recently_used(self, delete_this_much, batch_size=100):
+        """Remove and return the least recently used entries from the index.
+
+        Entries are popped oldest first until their combined size reaches
+        ``delete_this_much`` bytes. Returns a list of ``(rel_path, size)``
+        tuples, deleting the corresponding files is left to the caller.
+        """
+        popped = []
+        popped_amount = 0
+        while popped_amount < delete_this_much:
+            with self._lock, self._connection:
+                rows = self._connection.execute("SELECT path, size FROM cache_entries ORDER BY atime LIMIT ?",
+                                                (batch_size,)).fetchall()
+                if not rows:
+                    break
+                batch = []
+                for row in rows:
+                    if popped_amount >= delete_this_much:
+                        break
+                    batch.append((row[0], row[1]))
+                    popped_amount += row[1]
+                self._connection.executemany("DELETE FROM cache_entries WHERE path = ?", [(p,) for p, _ in batch])
+                for path, _ in batch:
+                    self._touched.pop(path, None)
+            popped.extend(batch)
+        return popped
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class SingleFlight(object):
+    """Collapse concurrent calls for the same key into a single call.
+
+    The first caller for a key runs the function, callers arriving while it
+    is in flight block until it completes and receive its result (or its
+    exception) instead of running the function again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwds):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _SingleFlightCall()
+        if not leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+        try:
+            call.result = func(*args, **kwds)
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _SingleFlightCall(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+def download_atomically(download, cache_path):
+    """Run ``download(path)`` against a temporary file next to ``cache_path``.
+
+    The temporary file is renamed over ``cache_path`` only if ``download``
+    returns ``True``, so other readers of the cache never observe a partially
+    written file. Returns the result of ``download``.
+    """
+    cache_dir, cache_name = os.path.split(cache_path)
+    temp_path = os.path.join(cache_dir, ".%s.%s.%s%s" % (cache_name, os.getpid(), uuid.uuid4().hex, PARTIAL_DOWNLOAD_SUFFIX))
+    try:
+        file_ok = download(temp_path)
+        if file_ok and os.path.exists(temp_path):
+            os.rename(temp_path, cache_path)
+            return True
+        return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class BatchProbeMixin(object):
+    """Batched ``exists_many``/``size_many`` for cached remote object stores.
+
+    Instead of one request per object, the remote keys are listed once per
+    directory prefix, concurrently on a small thread pool. Classes using this
+    provide ``_list_remote_sizes(prefix)`` returning a dict mapping the names
+    of the keys directly below ``prefix`` to their sizes (or ``None`` if the
+    listing failed) on top of the usual ``_construct_path``, ``_in_cache``,
+    ``_get_cache_path`` and ``_push_to_os`` methods.
+    """
+    probe_threads = DEFAULT_PROBE_THREADS
+
+    def exists_many(self, objs, **kwargs):
+        if kwargs.get('dir_only', False) or kwargs.get('base_dir', None):
+            # Directories and job working directories are not listed remotely
+            return [self.exists(obj, **kwargs) for obj in objs]
+        rel_paths = [self._construct_path(obj, **kwargs) for obj in objs]
+        remote_sizes = self._probe_remote_sizes(rel_paths)
+        results = []
+        for obj, rel_path in zip(objs, rel_paths):
+            if rel_path not in remote_sizes:
+                results.append(self.exists(obj, **kwargs))
+                continue
+            in_cache = self._in_cache(rel_path)
+            in_remote = remote_sizes[rel_path] is not None
+            if in_cache and self._upload_pending(rel_path):
+                # Committed to the cache and waiting for the upload queue
+                results.append(True)
+                continue
+            if in_cache and not in_remote:
+                # Same synchronization as exists()
+                self._push_to_os(rel_path, source_file=self._get_cache_path(rel_path))
+            results.append(in_cache or in_remote)
+        return results
+
+    def size_many(self, objs, **kwargs):
+        if kwargs.get('dir_only', False) or kwargs.get('base_dir', None):
+            return [self.size(obj, **kwargs) for obj in objs]
+        rel_paths = [self._construct_path(obj, **kwargs) for obj in objs]
+        uncached = [rel_path for rel_path in rel_paths if not self._in_cache(rel_path)]
+        remote_sizes = self._probe_remote_sizes(uncached)
+        sizes = []
+        for obj, rel_path in zip(objs, rel_paths):
+            if rel_path in remote_sizes:
+                sizes.append(remote_sizes[rel_path] or 0)
+                continue
+            try:
+                sizes.append(os.path.getsize(self._get_cache_path(rel_path)))
+            except OSError:
+                sizes.append(self.size(obj, **kwargs))
+        return sizes
+
+    def _upload_pending(self, rel_path):
+        """Whether ``rel_path`` waits for a write-behind upload, stores with an upload queue override this."""
+        return False
+
+    def _probe_remote_sizes(self, rel_paths):
+        """
+        Return a dict mapping each of the ``rel_paths`` whose prefix could be
+        listed to its remote size, or ``None`` if there is no such key.
+        """
+        by_prefix = {}
+        for rel_path in rel_paths:
+            by_prefix.setdefault(os.path.dirname(rel_path) + '/', []).append(rel_path)
+        if not by_prefix:
+            return {}
+        prefixes = list(by_prefix.keys())
+        pool = ThreadPool(min(self.probe_threads, len(prefixes)))
+        try:
+            listings = pool.map(self._list_remote_sizes, prefixes)
+        finally:
+            pool.close()
+            pool.join()
+        remote_sizes = {}
+        for prefix, listing in zip(prefixes, listings):
+            if listing is None:
+                continue
+            for rel_path in by_prefix[prefix]:
+                remote_sizes[rel_path] = listing.get(rel_path)
+        return remote_sizes
+
+
+class MappedFileCache(object):
+    """Bounded LRU of read-only memory maps of files.
+
+    A mapping is reused while the file keeps the same inode, size and
+    modification time. Evicted mappings are closed unless views on them are
+    still in use, in which case they are released once the last view is.
+    """
+
+    def __init__(self, max_files=DEFAULT_MAX_MAPPED_FILES):
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._maps = OrderedDict()
+
+    def view(self, path, start=0, count=-1):
+        """Return a read-only ``memoryview`` of ``count`` bytes of ``path`` from ``start``."""
+        stat = os.stat(path)
+        if stat.st_size == 0 or start >= stat.st_size:
+            # Empty files cannot be mapped
+            return memoryview(b'')
+        end = stat.st_size if count < 0 else min(start + count, stat.st_size)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime)
+        with self._lock:
+            entry = self._maps.pop(path, None)
+            if entry is not None and entry[0] != key:
+                self._close(entry[1])
+                entry = None
+            if entry is None:
+                with open(path, 'rb') as fh:
+                    entry = (key, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+            self._maps[path] = entry
+            # The view is taken before the lock is released, another thread
+            # evicting and closing the mapping would invalidate it otherwise
+            mapping = entry[1]
+            try:
+                view = memoryview(mapping)[start:end]
+            except TypeError:
+                # Python 2 mmap objects do not export the new buffer interface
+                view = memoryview(mapping[start:end])
+            while len(self._maps) > self.max_files:
+                self._close(self._maps.popitem(last=False)[1][1])
+        return view
+
+    def close(self):
+        with self._lock:
+            while self._maps:
+                self._close(self._maps.popitem()[1][1])
+
+    def _close(self, mapping):
+        try:
+            mapping.close()
+        except BufferError:
+            # Views are still exported, the map is freed with the last of them
+            pass
+
+
+class LocationCache(object):
+    """Bounded LRU of the backends of a nested object store holding objects.
+
+    Entries are keyed by ``(object_key, variant)``, the variant being the
+    extra_dir, alt_name, etc. arguments the object was looked up with, so
+    ``invalidate`` drops every variant of an object at once. Objects found in
+    no backend are recorded as ``None`` and forgotten after ``negative_ttl``
+    seconds, since jobs write outputs to the backends directly.
+    """
+
+    def __init__(self, max_entries=DEFAULT_LOCATION_CACHE_SIZE, negative_ttl=DEFAULT_LOCATION_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_object = {}
+
+    def get(self, key):
+        """Return a ``(hit, backend_key)`` tuple."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False, None
+            backend_key, expires = entry
+            if expires is not None and expires < time.time():
+                self._discard(key)
+                return False, None
+            self._entries[key] = entry
+            return True, backend_key
+
+    def set(self, key, backend_key):
+        if self.max_entries <= 0:
+            return
+        expires = time.time() + self.negative_ttl if backend_key is None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (backend_key, expires)
+            self._keys_by_object.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, object_key):
+        with self._lock:
+            for key in self._keys_by_object.pop(object_key, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_object.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_object.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_object[key[0]]
+
+
+class BlockCache(object):
+    """Bounded LRU cache of fixed size blocks of remote objects.
+
+    ``read`` serves a byte range from the cached blocks and fetches the
+    missing ones with a single ranged request through
+    ``fetch(start, end)``, where ``end`` is inclusive as in HTTP ``Range``
+    headers. A block shorter than ``block_size`` marks the end of the object.
+    """
+
+    def __init__(self, block_size=DEFAULT_RANGE_BLOCK_SIZE, max_size=DEFAULT_RANGE_CACHE_SIZE):
+        self.block_size = block_size
+        self.max_blocks = max(max_size // block_size, 1)
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._blocks_by_path = {}
+
+    def read(self, rel_path, start, count, fetch):
+        if count <= 0:
+            return b''
+        first = start // self.block_size
+        last = (start + count - 1) // self.block_size
+        blocks = []
+        with self._lock:
+            for index in range(first, last + 1):
+                block = self._blocks.get((rel_path, index))
+                if block is None:
+                    break
+                # Mark as most recently used
+                self._blocks[(rel_path, index)] = self._blocks.pop((rel_path, index))
+                blocks.append(block)
+                if len(block) < self.block_size:
+                    break
+        if len(blocks) < last - first + 1 and (not blocks or len(blocks[-1]) == self.block_size):
+            missing = first + len(blocks)
+            data = fetch(missing * self.block_size, (last + 1) * self.block_size - 1)
+            fetched = [data[i:i + self.block_size] for i in range(0, (last + 1 - missing) * self.block_size, self.block_size)]
+            with self._lock:
+                for offset, block in enumerate(fetched):
+                    self._put(rel_path, missing + offset, block)
+                    if len(block) < self.block_size:
+                        break
+            blocks.extend(fetched)
+        content = b''.join(blocks)
+        offset = start - first * self.block_size
+        return content[offset:offset + count]
+
+    def invalidate(self, rel_path):
+        with self._lock:
+            for index in self._blocks_by_path.pop(rel_path, ()):
+                self._blocks.pop((rel_path, index), None)
+
+    def _put(self, rel_path, index, block):
+        self._blocks[(rel_path, index)] = block
+        self._blocks_by_path.setdefault(rel_path, set()).add(index)
+        while len(self._blocks) > self.max_blocks:
+            (old_path, old_index), _ = self._blocks.popitem(last=False)
+            indices = self._blocks_by_path.get(old_path)
+            if indices is not None:
+                indices.discard(old_index)
+                if not indices:
+                    del self._blocks_by_path[old_path]
+
+
+class RangedReadMixin(object):
+    """Serve ``get_data`` byte ranges of uncached objects straight from the backend.
+
+    Classes using this set ``self.block_cache`` to a :class:`BlockCache` and
+    provide ``_fetch_remote_range(rel_path, start, end)`` returning the bytes
+    from ``start`` to ``end`` (inclusive) of the remote object. Cached and
+    remote reads both count ``start`` and ``count`` in bytes and decode the
+    range as UTF-8, replacing characters cut at its boundaries.
+    """
+
+    def _get_cached_data(self, rel_path, start, count):
+        """Return ``count`` bytes of the cached object from offset ``start``."""
+        with open(self._get_cache_path(rel_path), 'rb') as data_file:
+            data_file.seek(start)
+            return _decode_data(data_file.read(count))
+
+    def _get_remote_data(self, rel_path, start, count):
+        """
+        Return ``count`` bytes of the remote object from offset ``start``, or
+        ``None`` if they could not be fetched and the whole object should be
+        pulled into the cache instead.
+        """
+        try:
+            content = self.block_cache.read(rel_path, start, count,
+                                            lambda range_start, range_end: self._fetch_remote_range(rel_path, range_start, range_end))
+        except Exception:
+            log.warning("Could not fetch range %s-%s of '%s', falling back to a full download",
+                        start, start + count - 1, rel_path, exc_info=True)
+            return None
+        return _decode_data(content)
+
+
+def _decode_data(content):
+    if not isinstance(content, str):
+        # Python 3, Python 2 returns the bytes as they are
+        content = content.decode('utf-8', 'replace')
+    return content
+
+
+UPLOAD_QUEUE_FILENAME = ".upload_queue.sqlite"
+
+UPLOAD_QUEUE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS pending_uploads (
+        rel_path TEXT PRIMARY KEY,
+        source_file TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        next_attempt REAL NOT NULL,
+        generation INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_pending_uploads_next_attempt ON pending_uploads (next_attempt)",
+]
+
+
+class UploadQueue(object):
+    """Persistent write-behind queue of files waiting to be pushed to an object store.
+
+    Uploads are run by a bounded pool of background threads calling
+    ``upload(rel_path, source_file)``, which must return ``True`` on success.
+    Failed uploads are retried with an exponential backoff capped at
+    ``max_backoff`` seconds. The queue is kept in a SQLite database so uploads
+    pending when Galaxy stops are resumed on the next start.
+    """
+
+    def __init__(self, staging_path, upload, workers=2, backoff=5, max_backoff=600, queue_path=None):
+        self.upload = upload
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue_path = queue_path or os.path.join(staging_path, UPLOAD_QUEUE_FILENAME)
+        if not os.path.exists(os.path.dirname(self.queue_path)):
+            os.makedirs(os.path.dirname(self.queue_path))
+        self._connection = sqlite.connect(self.queue_path, check_same_thread=False)
+        self._condition = threading.Condition(threading.Lock())
+        self._in_flight = set()
+        self._running = True
+        with self._condition, self._connection:
+            for statement in UPLOAD_QUEUE_SCHEMA:
+                self._connection.execute(statement)
+            pending = self._connection.execute("SELECT count(*) FROM pending_uploads").fetchone()[0]
+        if pending:
+            log.info("Resuming %d pending uploads from %s", pending, self.queue_path)
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name="UploadQueueWorker-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def enqueue(self, rel_path, source_file):
+        """Schedule ``source_file`` to be uploaded as ``rel_path`` as soon as possible.
+
+        Enqueuing a path that is already pending replaces the pending upload,
+        an upload of the same path in flight is repeated once it completes.
+        """
+        with self._condition:
+            with self._connection:
+                cursor = self._connection.execute(
+                    "UPDATE pending_uploads SET source_file = ?, attempts = 0, next_attempt = ?, generation = generation + 1 "
+                    "WHERE rel_path = ?", (source_file, time.time(), rel_path))
+                if not cursor.rowcount:
+                    self._connection.execute("INSERT INTO pending_uploads VALUES (?, ?, 0, ?, 0)",
+                                             (rel_path, source_file, time.time()))
+            self._condition.notify()
+
+    def cancel(self, rel_path):
+        """Drop the pending upload of ``rel_path``, if any."""
+        with self._condition, self._connection:
+            self._connection.execute("DELETE FROM pending_uploads WHERE rel_path = ?", (rel_path,))
+
+    def is_pending(self, rel_path):
+        with self._condition:
+            row = self._connection.execute("SELECT 1 FROM pending_uploads WHERE rel_path = ?", (rel_path,)).fetchone()
+        return row is not None
+
+    def pending_count(self):
+        with self._condition:
+            return self._connection.execute("SELECT count(*) FROM pending_uploads").fetchone()[0]
+
+    def shutdown(self, timeout=None):
+        """Stop the workers, uploads not yet completed stay queued for the next start."""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+        with self._condition:
+            self._connection.close()
+
+    def _claim(self):
+        """Block until an upload is due and claim it, return ``None`` on shutdown."""
+        with self._condition:
+            while self._running:
+                now = time.time()
+                # Only the uploads in flight can be ahead of the one to claim
+                rows = self._connection.execute(
+                    "SELECT rel_path, source_file, attempts, next_attempt, generation FROM pending_uploads "
+                    "ORDER BY next_attempt LIMIT ?", (len(self._in_flight) + 1,)).fetchall()
+                wait = None
+                for row in rows:
+                    if row[0] in self._in_flight:
+                        continue
+                    if row[3] <= now:
+                        self._in_flight.add(row[0])
+                        return tuple(row)
+                    wait = row[3] - now
+                    break
+                self._condition.wait(wait)
+        return None
+
+    def _work(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                return
+            rel_path, source_file, attempts, _, generation = job
+            try:
+                if not os.path.exists(source_file):
+                    log.warning("Dropping upload of '%s', source file '%s' no longer exists", rel_path, source_file)
+                    uploaded = None
+                else:
+                    uploaded = self.upload(rel_path, source_file)
+            except Exception:
+                log.exception("Trouble uploading '%s' from '%s'", rel_path, source_file)
+                uploaded = False
+            with self._condition:
+                self._in_flight.discard(rel_path)
+                if not self._running:
+                    return
+                with self._connection:
+                    if uploaded is False:
+                        delay = min(self.backoff * 2 ** attempts, self.max_backoff)
+                        log.warning("Upload of '%s' failed (attempt %d), retrying in %s seconds", rel_path, attempts + 1, delay)
+                        self._connection.execute(
+                            "UPDATE pending_uploads SET attempts = attempts + 1, next_attempt = ? "
+                            "WHERE rel_path = ? AND generation = ?", (time.time() + delay, rel_path, generation))
+                    else:
+                        # A newer generation was enqueued during the upload and must run again
+                        self._connection.execute("DELETE FROM pending_uploads WHERE rel_path = ? AND generation = ?",
+                                                 (rel_path, generation))
+                self._condition.notify()
+
+
+def _is_partial_download(filename):
+    return filename.startswith(".") and filename.endswith(PARTIAL_DOWNLOAD_SUFFIX)
@@ -11,14 +11,30 @@ import threading
 import time
 from datetime import datetime
 
+import requests
+
 from galaxy.exceptions import ObjectInvalid, ObjectNotFound
 from galaxy.util import (
     directory_hash_id,
     safe_relpath,
     umask_fix_perms,
 )
+from galaxy.util.path import safe_makedirs
 from galaxy.util.sleeper import Sleeper
+from .caching import (
+    BatchProbeMixin,
+    BlockCache,
+    CacheIndex,
+    download_atomically,
+    RangedReadMixin,
+    SingleFlight,
+    UploadQueue,
+)
 from .s3 import CloudConfigMixin, parse_config_xml
+from .transfers import (
+    MultipartUploader,
+    TransferStats,
+)
 from ..objectstore import convert_bytes, ObjectStore
 try:
     from cloudbridge.cloud.factory import CloudProviderFactory, ProviderList
@@ -35,7 +51,7 @@ NO_CLOUDBRIDGE_ERROR_MESSAGE = (
 )
 
 
-class Cloud(ObjectStore, CloudConfigMixin):
+class Cloud(BatchProbeMixin, RangedReadMixin, ObjectStore, CloudConfigMixin):
     """
     Object store that stores objects as items in an cloud storage. A local
     cache exists that is used as an intermediate location for files between
@@ -46,6 +62,9 @@ class Cloud(ObjectStore, CloudConfigMixin):
     def __init__(self, config, config_dict):
         super(Cloud, self).__init__(config, config_dict)
         self.transfer_progress = 0
+        self.upload_stats = TransferStats()
+        self._pull_flights = SingleFlight()
+        self.block_cache = BlockCache()
 
         auth_dict = config_dict['auth']
         bucket_dict = config_dict['bucket']
@@ -64,9 +83,14 @@ class Cloud(ObjectStore, CloudConfigMixin):
         self.multipart = connection_dict.get('multipart', True)
         self.is_secure = connection_dict.get('is_secure', True)
         self.conn_path = connection_dict.get('conn_path', '/')
+        self.download_threads = connection_dict.get('download_threads') or multiprocessing.cpu_count()
+        self.upload_part_threads = connection_dict.get('upload_part_threads') or multiprocessing.cpu_count()
 
         self.cache_size = cache_dict.get('size', -1)
         self.staging_path = cache_dict.get('path') or self.config.object_store_cache_path
+        self.write_behind = cache_dict.get('write_behind', False)
+        self.upload_threads = cache_dict.get('upload_threads', 2)
+        self.upload_queue = None
 
         self._initialize()
 
@@ -74,17 +98,28 @@ class Cloud(ObjectStore, CloudConfigMixin):
         if CloudProviderFactory is None:
             raise Exception(NO_CLOUDBRIDGE_ERROR_MESSAGE)
 
+        # CloudBridge does not expose multipart uploads, objects are sent in a
+        # single request through the engine for its retries and instrumentation
+        self.uploader = MultipartUploader(self.max_chunk_size * 1024 * 1024,
+                                          threads=self.upload_part_threads,
+                                          stats=self.upload_stats)
+
         self._configure_connection()
         self.bucket = self._get_bucket(self.bucket)
+        self.cache_index = None
         # Clean cache only if value is set in galaxy.ini
         if self.cache_size != -1:
             # Convert GBs to bytes for comparison
             self.cache_size = self.cache_size * 1073741824
+            self.cache_index = CacheIndex(self.staging_path)
             # Helper for interruptable sleep
             self.sleeper = Sleeper()
             self.cache_monitor_thread = threading.Thread(target=self.__cache_monitor)
             self.cache_monitor_thread.start()
             log.info("Cache cleaner manager started")
+        if self.write_behind:
+            self.upload_queue = UploadQueue(self.staging_path, self._push_to_os, workers=self.upload_threads)
+            log.info("Write-behind upload queue started with %s workers", self.upload_threads)
         # Test if 'axel' is available for parallel download and pull the key into cache
         try:
             subprocess.call('axel')
@@ -92,6 +127,12 @@ class Cloud(ObjectStore, CloudConfigMixin):
         except OSError:
             self.use_axel = False
 
+    def shutdown(self):
+        super(Cloud, self).shutdown()
+        if self.upload_queue is not None:
+            # Unfinished uploads are persisted and resumed on the next start
+            self.upload_queue.shutdown()
+
     def _configure_connection(self):
         log.debug("Configuring AWS-S3 Connection")
         aws_config = {'aws_access_key': self.access_key,
@@ -110,21 +151,9 @@ class Cloud(ObjectStore, CloudConfigMixin):
     def __cache_monitor(self):
         time.sleep(2)  # Wait for things to load before starting the monitor
         while self.running:
-            total_size = 0
-            # Is this going to be too expensive of an operation to be done frequently?
-            file_list = []
-            for dirpath, _, filenames in os.walk(self.staging_path):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    file_size = os.path.getsize(filepath)
-                    total_size += file_size
-                    # Get the time given file was last accessed
-                    last_access_time = time.localtime(os.stat(filepath)[7])
-                    # Compose a tuple of the access time and the file path
-                    file_tuple = last_access_time, filepath, file_size
-                    file_list.append(file_tuple)
-            # Sort the file list (based on access time)
-            file_list.sort()
+            # The cache index tracks the cache contents as files move in and
+            # out of it, so there is no need to walk the staging directory.
+            total_size = self.cache_index.total_size()
             # Initiate cleaning once within 10% of the defined cache size?
             cache_limit = self.cache_size * 0.9
             if total_size > cache_limit:
@@ -135,41 +164,45 @@ class Cloud(ObjectStore, CloudConfigMixin):
                 # the limit - maybe delete additional #%?
                 # For now, delete enough to leave at least 10% of the total cache free
                 delete_this_much = total_size - cache_limit
-                self.__clean_cache(file_list, delete_this_much)
+                self.__clean_cache(delete_this_much)
             self.sleeper.sleep(30)  # Test cache size every 30 seconds?
 
-    def __clean_cache(self, file_list, delete_this_much):
-        """ Keep deleting files from the file_list until the size of the deleted
-        files is greater than the value in delete_this_much parameter.
-
-        :type file_list: list
-        :param file_list: List of candidate files that can be deleted. This method
-            will start deleting files from the beginning of the list so the list
-            should be sorted accordingly. The list must contains 3-element tuples,
-            positioned as follows: position 0 holds file last accessed timestamp
-            (as time.struct_time), position 1 holds file path, and position 2 has
-            file size (e.g., (<access time>, /mnt/data/dataset_1.dat), 472394)
+    def __clean_cache(self, delete_this_much):
+        """ Delete the least recently used files from the cache until the size
+        of the deleted files is greater than the value in delete_this_much
+        parameter.
 
         :type delete_this_much: int
         :param delete_this_much: Total size of files, in bytes, that should be deleted.
         """
-        # Keep deleting datasets from file_list until deleted_amount does not
-        # exceed delete_this_much; start deleting from the front of the file list,
-        # which assumes the oldest files come first on the list.
         deleted_amount = 0
-        for entry in enumerate(file_list):
-            if deleted_amount < delete_this_much:
-                deleted_amount += entry[2]
-                os.remove(entry[1])
-                # Debugging code for printing deleted files' stats
-                # folder, file_name = os.path.split(f[1])
-                # file_date = time.strftime("%m/%d/%y %H:%M:%S", f[0])
-                # log.debug("%s. %-25s %s, size %s (deleted %s/%s)" \
-                #     % (i, file_name, convert_bytes(f[2]), file_date, \
-                #     convert_bytes(deleted_amount), convert_bytes(delete_this_much)))
+        for rel_path, file_size in self.cache_index.pop_least_recently_used(delete_this_much):
+            if self._upload_pending(rel_path):
+                # The cached copy is the only one until the upload completes
+                self._cache_index_touch(rel_path, size=file_size)
+                continue
+            try:
+                os.remove(self._get_cache_path(rel_path))
+                deleted_amount += file_size
+            except OSError:
+                # Already removed outside of the object store, the index
+                # entry is gone now as well.
+                log.debug("Cached file '%s' vanished before it could be cleaned", rel_path)
+        log.debug("Cache cleaning done. Total space freed: %s", convert_bytes(deleted_amount))
+
+    def _upload_pending(self, rel_path):
+        return self.upload_queue is not None and self.upload_queue.is_pending(rel_path)
+
+    def _cache_index_touch(self, rel_path, size=None):
+        if self.cache_index is not None:
+            self.cache_index.touch(rel_path, size=size)
+
+    def _cache_index_remove(self, rel_path, entire_dir=False):
+        if self.cache_index is not None:
+            if entire_dir:
+                self.cache_index.remove_dir(rel_path)
             else:
-                log.debug("Cache cleaning done. Total space freed: %s", convert_bytes(deleted_amount))
-                return
+                self.cache_index.remove(rel_path)
 
     def _get_bucket(self, bucket_name):
         try:
@@ -271,6 +304,29 @@ class Cloud(ObjectStore, CloudConfigMixin):
             raise
         return exists
 
+    def _list_remote_sizes(self, prefix):
+        try:
+            sizes = {}
+            results = self.bucket.objects.list(prefix=prefix)
+            while True:
+                sizes.update((obj.name, obj.size) for obj in results)
+                if not getattr(results, 'is_truncated', False):
+                    return sizes
+                results = self.bucket.objects.list(prefix=prefix, marker=results.marker)
+        except Exception:
+            log.exception("Trouble listing cloud keys with prefix '%s'", prefix)
+            return None
+
+    def _fetch_remote_range(self, rel_path, start, end):
+        # CloudBridge has no ranged reads, use a Range request on a signed URL
+        url = self.bucket.objects.get(rel_path).generate_url(expires_in=300)
+        response = requests.get(url, headers={'Range': 'bytes=%d-%d' % (start, end)}, timeout=60)
+        response.raise_for_status()
+        if response.status_code != 206:
+            # Range ignored, the whole object was returned
+            return response.content[start:end + 1]
+        return response.content
+
     def _in_cache(self, rel_path):
         """ Check if the given dataset is in the local cache and return True if so. """
         # log.debug("------ Checking cache for rel_path %s" % rel_path)
@@ -278,21 +334,30 @@ class Cloud(ObjectStore, CloudConfigMixin):
         return os.path.exists(cache_path)
 
     def _pull_into_cache(self, rel_path):
+        # Concurrent cache misses for the same key share a single download
+        return self._pull_flights.do(rel_path, self._pull_into_cache_once, rel_path)
+
+    def _pull_into_cache_once(self, rel_path):
+        if self._in_cache(rel_path):
+            # Pulled by a concurrent caller that finished in the meantime
+            return True
         # Ensure the cache directory structure exists (e.g., dataset_#_files/)
         rel_path_dir = os.path.dirname(rel_path)
-        if not os.path.exists(self._get_cache_path(rel_path_dir)):
-            os.makedirs(self._get_cache_path(rel_path_dir))
-        # Now pull in the file
-        file_ok = self._download(rel_path)
+        safe_makedirs(self._get_cache_path(rel_path_dir))
+        # Now pull in the file, readers never see it until it is complete
+        file_ok = download_atomically(lambda path: self._download(rel_path, path), self._get_cache_path(rel_path))
         self._fix_permissions(self._get_cache_path(rel_path_dir))
+        if file_ok:
+            self._cache_index_touch(rel_path)
         return file_ok
 
     def _transfer_cb(self, complete, total):
         self.transfer_progress += 10
 
-    def _download(self, rel_path):
+    def _download(self, rel_path, local_destination=None):
+        local_destination = local_destination or self._get_cache_path(rel_path)
         try:
-            log.debug("Pulling key '%s' into cache to %s", rel_path, self._get_cache_path(rel_path))
+            log.debug("Pulling key '%s' into cache to %s", rel_path, local_destination)
             key = self.bucket.objects.get(rel_path)
             # Test if cache is large enough to hold the new file
             if self.cache_size > 0 and key.size > self.cache_size:
@@ -300,16 +365,16 @@ class Cloud(ObjectStore, CloudConfigMixin):
                              rel_path, key.size, self.cache_size)
                 return False
             if self.use_axel:
-                log.debug("Parallel pulled key '%s' into cache to %s", rel_path, self._get_cache_path(rel_path))
+                log.debug("Parallel pulled key '%s' into cache to %s", rel_path, local_destination)
                 ncores = multiprocessing.cpu_count()
                 url = key.generate_url(7200)
                 ret_code = subprocess.call("axel -a -n %s '%s'" % (ncores, url))
                 if ret_code == 0:
                     return True
             else:
-                log.debug("Pulled key '%s' into cache to %s", rel_path, self._get_cache_path(rel_path))
+                log.debug("Pulled key '%s' into cache to %s", rel_path, local_destination)
                 self.transfer_progress = 0  # Reset transfer progress counter
-                with open(self._get_cache_path(rel_path), "w+") as downloaded_file_handle:
+                with open(local_destination, "w+") as downloaded_file_handle:
                     key.save_content(downloaded_file_handle)
                 return True
         except Exception:
@@ -343,15 +408,14 @@ class Cloud(ObjectStore, CloudConfigMixin):
                     log.debug("Pushing cache file '%s' of size %s bytes to key '%s'", source_file,
                               os.path.getsize(source_file), rel_path)
                     self.transfer_progress = 0  # Reset transfer progress counter
-                    if not self.bucket.objects.get(rel_path):
-                        created_obj = self.bucket.objects.create(rel_path)
-                        created_obj.upload_from_file(source_file)
-                    else:
-                        self.bucket.objects.get(rel_path).upload_from_file(source_file)
+                    self.uploader.upload(_CloudUploadTarget(self.bucket, rel_path), source_file)
 
                     end_time = datetime.now()
                     log.debug("Pushed cache file '%s' to key '%s' (%s bytes transfered in %s sec)",
                               source_file, rel_path, os.path.getsize(source_file), end_time - start_time)
+                self.block_cache.invalidate(rel_path)
+                if self._in_cache(rel_path):
+                    self._cache_index_touch(rel_path, size=os.path.getsize(self._get_cache_path(rel_path)))
                 return True
             else:
                 log.error("Tried updating key '%s' from source file '%s', but source file does not exist.",
@@ -368,6 +432,9 @@ class Cloud(ObjectStore, CloudConfigMixin):
         rel_path = self._construct_path(obj, **kwargs)
         # Make sure the size in cache is available in its entirety
         if self._in_cache(rel_path):
+            if self._upload_pending(rel_path):
+                # Complete in the cache, the cloud will catch up
+                return True
             if os.path.getsize(self._get_cache_path(rel_path)) == self._get_size_in_cloud(rel_path):
                 return True
             log.debug("Waiting for dataset %s to transfer from OS: %s/%s", rel_path,
@@ -381,6 +448,9 @@ class Cloud(ObjectStore, CloudConfigMixin):
         # Check cache
         if self._in_cache(rel_path):
             in_cache = True
+            if self._upload_pending(rel_path):
+                # Committed to the cache and waiting for the upload queue
+                return True
         # Check cloud
         in_cloud = self._key_exists(rel_path)
         # log.debug("~~~~~~ File '%s' exists in cache: %s; in s3: %s" % (rel_path, in_cache, in_s3))
@@ -473,6 +543,7 @@ class Cloud(ObjectStore, CloudConfigMixin):
             # but requires iterating through each individual key in S3 and deleing it.
             if entire_dir and extra_dir:
                 shutil.rmtree(self._get_cache_path(rel_path))
+                self._cache_index_remove(rel_path, entire_dir=True)
                 results = self.bucket.objects.list(prefix=rel_path)
                 for key in results:
                     log.debug("Deleting key %s", key.name)
@@ -480,7 +551,11 @@ class Cloud(ObjectStore, CloudConfigMixin):
                 return True
             else:
                 # Delete from cache first
+                if self.upload_queue is not None:
+                    self.upload_queue.cancel(rel_path)
+                self.block_cache.invalidate(rel_path)
                 os.unlink(self._get_cache_path(rel_path))
+                self._cache_index_remove(rel_path)
                 # Delete from S3 as well
                 if self._key_exists(rel_path):
                     key = self.bucket.objects.get(rel_path)
@@ -497,13 +572,14 @@ class Cloud(ObjectStore, CloudConfigMixin):
         rel_path = self._construct_path(obj, **kwargs)
         # Check cache first and get file if not there
         if not self._in_cache(rel_path):
+            if count >= 0:
+                # Serve ranges, e.g. dataset peeks, without pulling the whole object
+                content = self._get_remote_data(rel_path, start, count)
+                if content is not None:
+                    return content
             self._pull_into_cache(rel_path)
         # Read the file content from cache
-        data_file = open(self._get_cache_path(rel_path), 'r')
-        data_file.seek(start)
-        content = data_file.read(count)
-        data_file.close()
-        return content
+        return self._get_cached_data(rel_path, start, count)
 
     def get_filename(self, obj, **kwargs):
         base_dir = kwargs.get('base_dir', None)
@@ -526,6 +602,8 @@ class Cloud(ObjectStore, CloudConfigMixin):
         #     return cache_path
         # Check if the file exists in the cache first
         if self._in_cache(rel_path):
+            if not dir_only:
+                self._cache_index_touch(rel_path)
             return cache_path
         # Check if the file exists in persistent storage and, if it does, pull it into cache
         elif self.exists(obj, **kwargs):
@@ -561,8 +639,13 @@ class Cloud(ObjectStore, CloudConfigMixin):
                     log.exception("Trouble copying source file '%s' to cache '%s'", source_file, cache_file)
             else:
                 source_file = self._get_cache_path(rel_path)
-            # Update the file on cloud
-            self._push_to_os(rel_path, source_file)
+            if self.upload_queue is not None and self._in_cache(rel_path):
+                # Upload the committed cache copy in the background
+                self._cache_index_touch(rel_path, size=os.path.getsize(self._get_cache_path(rel_path)))
+                self.upload_queue.enqueue(rel_path, self._get_cache_path(rel_path))
+            else:
+                # Update the file on cloud
+                self._push_to_os(rel_path, source_file)
         else:
             raise ObjectNotFound('objectstore.update_from_file, object does not exist: %s, kwargs: %s'
                                  % (str(obj), str(kwargs)))
@@ -579,3 +662,18 @@ class Cloud(ObjectStore, CloudConfigMixin):
 
     def get_store_usage_percent(self):
         return 0.0
+
+
+class _CloudUploadTarget(object):
+    """:class:`galaxy.objectstore.transfers.MultipartUploader` target for a CloudBridge bucket object."""
+    supports_multipart = False
+
+    def __init__(self, bucket, rel_path):
+        self.bucket = bucket
+        self.name = rel_path
+
+    def upload_file(self, source_file):
+        obj = self.bucket.objects.get(self.name)
+        if not obj:
+            obj = self.bucket.objects.create(self.name)
+        obj.upload_from_file(source_file)
@@ -0,0 +1,203 @@
+"""
+Weighted, capacity-aware selection of the backend new objects are created in
+by the :class:`galaxy.objectstore.DistributedObjectStore`.
+"""
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Weight given to the newest observation in the moving averages
+SMOOTHING = 0.3
+
+
+class WeightedSampler(object):
+    """Pick keys at random proportionally to their weights.
+
+    Weights are stored in a Fenwick tree so both updating a weight and
+    sampling are O(log n).
+
+    >>> sampler = WeightedSampler(['a', 'b'], [0, 1])
+    >>> sampler.sample()
+    'b'
+    >>> sampler.update('b', 0)
+    >>> sampler.sample() is None
+    True
+    """
+
+    def __init__(self, keys, weights):
+        self.keys = list(keys)
+        self._index = dict((key, i) for i, key in enumerate(self.keys))
+        self._weights = [0.0] * len(self.keys)
+        self._tree = [0.0] * (len(self.keys) + 1)
+        for key, weight in zip(self.keys, weights):
+            self.update(key, weight)
+
+    @property
+    def total(self):
+        total = 0.0
+        i = len(self.keys)
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def weight(self, key):
+        return self._weights[self._index[key]]
+
+    def update(self, key, weight):
+        i = self._index[key]
+        weight = max(float(weight), 0.0)
+        delta = weight - self._weights[i]
+        self._weights[i] = weight
+        i += 1
+        while i <= len(self.keys):
+            self._tree[i] += delta
+            i += i & -i
+
+    def sample(self, rand=random.random):
+        """Return a random key, ``None`` if all weights are 0."""
+        total = self.total
+        if total <= 0:
+            return None
+        target = rand() * total
+        position = 0
+        step = 1
+        while step * 2 <= len(self.keys):
+            step *= 2
+        while step:
+            next_position = position + step
+            if next_position <= len(self.keys) and self._tree[next_position] <= target:
+                position = next_position
+                target -= self._tree[position]
+            step //= 2
+        # Guard against float rounding landing on a zero weight key
+        while position < len(self.keys) - 1 and self._weights[position] == 0:
+            position += 1
+        return self.keys[min(position, len(self.keys) - 1)]
+
+
+class _BackendUsage(object):
+
+    def __init__(self, weight, max_percent_full):
+        self.weight = weight
+        self.max_percent_full = max_percent_full
+        self.total_bytes = None
+        self.free_bytes = None
+        self.polled_at = None
+        # Objects created since the last poll, their content is mostly still to be written
+        self.in_flight = 0
+        self.allocations_since_poll = 0
+        self.object_size = 0.0
+        self.write_rate = 0.0
+
+
+class PlacementEngine(object):
+    """Choose backends for new objects, accounting for live disk usage.
+
+    Without capacity information every backend is picked proportionally to
+    its configured weight. Once ``poll`` has run, the weight is scaled by the
+    bytes the backend can still take before reaching its ``max_percent_full``
+    limit, minus what is expected to land on it before the next poll, relative
+    to the mean of these projected bytes over all backends at the last poll.
+    What is expected to land is its recent write throughput over the poll
+    interval, or, once more objects were allocated to it since the last poll,
+    their average size times their number. Backends are thus filled evenly in
+    bytes and stop getting new objects before, not after, they cross their
+    limit.
+
+    :type backends: dict
+    :param backends: Maps backend ids to objects providing ``get_store_space()``
+        returning ``(total_bytes, free_bytes)``.
+    """
+
+    def __init__(self, backends, weights, max_percent_full, global_max_percent_full=0, poll_interval=120):
+        self.backends = backends
+        self.poll_interval = poll_interval
+        self.global_max_percent_full = global_max_percent_full
+        self._lock = threading.Lock()
+        self._usage = dict((backend_id, _BackendUsage(weights[backend_id], max_percent_full.get(backend_id, 0)))
+                           for backend_id in backends)
+        self._sampler = WeightedSampler(list(backends.keys()), [weights[b] for b in backends])
+        # Mean projected bytes of the polled backends, projected bytes are weighted relative to it
+        self._mean_projected = 0.0
+
+    def allocate(self):
+        """Return the id of the backend the next object should be created in, ``None`` if all are full."""
+        with self._lock:
+            backend_id = self._sampler.sample()
+            if backend_id is not None:
+                usage = self._usage[backend_id]
+                usage.in_flight += 1
+                usage.allocations_since_poll += 1
+                self._update_weight(backend_id)
+            return backend_id
+
+    def poll(self):
+        """Refresh the usage of every backend."""
+        now = time.time()
+        for backend_id, backend in self.backends.items():
+            try:
+                total_bytes, free_bytes = backend.get_store_space()
+            except (OSError, AttributeError):
+                log.exception("Could not get the disk usage of backend '%s'", backend_id)
+                continue
+            with self._lock:
+                usage = self._usage[backend_id]
+                if usage.polled_at is not None:
+                    written = max(usage.free_bytes - free_bytes, 0)
+                    elapsed = max(now - usage.polled_at, 1e-6)
+                    usage.write_rate = _smooth(usage.write_rate, written / elapsed)
+                    if usage.allocations_since_poll:
+                        usage.object_size = _smooth(usage.object_size, float(written) / usage.allocations_since_poll)
+                usage.total_bytes = total_bytes
+                usage.free_bytes = free_bytes
+                usage.polled_at = now
+                usage.in_flight = 0
+                usage.allocations_since_poll = 0
+        with self._lock:
+            projected = [self._projected(backend_id) for backend_id, usage in self._usage.items() if usage.polled_at is not None]
+            self._mean_projected = float(sum(projected)) / len(projected) if projected else 0.0
+            for backend_id in self._usage:
+                self._update_weight(backend_id)
+
+    def percent_full(self, backend_id):
+        usage = self._usage[backend_id]
+        if not usage.total_bytes:
+            return 0.0
+        return (float(usage.total_bytes - usage.free_bytes) / usage.total_bytes) * 100
+
+    def effective_weight(self, backend_id):
+        return self._sampler.weight(backend_id)
+
+    def _headroom(self, backend_id):
+        usage = self._usage[backend_id]
+        return usage.free_bytes - usage.total_bytes * (1 - self._max_percent_full(backend_id) / 100.0)
+
+    def _max_percent_full(self, backend_id):
+        return self._usage[backend_id].max_percent_full or self.global_max_percent_full or 100
+
+    def _projected(self, backend_id):
+        """Return the bytes the backend is expected to be able to take at the next poll."""
+        usage = self._usage[backend_id]
+        # The measured write rate already includes the writes of in-flight objects
+        expected = max(usage.in_flight * usage.object_size, usage.write_rate * self.poll_interval)
+        return max(self._headroom(backend_id) - expected, 0)
+
+    def _update_weight(self, backend_id):
+        usage = self._usage[backend_id]
+        if usage.polled_at is None:
+            self._sampler.update(backend_id, usage.weight)
+            return
+        projected = self._projected(backend_id)
+        if projected == 0 and self._headroom(backend_id) > 0:
+            log.debug("Backend '%s' expected to reach %s%% full before the next poll, not selecting it",
+                      backend_id, self._max_percent_full(backend_id))
+        # Relative to the mean keeps weights comparable to the configured ones
+        self._sampler.update(backend_id, usage.weight * projected / self._mean_projected if self._mean_projected else 0)
+
+
+def _smooth(average, value):
+    return value if not average else SMOOTHING * value + (1 - SMOOTHING) * average
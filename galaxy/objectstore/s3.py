@@ -5,10 +5,10 @@ import logging
 import multiprocessing
 import os
 import shutil
-import subprocess
 import threading
 import time
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 try:
     # Imports are done this way to allow objectstore code to be used outside of Galaxy.
@@ -24,19 +24,57 @@ from galaxy.util import (
     directory_hash_id,
     string_as_bool,
     umask_fix_perms,
-    which,
 )
-from galaxy.util.path import safe_relpath
+from galaxy.util.path import (
+    safe_makedirs,
+    safe_relpath,
+)
 from galaxy.util.sleeper import Sleeper
-from .s3_multipart_upload import multipart_upload
+from .caching import (
+    BatchProbeMixin,
+    BlockCache,
+    CacheIndex,
+    download_atomically,
+    RangedReadMixin,
+    SingleFlight,
+    UploadQueue,
+)
+from .s3_multipart_upload import S3UploadTarget
+from .transfers import (
+    MultipartUploader,
+    MultipartUploadError,
+    TransferStats,
+)
 from ..objectstore import convert_bytes, ObjectStore
 
 NO_BOTO_ERROR_MESSAGE = ("S3/Swift object store configured, but no boto dependency available."
                          "Please install and properly configure boto or modify object store configuration.")
 
+# Directory of the staging path holding the state of interrupted multipart uploads
+MULTIPART_STATE_DIRNAME = ".multipart_uploads"
+# Size of the reads done by each thread while downloading a byte range
+DOWNLOAD_READ_SIZE = 1024 * 1024
+
 log = logging.getLogger(__name__)
 logging.getLogger('boto').setLevel(logging.INFO)  # Otherwise boto is quite noisy
 
+_pwrite_lock = threading.Lock()
+
+
+def _pwrite(fd, data, offset):
+    """Write ``data`` at ``offset`` of ``fd`` without moving a shared file position."""
+    if hasattr(os, 'pwrite'):
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset + written)
+    else:
+        # Python 2 has no pwrite, serialize seek and write on the shared offset.
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = 0
+            while written < len(data):
+                written += os.write(fd, data[written:])
+
 
 def parse_config_xml(config_xml):
     try:
@@ -60,9 +98,17 @@ def parse_config_xml(config_xml):
         multipart = string_as_bool(cn_xml.get('multipart', 'True'))
         is_secure = string_as_bool(cn_xml.get('is_secure', 'True'))
         conn_path = cn_xml.get('conn_path', '/')
+        download_threads = cn_xml.get('download_threads', None)
+        if download_threads is not None:
+            download_threads = int(download_threads)
+        upload_part_threads = cn_xml.get('upload_part_threads', None)
+        if upload_part_threads is not None:
+            upload_part_threads = int(upload_part_threads)
 
         c_xml = config_xml.findall('cache')[0]
         cache_size = float(c_xml.get('size', -1))
+        write_behind = string_as_bool(c_xml.get('write_behind', 'False'))
+        upload_threads = int(c_xml.get('upload_threads', 2))
 
         staging_path = c_xml.get('path', None)
 
@@ -90,10 +136,14 @@ def parse_config_xml(config_xml):
                 'multipart': multipart,
                 'is_secure': is_secure,
                 'conn_path': conn_path,
+                'download_threads': download_threads,
+                'upload_part_threads': upload_part_threads,
             },
             'cache': {
                 'size': cache_size,
                 'path': staging_path,
+                'write_behind': write_behind,
+                'upload_threads': upload_threads,
             },
             'extra_dirs': extra_dirs,
         }
@@ -121,15 +171,19 @@ class CloudConfigMixin(object):
                 'multipart': self.multipart,
                 'is_secure': self.is_secure,
                 'conn_path': self.conn_path,
+                'download_threads': self.download_threads,
+                'upload_part_threads': self.upload_part_threads,
             },
             'cache': {
                 'size': self.cache_size,
                 'path': self.staging_path,
+                'write_behind': self.write_behind,
+                'upload_threads': self.upload_threads,
             }
         }
 
 
-class S3ObjectStore(ObjectStore, CloudConfigMixin):
+class S3ObjectStore(BatchProbeMixin, RangedReadMixin, ObjectStore, CloudConfigMixin):
     """
     Object store that stores objects as items in an AWS S3 bucket. A local
     cache exists that is used as an intermediate location for files between
@@ -141,6 +195,9 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
         super(S3ObjectStore, self).__init__(config)
 
         self.transfer_progress = 0
+        self.upload_stats = TransferStats()
+        self._pull_flights = SingleFlight()
+        self.block_cache = BlockCache()
 
         auth_dict = config_dict['auth']
         bucket_dict = config_dict['bucket']
@@ -159,9 +216,14 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
         self.multipart = connection_dict.get('multipart', True)
         self.is_secure = connection_dict.get('is_secure', True)
         self.conn_path = connection_dict.get('conn_path', '/')
+        self.download_threads = connection_dict.get('download_threads') or multiprocessing.cpu_count()
+        self.upload_part_threads = connection_dict.get('upload_part_threads') or multiprocessing.cpu_count()
 
         self.cache_size = cache_dict.get('size', -1)
         self.staging_path = cache_dict.get('path') or self.config.object_store_cache_path
+        self.write_behind = cache_dict.get('write_behind', False)
+        self.upload_threads = cache_dict.get('upload_threads', 2)
+        self.upload_queue = None
 
         extra_dirs = dict(
             (e['type'], e['path']) for e in config_dict.get('extra_dirs', []))
@@ -186,22 +248,33 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
                          'use_rr': self.use_rr,
                          'conn_path': self.conn_path}
 
+        self.uploader = MultipartUploader(self.max_chunk_size * 1024 * 1024,
+                                          threads=self.upload_part_threads,
+                                          state_dir=os.path.join(self.staging_path, MULTIPART_STATE_DIRNAME),
+                                          stats=self.upload_stats)
+
         self._configure_connection()
         self.bucket = self._get_bucket(self.bucket)
+        self.cache_index = None
         # Clean cache only if value is set in galaxy.ini
         if self.cache_size != -1:
             # Convert GBs to bytes for comparison
             self.cache_size = self.cache_size * 1073741824
+            self.cache_index = CacheIndex(self.staging_path)
             # Helper for interruptable sleep
             self.sleeper = Sleeper()
             self.cache_monitor_thread = threading.Thread(target=self.__cache_monitor)
             self.cache_monitor_thread.start()
             log.info("Cache cleaner manager started")
-        # Test if 'axel' is available for parallel download and pull the key into cache
-        if which('axel'):
-            self.use_axel = True
-        else:
-            self.use_axel = False
+        if self.write_behind:
+            self.upload_queue = UploadQueue(self.staging_path, self._push_to_os, workers=self.upload_threads)
+            log.info("Write-behind upload queue started with %s workers", self.upload_threads)
+
+    def shutdown(self):
+        super(S3ObjectStore, self).shutdown()
+        if self.upload_queue is not None:
+            # Unfinished uploads are persisted and resumed on the next start
+            self.upload_queue.shutdown()
 
     def _configure_connection(self):
         log.debug("Configuring S3 Connection")
@@ -219,21 +292,9 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
     def __cache_monitor(self):
         time.sleep(2)  # Wait for things to load before starting the monitor
         while self.running:
-            total_size = 0
-            # Is this going to be too expensive of an operation to be done frequently?
-            file_list = []
-            for dirpath, _, filenames in os.walk(self.staging_path):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    file_size = os.path.getsize(filepath)
-                    total_size += file_size
-                    # Get the time given file was last accessed
-                    last_access_time = time.localtime(os.stat(filepath)[7])
-                    # Compose a tuple of the access time and the file path
-                    file_tuple = last_access_time, filepath, file_size
-                    file_list.append(file_tuple)
-            # Sort the file list (based on access time)
-            file_list.sort()
+            # The cache index tracks the cache contents as files move in and
+            # out of it, so there is no need to walk the staging directory.
+            total_size = self.cache_index.total_size()
             # Initiate cleaning once within 10% of the defined cache size?
             cache_limit = self.cache_size * 0.9
             if total_size > cache_limit:
@@ -244,41 +305,45 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
                 # the limit - maybe delete additional #%?
                 # For now, delete enough to leave at least 10% of the total cache free
                 delete_this_much = total_size - cache_limit
-                self.__clean_cache(file_list, delete_this_much)
+                self.__clean_cache(delete_this_much)
             self.sleeper.sleep(30)  # Test cache size every 30 seconds?
 
-    def __clean_cache(self, file_list, delete_this_much):
-        """ Keep deleting files from the file_list until the size of the deleted
-        files is greater than the value in delete_this_much parameter.
-
-        :type file_list: list
-        :param file_list: List of candidate files that can be deleted. This method
-            will start deleting files from the beginning of the list so the list
-            should be sorted accordingly. The list must contains 3-element tuples,
-            positioned as follows: position 0 holds file last accessed timestamp
-            (as time.struct_time), position 1 holds file path, and position 2 has
-            file size (e.g., (<access time>, /mnt/data/dataset_1.dat), 472394)
+    def __clean_cache(self, delete_this_much):
+        """ Delete the least recently used files from the cache until the size
+        of the deleted files is greater than the value in delete_this_much
+        parameter.
 
         :type delete_this_much: int
         :param delete_this_much: Total size of files, in bytes, that should be deleted.
         """
-        # Keep deleting datasets from file_list until deleted_amount does not
-        # exceed delete_this_much; start deleting from the front of the file list,
-        # which assumes the oldest files come first on the list.
         deleted_amount = 0
-        for entry in file_list:
-            if deleted_amount < delete_this_much:
-                deleted_amount += entry[2]
-                os.remove(entry[1])
-                # Debugging code for printing deleted files' stats
-                # folder, file_name = os.path.split(f[1])
-                # file_date = time.strftime("%m/%d/%y %H:%M:%S", f[0])
-                # log.debug("%s. %-25s %s, size %s (deleted %s/%s)" \
-                #     % (i, file_name, convert_bytes(f[2]), file_date, \
-                #     convert_bytes(deleted_amount), convert_bytes(delete_this_much)))
+        for rel_path, file_size in self.cache_index.pop_least_recently_used(delete_this_much):
+            if self._upload_pending(rel_path):
+                # The cached copy is the only one until the upload completes
+                self._cache_index_touch(rel_path, size=file_size)
+                continue
+            try:
+                os.remove(self._get_cache_path(rel_path))
+                deleted_amount += file_size
+            except OSError:
+                # Already removed outside of the object store, the index
+                # entry is gone now as well.
+                log.debug("Cached file '%s' vanished before it could be cleaned", rel_path)
+        log.debug("Cache cleaning done. Total space freed: %s", convert_bytes(deleted_amount))
+
+    def _upload_pending(self, rel_path):
+        return self.upload_queue is not None and self.upload_queue.is_pending(rel_path)
+
+    def _cache_index_touch(self, rel_path, size=None):
+        if self.cache_index is not None:
+            self.cache_index.touch(rel_path, size=size)
+
+    def _cache_index_remove(self, rel_path, entire_dir=False):
+        if self.cache_index is not None:
+            if entire_dir:
+                self.cache_index.remove_dir(rel_path)
             else:
-                log.debug("Cache cleaning done. Total space freed: %s", convert_bytes(deleted_amount))
-                return
+                self.cache_index.remove(rel_path)
 
     def _get_bucket(self, bucket_name):
         """ Sometimes a handle to a bucket is not established right away so try
@@ -382,6 +447,19 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
             raise
         return exists
 
+    def _list_remote_sizes(self, prefix):
+        try:
+            # The delimiter keeps keys of nested extra files directories out
+            return dict((key.name, key.size) for key in self.bucket.list(prefix=prefix, delimiter='/')
+                        if isinstance(key, Key))
+        except S3ResponseError:
+            log.exception("Trouble listing S3 keys with prefix '%s'", prefix)
+            return None
+
+    def _fetch_remote_range(self, rel_path, start, end):
+        key = Key(self.bucket, rel_path)
+        return key.get_contents_as_string(headers={'Range': 'bytes=%d-%d' % (start, end)})
+
     def _in_cache(self, rel_path):
         """ Check if the given dataset is in the local cache and return True if so. """
         # log.debug("------ Checking cache for rel_path %s" % rel_path)
@@ -412,43 +490,95 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
         #     return False
 
     def _pull_into_cache(self, rel_path):
+        # Concurrent cache misses for the same key share a single download
+        return self._pull_flights.do(rel_path, self._pull_into_cache_once, rel_path)
+
+    def _pull_into_cache_once(self, rel_path):
+        if self._in_cache(rel_path):
+            # Pulled by a concurrent caller that finished in the meantime
+            return True
         # Ensure the cache directory structure exists (e.g., dataset_#_files/)
         rel_path_dir = os.path.dirname(rel_path)
-        if not os.path.exists(self._get_cache_path(rel_path_dir)):
-            os.makedirs(self._get_cache_path(rel_path_dir))
-        # Now pull in the file
-        file_ok = self._download(rel_path)
+        safe_makedirs(self._get_cache_path(rel_path_dir))
+        # Now pull in the file, readers never see it until it is complete
+        file_ok = download_atomically(lambda path: self._download(rel_path, path), self._get_cache_path(rel_path))
         self._fix_permissions(self._get_cache_path(rel_path_dir))
+        if file_ok:
+            self._cache_index_touch(rel_path)
         return file_ok
 
     def _transfer_cb(self, complete, total):
         self.transfer_progress += 10
 
-    def _download(self, rel_path):
+    def _download(self, rel_path, local_destination=None):
+        local_destination = local_destination or self._get_cache_path(rel_path)
         try:
-            log.debug("Pulling key '%s' into cache to %s", rel_path, self._get_cache_path(rel_path))
+            log.debug("Pulling key '%s' into cache to %s", rel_path, local_destination)
             key = self.bucket.get_key(rel_path)
             # Test if cache is large enough to hold the new file
             if self.cache_size > 0 and key.size > self.cache_size:
                 log.critical("File %s is larger (%s) than the cache size (%s). Cannot download.",
                              rel_path, key.size, self.cache_size)
                 return False
-            if self.use_axel:
-                log.debug("Parallel pulled key '%s' into cache to %s", rel_path, self._get_cache_path(rel_path))
-                ncores = multiprocessing.cpu_count()
-                url = key.generate_url(7200)
-                ret_code = subprocess.call(['axel', '-a', '-n', ncores, url])
-                if ret_code == 0:
-                    return True
+            part_size = self.max_chunk_size * 1024 * 1024
+            if self.multipart and self.download_threads > 1 and key.size > part_size:
+                log.debug("Parallel pulled key '%s' into cache to %s", rel_path, local_destination)
+                return self._download_parts(key, local_destination, part_size)
             else:
-                log.debug("Pulled key '%s' into cache to %s", rel_path, self._get_cache_path(rel_path))
+                log.debug("Pulled key '%s' into cache to %s", rel_path, local_destination)
                 self.transfer_progress = 0  # Reset transfer progress counter
-                key.get_contents_to_filename(self._get_cache_path(rel_path), cb=self._transfer_cb, num_cb=10)
+                key.get_contents_to_filename(local_destination, cb=self._transfer_cb, num_cb=10)
                 return True
         except S3ResponseError:
             log.exception("Problem downloading key '%s' from S3 bucket '%s'", rel_path, self.bucket.name)
         return False
 
+    def _download_parts(self, key, cache_path, part_size):
+        """
+        Download ``key`` to ``cache_path`` by fetching byte ranges of at most
+        ``part_size`` bytes concurrently on a pool of ``self.download_threads``
+        threads. Each range is written directly at its offset into a file
+        preallocated to the size of the key.
+        """
+        ranges = [(start, min(start + part_size, key.size) - 1) for start in range(0, key.size, part_size)]
+        self.transfer_progress = 0  # Reset transfer progress counter
+        fd = os.open(cache_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, key.size)
+
+            def download_range(byte_range):
+                start, end = byte_range
+                # Keys hold the open response, so every range needs its own
+                part_key = self.bucket.new_key(key.name)
+                part_key.open_read(headers={'Range': 'bytes=%d-%d' % (start, end)})
+                offset = start
+                try:
+                    while True:
+                        chunk = part_key.read(DOWNLOAD_READ_SIZE)
+                        if not chunk:
+                            break
+                        _pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                finally:
+                    part_key.close()
+                self.transfer_progress += int(100 * (end - start + 1) / key.size)
+                return offset - start
+
+            pool = ThreadPool(min(self.download_threads, len(ranges)))
+            try:
+                written = sum(pool.map(download_range, ranges))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            os.close(fd)
+        if written != key.size or os.path.getsize(cache_path) != key.size:
+            log.error("Parallel download of key '%s' to '%s' is incomplete: got %s of %s bytes",
+                      key.name, cache_path, written, key.size)
+            os.remove(cache_path)
+            return False
+        return True
+
     def _push_to_os(self, rel_path, source_file=None, from_string=None):
         """
         Push the file pointed to by ``rel_path`` to the object store naming the key
@@ -470,23 +600,21 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
                 else:
                     start_time = datetime.now()
                     log.debug("Pushing cache file '%s' of size %s bytes to key '%s'", source_file, os.path.getsize(source_file), rel_path)
-                    mb_size = os.path.getsize(source_file) / 1e6
-                    if mb_size < 10 or (not self.multipart):
-                        self.transfer_progress = 0  # Reset transfer progress counter
-                        key.set_contents_from_filename(source_file,
-                                                       reduced_redundancy=self.use_rr,
-                                                       cb=self._transfer_cb,
-                                                       num_cb=10)
-                    else:
-                        multipart_upload(self.s3server, self.bucket, key.name, source_file, mb_size)
+                    self.transfer_progress = 0  # Reset transfer progress counter
+                    target = S3UploadTarget(self.s3server, self.bucket, key.name, multipart=self.multipart,
+                                            cb=self._transfer_cb, num_cb=10)
+                    self.uploader.upload(target, source_file)
                     end_time = datetime.now()
                     log.debug("Pushed cache file '%s' to key '%s' (%s bytes transfered in %s sec)",
                               source_file, rel_path, os.path.getsize(source_file), end_time - start_time)
+                self.block_cache.invalidate(rel_path)
+                if self._in_cache(rel_path):
+                    self._cache_index_touch(rel_path, size=os.path.getsize(self._get_cache_path(rel_path)))
                 return True
             else:
                 log.error("Tried updating key '%s' from source file '%s', but source file does not exist.",
                           rel_path, source_file)
-        except S3ResponseError:
+        except (S3ResponseError, MultipartUploadError):
             log.exception("Trouble pushing S3 key '%s' from file '%s'", rel_path, source_file)
         return False
 
@@ -498,6 +626,9 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
         rel_path = self._construct_path(obj, **kwargs)
         # Make sure the size in cache is available in its entirety
         if self._in_cache(rel_path):
+            if self._upload_pending(rel_path):
+                # Complete in the cache, S3 will catch up
+                return True
             if os.path.getsize(self._get_cache_path(rel_path)) == self._get_size_in_s3(rel_path):
                 return True
             log.debug("Waiting for dataset %s to transfer from OS: %s/%s", rel_path,
@@ -511,6 +642,9 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
         # Check cache
         if self._in_cache(rel_path):
             in_cache = True
+            if self._upload_pending(rel_path):
+                # Committed to the cache and waiting for the upload queue
+                return True
         # Check S3
         in_s3 = self._key_exists(rel_path)
         # log.debug("~~~~~~ File '%s' exists in cache: %s; in s3: %s" % (rel_path, in_cache, in_s3))
@@ -609,6 +743,7 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
             # but requires iterating through each individual key in S3 and deleing it.
             if entire_dir and extra_dir:
                 shutil.rmtree(self._get_cache_path(rel_path))
+                self._cache_index_remove(rel_path, entire_dir=True)
                 results = self.bucket.get_all_keys(prefix=rel_path)
                 for key in results:
                     log.debug("Deleting key %s", key.name)
@@ -616,7 +751,12 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
                 return True
             else:
                 # Delete from cache first
+                if self.upload_queue is not None:
+                    self.upload_queue.cancel(rel_path)
+                self.uploader.discard(S3UploadTarget(self.s3server, self.bucket, rel_path, multipart=self.multipart))
+                self.block_cache.invalidate(rel_path)
                 os.unlink(self._get_cache_path(rel_path))
+                self._cache_index_remove(rel_path)
                 # Delete from S3 as well
                 if self._key_exists(rel_path):
                     key = Key(self.bucket, rel_path)
@@ -633,13 +773,14 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
         rel_path = self._construct_path(obj, **kwargs)
         # Check cache first and get file if not there
         if not self._in_cache(rel_path):
+            if count >= 0:
+                # Serve ranges, e.g. dataset peeks, without pulling the whole object
+                content = self._get_remote_data(rel_path, start, count)
+                if content is not None:
+                    return content
             self._pull_into_cache(rel_path)
         # Read the file content from cache
-        data_file = open(self._get_cache_path(rel_path), 'r')
-        data_file.seek(start)
-        content = data_file.read(count)
-        data_file.close()
-        return content
+        return self._get_cached_data(rel_path, start, count)
 
     def get_filename(self, obj, **kwargs):
         base_dir = kwargs.get('base_dir', None)
@@ -662,6 +803,8 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
         #     return cache_path
         # Check if the file exists in the cache first
         if self._in_cache(rel_path):
+            if not dir_only:
+                self._cache_index_touch(rel_path)
             return cache_path
         # Check if the file exists in persistent storage and, if it does, pull it into cache
         elif self.exists(obj, **kwargs):
@@ -697,8 +840,13 @@ class S3ObjectStore(ObjectStore, CloudConfigMixin):
                     log.exception("Trouble copying source file '%s' to cache '%s'", source_file, cache_file)
             else:
                 source_file = self._get_cache_path(rel_path)
-            # Update the file on S3
-            self._push_to_os(rel_path, source_file)
+            if self.upload_queue is not None and self._in_cache(rel_path):
+                # Upload the committed cache copy in the background
+                self._cache_index_touch(rel_path, size=os.path.getsize(self._get_cache_path(rel_path)))
+                self.upload_queue.enqueue(rel_path, self._get_cache_path(rel_path))
+            else:
+                # Update the file on S3
+                self._push_to_os(rel_path, source_file)
         else:
             raise ObjectNotFound('objectstore.update_from_file, object does not exist: %s, kwargs: %s'
                                  % (str(obj), str(kwargs)))
@@ -1,37 +1,25 @@
 #!/usr/bin/env python
 """
-Split large file into multiple pieces for upload to S3.
-This parallelizes the task over available cores using multiprocessing.
-Code mostly taken form CloudBioLinux.
+Upload target for S3 (and Swift through its S3 API) used with
+:class:`galaxy.objectstore.transfers.MultipartUploader`, which sends the parts
+of large files concurrently.
 """
 
-import contextlib
-import functools
-import glob
-import multiprocessing
-import os
-import subprocess
-from multiprocessing.pool import IMapIterator
+import threading
 
 try:
     import boto
     from boto.s3.connection import S3Connection
+    from boto.s3.key import Key
 except ImportError:
     boto = None
 
 
-def map_wrap(f):
-    @functools.wraps(f)
-    def wrapper(args):
-        return f(*args)
-    return wrapper
-
-
 def mp_from_ids(s3server, mp_id, mp_keyname, mp_bucketname):
     """Get the multipart upload from the bucket and multipart IDs.
 
     This allows us to reconstitute a connection to the upload
-    from within multiprocessing functions.
+    from within the threads uploading parts.
     """
     if s3server['host']:
         conn = boto.connect_s3(aws_access_key_id=s3server['access_key'],
@@ -51,58 +39,46 @@ def mp_from_ids(s3server, mp_id, mp_keyname, mp_bucketname):
     return mp
 
 
-@map_wrap
-def transfer_part(s3server, mp_id, mp_keyname, mp_bucketname, i, part):
-    """Transfer a part of a multipart upload. Designed to be run in parallel.
-    """
-    mp = mp_from_ids(s3server, mp_id, mp_keyname, mp_bucketname)
-    with open(part) as t_handle:
-        mp.upload_part_from_file(t_handle, i + 1)
-    os.remove(part)
-
+class S3UploadTarget(object):
+    """Upload ``key_name`` to ``bucket``.
 
-def multipart_upload(s3server, bucket, s3_key_name, tarball, mb_size):
-    """Upload large files using Amazon's multipart upload functionality.
-    """
-    cores = multiprocessing.cpu_count()
-
-    def split_file(in_file, mb_size, split_num=5):
-        prefix = os.path.join(os.path.dirname(in_file),
-                              "%sS3PART" % (os.path.basename(s3_key_name)))
-        max_chunk = s3server['max_chunk_size']
-        # Split chunks so they are 5MB < chunk < 250MB(max_chunk_size)
-        split_size = int(max(min(mb_size / (split_num * 2.0), max_chunk), 5))
-        if not os.path.exists("%saa" % prefix):
-            cl = ["split", "-b%sm" % split_size, in_file, prefix]
-            subprocess.check_call(cl)
-        return sorted(glob.glob("%s*" % prefix))
-
-    mp = bucket.initiate_multipart_upload(s3_key_name,
-                                          reduced_redundancy=s3server['use_rr'])
-
-    with multimap(cores) as pmap:
-        for _ in pmap(transfer_part, ((s3server, mp.id, mp.key_name, mp.bucket_name, i, part)
-                                      for (i, part) in
-                                      enumerate(split_file(tarball, mb_size, cores)))):
-            pass
-    mp.complete_upload()
-
-
-@contextlib.contextmanager
-def multimap(cores=None):
-    """Provide multiprocessing imap like function.
-
-    The context manager handles setting up the pool, worked around interrupt issues
-    and terminating the pool on completion.
+    boto connections should not be shared between threads, so every thread
+    sending parts reconstitutes the multipart upload on its own connection.
     """
-    if cores is None:
-        cores = max(multiprocessing.cpu_count() - 1, 1)
-
-    def wrapper(func):
-        def wrap(self, timeout=None):
-            return func(self, timeout=timeout if timeout is not None else 1e100)
-        return wrap
-    IMapIterator.next = wrapper(IMapIterator.next)
-    pool = multiprocessing.Pool(cores)
-    yield pool.imap
-    pool.terminate()
+
+    def __init__(self, s3server, bucket, key_name, multipart=True, cb=None, num_cb=10):
+        self.supports_multipart = multipart
+        self.s3server = s3server
+        self.bucket = bucket
+        self.name = key_name
+        self.cb = cb
+        self.num_cb = num_cb
+        self._local = threading.local()
+
+    def upload_file(self, source_file):
+        key = Key(self.bucket, self.name)
+        key.set_contents_from_filename(source_file,
+                                       reduced_redundancy=self.s3server['use_rr'],
+                                       cb=self.cb,
+                                       num_cb=self.num_cb)
+
+    def initiate(self):
+        return self.bucket.initiate_multipart_upload(self.name, reduced_redundancy=self.s3server['use_rr']).id
+
+    def upload_part(self, upload_id, part_number, fh, size):
+        self._multipart_upload(upload_id).upload_part_from_file(fh, part_number, size=size)
+
+    def uploaded_parts(self, upload_id):
+        return [part.part_number for part in self._multipart_upload(upload_id)]
+
+    def complete(self, upload_id):
+        self._multipart_upload(upload_id).complete_upload()
+
+    def abort(self, upload_id):
+        self._multipart_upload(upload_id).cancel_upload()
+
+    def _multipart_upload(self, upload_id):
+        mps = self._local.__dict__.setdefault('mps', {})
+        if upload_id not in mps:
+            mps[upload_id] = mp_from_ids(self.s3server, upload_id, self.name, self.bucket.name)
+        return mps[upload_id]
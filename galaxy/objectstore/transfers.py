@@ -0,0 +1,268 @@
+"""
+Chunked, concurrent and resumable upload engine shared by the cloud object
+stores (S3, Swift, Cloud).
+
+The engine is independent of any storage API, object stores hand it a
+*target* describing how to talk to their backend::
+
+    class Target(object):
+        name = 'key/name'                    # used in logs and resume state
+        supports_multipart = True
+
+        def upload_file(self, source_file): ...     # single request upload
+        def initiate(self): ...                     # returns an upload id
+        def upload_part(self, upload_id, part_number, fh, size): ...
+        def uploaded_parts(self, upload_id): ...    # part numbers already stored
+        def complete(self, upload_id): ...
+        def abort(self, upload_id): ...
+
+Only ``name``, ``supports_multipart`` and ``upload_file`` are needed for
+targets without multipart support.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from galaxy.util import smart_str
+
+log = logging.getLogger(__name__)
+
+# Files smaller than this are always sent in a single request
+MULTIPART_THRESHOLD = 10 * 1024 * 1024
+# Smallest part size accepted by S3 (except for the last part)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class TransferStats(object):
+    """Cumulative throughput of the transfers done by an object store."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.transfers = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.last_bytes_per_second = 0.0
+
+    def record(self, nbytes, seconds):
+        seconds = max(seconds, 1e-6)
+        with self._lock:
+            self.transfers += 1
+            self.bytes += nbytes
+            self.seconds += seconds
+            self.last_bytes_per_second = nbytes / seconds
+        return nbytes / seconds
+
+    @property
+    def bytes_per_second(self):
+        with self._lock:
+            return self.bytes / self.seconds if self.seconds else 0.0
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'transfers': self.transfers,
+                'bytes': self.bytes,
+                'seconds': self.seconds,
+                'bytes_per_second': self.bytes / self.seconds if self.seconds else 0.0,
+                'last_bytes_per_second': self.last_bytes_per_second,
+            }
+
+
+class MultipartUploadError(Exception):
+    pass
+
+
+class MultipartUploader(object):
+    """Upload files to a target, in concurrently sent parts when supported.
+
+    :type max_part_size: int
+    :param max_part_size: Upper bound, in bytes, of a part. Parts are sized to
+        give every thread about two parts, within ``MIN_PART_SIZE`` and this.
+
+    :type threads: int
+    :param threads: Number of parts uploaded concurrently.
+
+    :type attempts: int
+    :param attempts: Number of times each part (or single request upload)
+        is tried before the upload is given up.
+
+    :type state_dir: str
+    :param state_dir: If set, the progress of multipart uploads is recorded
+        there so an interrupted upload of an unchanged file resumes with the
+        parts not yet uploaded.
+
+    :type resumes: int
+    :param resumes: Number of times a failed multipart upload recorded in
+        ``state_dir`` may be resumed. Once these are used up, or the upload
+        cannot be resumed, it is aborted and its state removed.
+
+    :type stats: TransferStats
+    :param stats: Throughput instrumentation updated after each upload.
+    """
+
+    def __init__(self, max_part_size, threads=4, attempts=3, backoff=1, state_dir=None, stats=None,
+                 multipart_threshold=MULTIPART_THRESHOLD, resumes=3):
+        self.max_part_size = max(max_part_size, MIN_PART_SIZE)
+        self.threads = max(threads, 1)
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.state_dir = state_dir
+        self.stats = stats if stats is not None else TransferStats()
+        self.multipart_threshold = multipart_threshold
+        self.resumes = max(resumes, 0)
+
+    def part_size(self, size):
+        return int(max(min(size / (self.threads * 2.0), self.max_part_size), MIN_PART_SIZE))
+
+    def upload(self, target, source_file):
+        """Upload ``source_file`` to ``target``, return the achieved bytes/sec."""
+        size = os.path.getsize(source_file)
+        start = time.time()
+        if target.supports_multipart and size >= self.multipart_threshold:
+            self._upload_parts(target, source_file, size)
+        else:
+            self._retry("upload of '%s'" % target.name, target.upload_file, source_file)
+        rate = self.stats.record(size, time.time() - start)
+        log.debug("Uploaded '%s' to '%s' (%s bytes at %.2f MB/s, store average %.2f MB/s)",
+                  source_file, target.name, size, rate / 1e6, self.stats.bytes_per_second / 1e6)
+        return rate
+
+    def _retry(self, description, func, *args):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return func(*args)
+            except Exception:
+                if attempt == self.attempts:
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                log.warning("Attempt %d/%d of %s failed, retrying in %s seconds",
+                            attempt, self.attempts, description, delay, exc_info=True)
+                time.sleep(delay)
+
+    def _upload_parts(self, target, source_file, size):
+        part_size = self.part_size(size)
+        parts = [(i + 1, offset, min(part_size, size - offset)) for i, offset in enumerate(range(0, size, part_size))]
+        state = self._load_state(target, source_file, size, part_size)
+        if state is None:
+            state = {
+                'upload_id': target.initiate(),
+                'source_file': source_file,
+                'size': size,
+                'mtime': os.path.getmtime(source_file),
+                'part_size': part_size,
+                'parts': [],
+                'failures': 0,
+            }
+            self._save_state(target, state)
+        upload_id = state['upload_id']
+        done = set(state['parts'])
+        todo = [part for part in parts if part[0] not in done]
+        if done:
+            log.info("Resuming upload of '%s' to '%s', %d of %d parts already uploaded",
+                     source_file, target.name, len(parts) - len(todo), len(parts))
+        state_lock = threading.Lock()
+
+        def upload_part(part):
+            part_number, offset, length = part
+
+            def send():
+                with open(source_file, 'rb') as fh:
+                    fh.seek(offset)
+                    target.upload_part(upload_id, part_number, fh, length)
+            self._retry("part %d of '%s'" % (part_number, target.name), send)
+            with state_lock:
+                state['parts'].append(part_number)
+                self._save_state(target, state)
+
+        if todo:
+            pool = ThreadPool(min(self.threads, len(todo)))
+            try:
+                pool.map(upload_part, todo)
+            except Exception as e:
+                # Wait for the other parts, they must not record state after it is cleared
+                pool.close()
+                pool.join()
+                state['failures'] = state.get('failures', 0) + 1
+                if self.state_dir is None or state['failures'] > self.resumes:
+                    # Nothing will resume it, release the stored parts
+                    self._abort(target, upload_id)
+                    self._clear_state(target)
+                else:
+                    self._save_state(target, state)
+                raise MultipartUploadError("Multipart upload of '%s' to '%s' failed: %s" % (source_file, target.name, e))
+            finally:
+                pool.close()
+                pool.join()
+        target.complete(upload_id)
+        self._clear_state(target)
+
+    def discard(self, target):
+        """Abort the resumable upload to ``target``, e.g. once the object is deleted."""
+        if self.state_dir is None:
+            return
+        try:
+            with open(self._state_path(target)) as f:
+                upload_id = json.load(f)['upload_id']
+        except (IOError, OSError, ValueError, KeyError):
+            upload_id = None
+        if upload_id is not None:
+            self._abort(target, upload_id)
+        self._clear_state(target)
+
+    def _abort(self, target, upload_id):
+        try:
+            target.abort(upload_id)
+        except Exception:
+            log.exception("Could not abort multipart upload to '%s'", target.name)
+
+    def _state_path(self, target):
+        return os.path.join(self.state_dir, "%s.json" % hashlib.sha1(smart_str(target.name)).hexdigest())
+
+    def _load_state(self, target, source_file, size, part_size):
+        if self.state_dir is None:
+            return None
+        state_path = self._state_path(target)
+        if not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            log.warning("Ignoring corrupt multipart upload state '%s'", state_path)
+            return None
+        unchanged = (state.get('source_file') == source_file and state.get('size') == size and
+                     state.get('mtime') == os.path.getmtime(source_file) and state.get('part_size') == part_size)
+        if not unchanged:
+            self._abort(target, state['upload_id'])
+            return None
+        try:
+            # Only trust parts the backend actually has
+            stored = set(target.uploaded_parts(state['upload_id']))
+        except Exception:
+            log.warning("Cannot resume multipart upload to '%s', starting over", target.name, exc_info=True)
+            self._abort(target, state['upload_id'])
+            return None
+        state['parts'] = [p for p in state['parts'] if p in stored]
+        return state
+
+    def _save_state(self, target, state):
+        if self.state_dir is None:
+            return
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+        state_path = self._state_path(target)
+        temp_path = "%s.%s" % (state_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(temp_path, state_path)
+
+    def _clear_state(self, target):
+        if self.state_dir is None:
+            return
+        state_path = self._state_path(target)
+        if os.path.exists(state_path):
+            os.remove(state_path)
@@ -2,12 +2,17 @@
 Dependency management for tools.
 """
 
+import copy
 import json
 import logging
 import os.path
 import shutil
+import threading
+import time
 from collections import OrderedDict
 
+from six import string_types
+
 from galaxy.util import (
     hash_util,
     plugin_config
@@ -32,6 +37,12 @@ log = logging.getLogger(__name__)
 
 CONFIG_VAL_NOT_FOUND = object()
 
+# Seconds a requirements resolution is reused for, 0 disables the cache
+DEFAULT_RESOLUTION_CACHE_TTL = 60
+MAX_RESOLUTION_CACHE_SIZE = 10000
+# Keyword arguments that do not change what resolvers return
+UNCACHED_RESOLUTION_KWDS = ("job_directory", "tool_instance")
+
 
 def build_dependency_manager(config):
     if getattr(config, "use_tool_dependencies", False):
@@ -77,12 +88,34 @@ class DependencyManager(object):
         self.dependency_resolvers = self.__build_dependency_resolvers(conf_file)
         self._enabled_container_types = []
         self._destination_for_container_type = {}
+        self._init_resolution_cache(self.get_app_option("dependency_resolution_cache_ttl", DEFAULT_RESOLUTION_CACHE_TTL))
+
+    def _init_resolution_cache(self, ttl):
+        self.resolution_cache_ttl = float(ttl or 0)
+        self._resolution_cache = {}
+        self._resolution_cache_lock = threading.Lock()
+        self._resolution_cache_stats = dict(hits=0, misses=0, uncacheable=0, invalidations=0)
+
+    def invalidate_resolution_cache(self):
+        """Forget cached resolutions, e.g. after dependencies were (un)installed."""
+        with self._resolution_cache_lock:
+            self._resolution_cache.clear()
+            self._resolution_cache_stats["invalidations"] += 1
+
+    def resolution_cache_stats(self):
+        """Return hit, miss and size counters of the resolution cache."""
+        with self._resolution_cache_lock:
+            stats = dict(self._resolution_cache_stats)
+            stats["size"] = len(self._resolution_cache)
+        stats["ttl"] = self.resolution_cache_ttl
+        return stats
 
     def set_enabled_container_types(self, container_types_to_destinations):
         """Set the union of all enabled container types."""
         self._enabled_container_types = [container_type for container_type in container_types_to_destinations.keys()]
         # Just pick first enabled destination for a container type, probably covers the most common deployment scenarios
         self._destination_for_container_type = container_types_to_destinations
+        self.invalidate_resolution_cache()
 
     def get_destination_info_for_container_type(self, container_type, destination_id=None):
         if destination_id is None:
@@ -140,7 +173,76 @@ class DependencyManager(object):
         return requirement_to_dependency
 
     def _requirements_to_dependencies_dict(self, requirements, search=False, **kwds):
-        """Build simple requirements to dependencies dict for resolution."""
+        """Build simple requirements to dependencies dict for resolution.
+
+        Resolutions are cached for ``resolution_cache_ttl`` seconds, keyed on
+        the requirements and on everything else resolvers depend on. Calls
+        that may install dependencies bypass the cache and invalidate it.
+        Each call gets its own copies of cached dependencies, with paths in
+        the ``job_directory`` of the cached call moved to its own.
+        """
+        key = self._resolution_cache_key(requirements, search, kwds)
+        if key is None:
+            if kwds.get('install'):
+                try:
+                    return self._resolve_requirements(requirements, search=search, **kwds)
+                finally:
+                    self.invalidate_resolution_cache()
+            with self._resolution_cache_lock:
+                self._resolution_cache_stats["uncacheable"] += 1
+            return self._resolve_requirements(requirements, search=search, **kwds)
+        job_directory = kwds.get('job_directory')
+        now = time.time()
+        with self._resolution_cache_lock:
+            entry = self._resolution_cache.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._resolution_cache[key]
+                entry = None
+            self._resolution_cache_stats["hits" if entry is not None else "misses"] += 1
+        if entry is None:
+            requirement_to_dependency = self._resolve_requirements(requirements, search=search, **kwds)
+            entry = (now + self.resolution_cache_ttl, job_directory, requirement_to_dependency)
+            with self._resolution_cache_lock:
+                if len(self._resolution_cache) >= MAX_RESOLUTION_CACHE_SIZE:
+                    self._resolution_cache = dict((k, v) for k, v in self._resolution_cache.items() if v[0] > now)
+                    if len(self._resolution_cache) >= MAX_RESOLUTION_CACHE_SIZE:
+                        self._resolution_cache.clear()
+                self._resolution_cache[key] = entry
+        _, cached_job_directory, cached = entry
+        copies = {}
+        requirement_to_dependency = OrderedDict()
+        for requirement, dependency in cached.items():
+            if id(dependency) not in copies:
+                copies[id(dependency)] = _copy_dependency(dependency, cached_job_directory, job_directory)
+            requirement_to_dependency[requirement] = copies[id(dependency)]
+        return requirement_to_dependency
+
+    def _resolution_cache_key(self, requirements, search, kwds):
+        """Return the resolution cache key for a call, None if it must not be cached."""
+        if self.resolution_cache_ttl <= 0 or kwds.get('install') or not hasattr(requirements, "resolvable"):
+            return None
+        options = []
+        for name, value in sorted(kwds.items(), key=lambda item: item[0]):
+            if name in UNCACHED_RESOLUTION_KWDS:
+                continue
+            if isinstance(value, list):
+                # e.g. installed_tool_dependencies, compared by identity
+                value = tuple(value)
+            options.append((name, value))
+        key = (
+            tuple(requirements.resolvable),
+            tuple(self.enabled_container_types),
+            bool(search),
+            bool(kwds.get('job_directory')),
+            tuple(options),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _resolve_requirements(self, requirements, search=False, **kwds):
         requirement_to_dependency = OrderedDict()
         index = kwds.get('index')
         install = kwds.get('install', False)
@@ -261,6 +363,17 @@ class DependencyManager(object):
         return plugin_config.plugins_dict(galaxy.tools.deps.resolvers, 'resolver_type')
 
 
+def _copy_dependency(dependency, from_directory=None, to_directory=None):
+    """Return a shallow copy of ``dependency`` with paths under ``from_directory`` moved to ``to_directory``."""
+    dependency = copy.copy(dependency)
+    if from_directory and to_directory and from_directory != to_directory:
+        prefix = os.path.join(from_directory, "")
+        for name, value in vars(dependency).items():
+            if isinstance(value, string_types) and (value == from_directory or value.startswith(prefix)):
+                setattr(dependency, name, to_directory + value[len(from_directory):])
+    return dependency
+
+
 class CachedDependencyManager(DependencyManager):
     def __init__(self, default_base_path, conf_file=None, app_config={}, tool_dependency_cache_dir=None):
         super(CachedDependencyManager, self).__init__(default_base_path=default_base_path, conf_file=conf_file, app_config=app_config)
@@ -329,6 +442,7 @@ class NullDependencyManager(DependencyManager):
         self.dependency_resolvers = []
         self._enabled_container_types = []
         self._destination_for_container_type = {}
+        self._init_resolution_cache(0)
 
     def uses_tool_shed_dependencies(self):
         return False
@@ -0,0 +1,319 @@
+"""
+Parsed and locally cached conda channel indexes.
+
+``conda search`` loads and prints the whole index of the searched
+channels for every call. A ``CondaChannelIndex`` fetches the
+``repodata.json`` of each channel once, keeps a compact copy of it on disk
+for a configurable time (per channel) and answers package lookups from
+memory.
+"""
+import errno
+import json
+import logging
+import os
+import platform
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+import packaging.version
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urljoin
+from six.moves.urllib.request import (
+    pathname2url,
+    Request,
+    urlopen
+)
+
+from galaxy.util import (
+    smart_str,
+    unicodify
+)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL_ALIAS = "https://conda.anaconda.org/"
+# Channels the "defaults" channel stands for
+DEFAULT_CHANNELS = [
+    "https://repo.anaconda.com/pkgs/main",
+    "https://repo.anaconda.com/pkgs/free",
+    "https://repo.anaconda.com/pkgs/r",
+]
+# Seconds a cached channel index is used before it is fetched again
+DEFAULT_INDEX_TTL = 3600
+# Seconds before a channel that could not be loaded is tried again
+FAILED_LOAD_RETRY = 60
+DEFAULT_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), "galaxy-conda-index")
+# Machines conda names subdirs after, others are named after their word size
+NON_X86_MACHINES = frozenset(["armv6l", "armv7l", "aarch64", "arm64", "ppc64", "ppc64le", "s390x"])
+FETCH_TIMEOUT = 60
+UNSAFE_FILENAME_CHARACTERS = re.compile(r"[^\w.-]")
+
+CondaPackageRecord = namedtuple("CondaPackageRecord", ["name", "version", "build", "build_number", "channel"])
+
+
+def platform_subdir(system=None, machine=None):
+    """Return the conda subdir of packages built for this platform, e.g. ``linux-64`` or ``osx-arm64``."""
+    system = system or sys.platform
+    machine = (machine or platform.machine()).lower()
+    if system.startswith("linux"):
+        system = "linux"
+    elif system == "darwin":
+        system = "osx"
+    elif system.startswith("win"):
+        system = "win"
+    if system == "linux" and machine == "arm64":
+        machine = "aarch64"
+    if machine in NON_X86_MACHINES:
+        return "%s-%s" % (system, machine)
+    return "%s-%d" % (system, 8 * struct.calcsize("P"))
+
+
+PLATFORM_SUBDIR = platform_subdir()
+DEFAULT_SUBDIRS = (PLATFORM_SUBDIR, "noarch")
+
+
+class CondaChannelIndex(object):
+    """Package records of conda channels, indexed by package name.
+
+    ``channels`` are channel names (resolved against ``channel_alias``,
+    ``defaults`` standing for ``DEFAULT_CHANNELS``), URLs or local
+    directories, in priority order. File URLs and local
+    directories, e.g. a mirror, are read even if ``offline`` is set, other
+    channels are then only read from the cache in ``cache_directory``. A
+    cached index older than its channel's TTL (``channel_ttls`` or ``ttl``)
+    is fetched again; the stale copy is kept if that fails. Channels that
+    could neither be fetched nor read from the cache are tried again after
+    ``FAILED_LOAD_RETRY`` seconds, ``loaded`` tells whether all channels are
+    available.
+
+    Records of a package are sorted newest first (by version, then build
+    number) once, when the package is first looked up.
+    """
+
+    def __init__(self, channels, cache_directory=DEFAULT_CACHE_DIRECTORY, ttl=DEFAULT_INDEX_TTL, channel_ttls=None,
+                 offline=False, channel_alias=DEFAULT_CHANNEL_ALIAS, subdirs=DEFAULT_SUBDIRS):
+        self.channels = []
+        for channel in channels:
+            self.channels.extend(DEFAULT_CHANNELS if channel == "defaults" else [channel])
+        self.cache_directory = cache_directory
+        self.ttl = ttl
+        self.channel_ttls = channel_ttls or {}
+        self.offline = offline
+        self.channel_alias = channel_alias.rstrip("/") + "/"
+        self.subdirs = subdirs
+        self._lock = threading.Lock()
+        # Maps channels to (load time, {package name: [(version, build, build_number), ...]})
+        self._channel_packages = {}
+        # Maps channels that could not be loaded to the time of the failure
+        self._failed_channels = {}
+        # Maps package names to their sorted CondaPackageRecords
+        self._records = {}
+
+    @classmethod
+    def from_repodata(cls, path, channel=None):
+        """Return an index of a single ``repodata.json`` file, which is never refreshed."""
+        index = cls([], cache_directory=None)
+        channel = channel or path
+        with open(path) as f:
+            index._set_channel_packages(channel, _compact_repodata(json.load(f)), loaded_at=float("inf"))
+        return index
+
+    def get(self, name, default=None):
+        """Return the records of package ``name`` as ``conda search --json`` like dicts, newest first."""
+        records = self.records(name)
+        if not records:
+            return default
+        return [record._asdict() for record in records]
+
+    def records(self, name):
+        """Return the CondaPackageRecords of package ``name``, newest first."""
+        self._refresh_expired()
+        records = self._records.get(name)
+        if records is None:
+            records = []
+            for channel in self.channels:
+                packages = self._channel_packages.get(channel, (None, {}))[1]
+                records.extend(CondaPackageRecord(name, version, build, build_number, channel)
+                               for version, build, build_number in packages.get(name, ()))
+            records.sort(key=_record_sort_key, reverse=True)
+            self._records[name] = records
+        return records
+
+    def versions(self, name):
+        """Return the distinct versions of package ``name``, newest first."""
+        versions = []
+        for record in self.records(name):
+            if not versions or versions[-1] != record.version:
+                versions.append(record.version)
+        return versions
+
+    def search(self, pattern):
+        """Return the sorted names of packages matching regular expression ``pattern``."""
+        self._refresh_expired()
+        regex = re.compile(pattern)
+        names = set()
+        for channel in self.channels:
+            packages = self._channel_packages.get(channel, (None, {}))[1]
+            names.update(name for name in packages if regex.search(name))
+        return sorted(names)
+
+    def __contains__(self, name):
+        return bool(self.records(name))
+
+    def loaded(self):
+        """Return whether the packages of all channels are known."""
+        self._refresh_expired()
+        return all(channel in self._channel_packages for channel in self.channels)
+
+    def refresh(self, channel=None):
+        """Fetch the index of ``channel`` (or of all channels) again."""
+        with self._lock:
+            for refreshed in [channel] if channel else self.channels:
+                self._load_channel(refreshed, force=True)
+
+    def _refresh_expired(self):
+        now = time.time()
+        expired = [c for c in self.channels if self._expired(c, now)]
+        if expired:
+            with self._lock:
+                for channel in expired:
+                    self._load_channel(channel)
+
+    def _ttl(self, channel):
+        return self.channel_ttls.get(channel, self.ttl)
+
+    def _expired(self, channel, now):
+        if self._failed_channels.get(channel, -FAILED_LOAD_RETRY) + FAILED_LOAD_RETRY > now:
+            return False
+        loaded_at = self._channel_packages.get(channel, (None, None))[0]
+        return loaded_at is None or loaded_at + self._ttl(channel) <= now
+
+    def _load_channel(self, channel, force=False):
+        if not force and not self._expired(channel, time.time()):
+            # Loaded (or failed) in another thread
+            return
+        packages = {}
+        for subdir in self.subdirs:
+            subdir_packages = self._load_subdir(channel, subdir, force=force)
+            if subdir_packages is None:
+                # Not recorded as loaded, a stale in-memory copy is kept
+                self._failed_channels[channel] = time.time()
+                return
+            for name, records in subdir_packages.items():
+                packages.setdefault(name, []).extend(records)
+        self._failed_channels.pop(channel, None)
+        self._set_channel_packages(channel, packages, loaded_at=time.time())
+
+    def _set_channel_packages(self, channel, packages, loaded_at):
+        if channel not in self.channels:
+            self.channels.append(channel)
+        self._channel_packages[channel] = (loaded_at, packages)
+        self._records = {}
+
+    def _load_subdir(self, channel, subdir, force=False):
+        url = urljoin(self._channel_url(channel), "%s/repodata.json" % subdir)
+        cache_path = self._cache_path(channel, subdir)
+        cached_at = None
+        if cache_path and os.path.exists(cache_path):
+            cached_at = os.path.getmtime(cache_path)
+        if self.offline and not url.startswith("file:"):
+            if cached_at is None:
+                log.warning("Conda channel index '%s' is not cached and cannot be fetched offline", url)
+                return None
+            return _read_json(cache_path)
+        if not force and cached_at is not None and cached_at + self._ttl(channel) > time.time():
+            return _read_json(cache_path)
+        try:
+            packages = _compact_repodata(json.loads(unicodify(_fetch(url))))
+        except Exception as e:
+            if _is_missing(e):
+                # Channels need not provide every subdir, e.g. noarch
+                packages = {}
+            elif cached_at is not None:
+                log.warning("Failed to fetch conda channel index '%s' (%s), using cached copy", url, e)
+                return _read_json(cache_path)
+            else:
+                log.warning("Failed to fetch conda channel index '%s': %s", url, e)
+                return None
+        if cache_path:
+            _write_json(cache_path, packages)
+        return packages
+
+    def _channel_url(self, channel):
+        if "://" in channel:
+            url = channel
+        elif os.path.isabs(channel) or os.path.isdir(channel):
+            url = urljoin("file:", pathname2url(os.path.abspath(channel)))
+        else:
+            url = urljoin(self.channel_alias, channel)
+        return url.rstrip("/") + "/"
+
+    def _cache_path(self, channel, subdir):
+        if not self.cache_directory:
+            return None
+        channel_directory = UNSAFE_FILENAME_CHARACTERS.sub("_", channel.strip("/"))
+        return os.path.join(self.cache_directory, channel_directory, "%s.json" % subdir)
+
+
+def _compact_repodata(repodata):
+    """Map package names to (version, build, build_number) lists."""
+    packages = {}
+    for key in ("packages", "packages.conda"):
+        for record in (repodata.get(key) or {}).values():
+            packages.setdefault(record["name"], []).append((record["version"], record["build"], record.get("build_number", 0)))
+    return packages
+
+
+def _record_sort_key(record):
+    try:
+        return (1, packaging.version.parse(record.version), record.build_number)
+    except packaging.version.InvalidVersion:
+        # Sorted before all versions packaging understands
+        return (0, record.version, record.build_number)
+
+
+def _fetch(url):
+    response = urlopen(Request(url, headers={"Accept-Encoding": "gzip"}), timeout=FETCH_TIMEOUT)
+    try:
+        data = response.read()
+        if response.info().get("Content-Encoding") == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+    finally:
+        response.close()
+
+
+def _is_missing(e):
+    """Whether fetching failed because there is no such file, rather than e.g. a network error."""
+    if isinstance(e, HTTPError):
+        return e.code == 404
+    reason = getattr(e, "reason", e)
+    return getattr(reason, "errno", None) == errno.ENOENT
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, packages):
+    """Atomically write ``packages`` to ``path``, failures only disable the cache."""
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".repodata")
+        with os.fdopen(fd, "wb") as f:
+            f.write(smart_str(json.dumps(packages)))
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.warning("Failed to cache conda channel index in '%s': %s", path, e)
+
+
+__all__ = ('CondaChannelIndex', 'CondaPackageRecord', 'platform_subdir')
@@ -1,3 +1,5 @@
+import errno
+import fcntl
 import functools
 import hashlib
 import json
@@ -7,9 +9,13 @@ import re
 import shutil
 import sys
 import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import packaging.version
 import six
+import yaml
 from six.moves import shlex_quote
 
 from galaxy.tools.deps.commands import CommandLineException
@@ -21,6 +27,11 @@ from . import (
     commands,
     installable
 )
+from .conda_index import (
+    CondaChannelIndex,
+    DEFAULT_CHANNEL_ALIAS,
+    DEFAULT_INDEX_TTL
+)
 
 log = logging.getLogger(__name__)
 
@@ -38,6 +49,12 @@ USE_PATH_EXEC_DEFAULT = False
 CONDA_VERSION = "4.3.33"
 CONDA_BUILD_VERSION = "2.1.18"
 USE_LOCAL_DEFAULT = False
+# Default location of CondaEnvironmentPool environments, relative to the conda prefix
+DEFAULT_ENVIRONMENT_POOL_DIRECTORY = "envs_pool"
+# Number of environments CondaInstallPlanner creates at the same time
+DEFAULT_INSTALL_WORKERS = 4
+# Location of CondaChannelIndex caches, relative to the conda prefix
+DEFAULT_CHANNEL_INDEX_DIRECTORY = "galaxy_channel_index"
 
 
 def conda_link():
@@ -78,7 +95,8 @@ class CondaContext(installable.InstallableContext):
     def __init__(self, conda_prefix=None, conda_exec=None,
                  shell_exec=None, debug=False, ensure_channels='',
                  condarc_override=None, use_path_exec=USE_PATH_EXEC_DEFAULT,
-                 copy_dependencies=False, use_local=USE_LOCAL_DEFAULT):
+                 copy_dependencies=False, use_local=USE_LOCAL_DEFAULT,
+                 use_channel_index=False, channel_index_ttl=DEFAULT_INDEX_TTL):
         self.condarc_override = condarc_override
         if not conda_exec and use_path_exec:
             conda_exec = commands.which("conda")
@@ -109,6 +127,10 @@ class CondaContext(installable.InstallableContext):
         self._miniconda_version = None
         self._conda_build_available = None
         self.use_local = use_local
+        self.use_channel_index = use_channel_index
+        self.channel_index_ttl = channel_index_ttl
+        self._channel_indexes = {}
+        self._channel_alias = None
 
     @property
     def conda_version(self):
@@ -153,6 +175,44 @@ class CondaContext(installable.InstallableContext):
     def _conda_meta_path(self):
         return os.path.join(self.conda_prefix, "conda-meta")
 
+    def channel_index(self, channels_override=None, offline=False):
+        """Return a CondaChannelIndex of the channels searched by this context.
+
+        Return ``None`` if the index is disabled, if these channels are not
+        known, i.e. if no channels are configured or local builds are used, or
+        if some of them could not be loaded, ``conda search`` is used then.
+        """
+        channels = channels_override or self.ensure_channels
+        if not self.use_channel_index or not channels or (self.use_local and not channels_override) or not self.channel_index_ttl:
+            return None
+        key = (tuple(channels), offline)
+        if key not in self._channel_indexes:
+            self._channel_indexes[key] = CondaChannelIndex(
+                channels,
+                cache_directory=os.path.join(self.conda_prefix, DEFAULT_CHANNEL_INDEX_DIRECTORY),
+                ttl=self.channel_index_ttl,
+                offline=offline,
+                channel_alias=self.channel_alias,
+            )
+        index = self._channel_indexes[key]
+        if not index.loaded():
+            return None
+        return index
+
+    @property
+    def channel_alias(self):
+        """The URL channel names are resolved against, as set in ``condarc_override``."""
+        if self._channel_alias is None:
+            channel_alias = None
+            if self.condarc_override and os.path.exists(self.condarc_override):
+                try:
+                    with open(self.condarc_override) as f:
+                        channel_alias = (yaml.safe_load(f) or {}).get("channel_alias")
+                except (IOError, OSError, AttributeError, yaml.YAMLError) as e:
+                    log.warning("Failed to read channel_alias from '%s': %s", self.condarc_override, e)
+            self._channel_alias = channel_alias or DEFAULT_CHANNEL_ALIAS
+        return self._channel_alias
+
     @property
     def _override_channels_args(self):
         override_channels_args = []
@@ -471,6 +531,101 @@ def install_conda_targets(conda_targets, conda_context, env_name=None, allow_loc
         return conda_context.exec_install([t.package_specifier for t in conda_targets], allow_local=allow_local)
 
 
+class CondaInstallPlan(object):
+    """Conda environments to install, as computed by ``CondaInstallPlanner.plan``."""
+
+    def __init__(self):
+        # Environment names mapped to the CondaTargets to install into them
+        self.environments = OrderedDict()
+        # Names of environments that are already installed
+        self.installed = []
+        # Environment names mapped to their CondaTargets missing from the channels
+        self.unavailable = OrderedDict()
+        self.use_index_cache = False
+
+
+class CondaInstallPlanner(object):
+    """Install many conda environments, e.g. for all tools of a toolbox.
+
+    ``plan`` skips installed environments and, using a single load of the
+    channels' package index, environments with packages the channels do
+    not provide. ``install`` creates the remaining environments with a pool
+    of ``workers`` concurrent ``conda create`` processes. These share the
+    package cache of the conda installation and, if ``plan`` ran
+    ``conda search``, reuse the index it loaded instead of fetching it
+    again. ``progress_callback`` is called with the number of completed and
+    total environments, the environment name and whether it was installed
+    successfully, after each environment.
+    """
+
+    def __init__(self, conda_context, workers=DEFAULT_INSTALL_WORKERS, progress_callback=None):
+        self.conda_context = conda_context
+        self.workers = workers
+        self.progress_callback = progress_callback
+
+    def plan(self, environments, index=None):
+        """Plan the installation of ``environments``, a dict mapping environment names to lists of CondaTargets."""
+        plan = CondaInstallPlan()
+        missing = OrderedDict()
+        for env, conda_targets in environments.items():
+            if self.conda_context.has_env(env):
+                plan.installed.append(env)
+            else:
+                missing[env] = conda_targets
+        if missing and index is None:
+            index = conda_search_index(self.conda_context)
+        for env, conda_targets in missing.items():
+            unavailable = [] if index is None else [t for t in conda_targets if not is_search_hit_available(t, index.get(t.package, []))]
+            if unavailable:
+                plan.unavailable[env] = unavailable
+            else:
+                plan.environments[env] = conda_targets
+        # Only conda search refreshes the repodata cache conda create can reuse
+        plan.use_index_cache = index is not None and not isinstance(index, CondaChannelIndex)
+        log.info("Planned conda install of %d environments, %d already installed, %d unavailable",
+                 len(plan.environments), len(plan.installed), len(plan.unavailable))
+        return plan
+
+    def install(self, plan):
+        """Install the environments of ``plan``.
+
+        Return a dict mapping all environment names of the plan to whether
+        they are installed.
+        """
+        results = OrderedDict((env, True) for env in plan.installed)
+        results.update((env, False) for env in plan.unavailable)
+        total = len(plan.environments)
+        if not total:
+            return results
+
+        def install_environment(item):
+            env, conda_targets = item
+            return env, self._install_environment(env, conda_targets, use_index_cache=plan.use_index_cache)
+
+        pool = ThreadPool(max(min(self.workers, total), 1))
+        try:
+            for done, (env, success) in enumerate(pool.imap_unordered(install_environment, plan.environments.items()), 1):
+                results[env] = success
+                log.info("Conda environment '%s' %s (%d/%d)", env, "installed" if success else "failed to install", done, total)
+                if self.progress_callback is not None:
+                    self.progress_callback(done, total, env, success)
+        finally:
+            pool.terminate()
+        return results
+
+    def _install_environment(self, env, conda_targets, use_index_cache=False):
+        create_args = ["--name", env]
+        if use_index_cache:
+            create_args.append("--use-index-cache")
+        create_args.extend(conda_target.package_specifier for conda_target in conda_targets)
+        exit_code = self.conda_context.exec_create(create_args)
+        is_installed = exit_code == 0 and self.conda_context.has_env(env)
+        if not is_installed:
+            log.debug("Removing failed conda install of %s", conda_targets)
+            cleanup_failed_install_of_environment(env, conda_context=self.conda_context)
+        return is_installed
+
+
 def install_conda_target(conda_target, conda_context, skip_environment=False):
     """
     Install specified target into a its own environment.
@@ -496,29 +651,34 @@ def cleanup_failed_install(conda_target, conda_context=None):
     cleanup_failed_install_of_environment(conda_target.install_environment, conda_context=conda_context)
 
 
-def best_search_result(conda_target, conda_context, channels_override=None, offline=False):
+def best_search_result(conda_target, conda_context, channels_override=None, offline=False, index=None):
     """Find best "conda search" result for specified target.
 
+    If ``index`` (see ``conda_search_index``) is given or the channels of
+    ``conda_context`` have a channel index, it is searched instead of
+    running ``conda search``.
+
     Return ``None`` if no results match.
     """
-    search_cmd = [conda_context.conda_exec, "search", "--full-name", "--json"]
-    if offline:
-        search_cmd.append("--offline")
-    if channels_override:
-        search_cmd.append("--override-channels")
-        for channel in channels_override:
-            search_cmd.extend(["--channel", channel])
+    if index is None and conda_context is not None:
+        index = conda_context.channel_index(channels_override=channels_override, offline=offline)
+    if isinstance(index, CondaChannelIndex):
+        # Already sorted, newest first
+        hits = index.get(conda_target.package, [])
+    elif index is not None:
+        hits = index.get(conda_target.package, [])
+        hits = sorted(hits, key=lambda hit: packaging.version.parse(hit['version']), reverse=True)
     else:
-        search_cmd.extend(conda_context._override_channels_args)
-    search_cmd.append(conda_target.package)
-    try:
-        res = commands.execute(search_cmd)
-        res = unicodify(res)
-        hits = json.loads(res).get(conda_target.package, [])
+        search_cmd = _conda_search_command(conda_context, channels_override=channels_override, offline=offline)
+        search_cmd.append(conda_target.package)
+        try:
+            res = commands.execute(search_cmd)
+            res = unicodify(res)
+            hits = json.loads(res).get(conda_target.package, [])
+        except CommandLineException:
+            log.error("Could not execute: '%s'", search_cmd)
+            hits = []
         hits = sorted(hits, key=lambda hit: packaging.version.parse(hit['version']), reverse=True)
-    except CommandLineException:
-        log.error("Could not execute: '%s'", search_cmd)
-        hits = []
 
     if len(hits) == 0:
         return (None, None)
@@ -533,6 +693,49 @@ def best_search_result(conda_target, conda_context, channels_override=None, offl
     return best_result
 
 
+def conda_search_index(conda_context, channels_override=None, offline=False):
+    """Return the packages of all channels.
+
+    This is the channel index of ``conda_context`` if it has one, otherwise
+    packages are loaded with a single ``conda search``. The result maps
+    package names to their ``conda search --json`` hits, it is ``None`` if
+    the search failed.
+    """
+    index = conda_context.channel_index(channels_override=channels_override, offline=offline)
+    if index is not None:
+        return index
+    search_cmd = _conda_search_command(conda_context, channels_override=channels_override, offline=offline, full_name=False)
+    try:
+        return json.loads(unicodify(commands.execute(search_cmd)))
+    except (CommandLineException, ValueError):
+        log.error("Could not load conda package index with: '%s'", search_cmd)
+        return None
+
+
+def _conda_search_command(conda_context, channels_override=None, offline=False, full_name=True):
+    search_cmd = [conda_context.conda_exec, "search", "--json"]
+    if full_name:
+        search_cmd.append("--full-name")
+    if offline:
+        search_cmd.append("--offline")
+    if channels_override:
+        search_cmd.append("--override-channels")
+        for channel in channels_override:
+            search_cmd.extend(["--channel", channel])
+    else:
+        search_cmd.extend(conda_context._override_channels_args)
+    return search_cmd
+
+
+def is_search_hit_available(conda_target, search_hits):
+    """Return whether ``conda create`` may find ``conda_target`` among ``search_hits``."""
+    if not conda_target.version:
+        return bool(search_hits)
+    # "=1.0" also matches version 1.0.3
+    version_prefix = conda_target.version + "."
+    return any(hit['version'] == conda_target.version or hit['version'].startswith(version_prefix) for hit in search_hits)
+
+
 def is_search_hit_exact(conda_target, search_hit):
     target_version = conda_target.version
     # It'd be nice to make request verson of 1.0 match available
@@ -622,6 +825,145 @@ def build_isolated_environment(
             shutil.rmtree(tempdir)
 
 
+class CondaEnvironmentPool(object):
+    """Share job environments of identical conda packages between jobs.
+
+    ``build_isolated_environment`` creates a new environment for every job.
+    The pool builds each environment once under ``path``, in a directory
+    named after a digest of ``hash_conda_packages``, of the packages
+    installed in the source environments and of the ``copy`` option.
+    Jobs are given a symlink to the pooled environment. Conda environments
+    hold absolute paths to their prefix, so they are built in place rather
+    than moved or cloned there.
+
+    Builds and reference changes of an environment hold an exclusive lock
+    on ``<digest>.lock``, concurrent requests for the same environment (in
+    any process) wait for a single build. Every job link is recorded in
+    ``<digest>.refs``, ``prune`` removes environments no job link points to
+    anymore.
+    """
+
+    def __init__(self, path, conda_context):
+        self.path = os.path.abspath(path)
+        self.conda_context = conda_context
+
+    def environment_key(self, conda_packages, copy=False):
+        h = hashlib.new('sha256')
+        h.update(smart_str(hash_conda_packages(conda_packages)))
+        for conda_package in conda_packages:
+            conda_meta = os.path.join(self.conda_context.env_path(conda_package.install_environment), "conda-meta")
+            installed = sorted(os.listdir(conda_meta)) if os.path.isdir(conda_meta) else []
+            h.update(smart_str("\n".join(installed)))
+        h.update(smart_str("copy" if copy else "link"))
+        # Keep environment paths short, conda prefixes end up in shebang lines
+        return h.hexdigest()[:16]
+
+    def environment_path(self, key):
+        return os.path.join(self.path, key)
+
+    def acquire(self, conda_packages, reference, copy=False, quiet=False):
+        """Link ``reference`` to the pooled environment for ``conda_packages``.
+
+        The environment is built first if needed. Return the tuple
+        ``(reference, exit_code)`` like ``build_isolated_environment``.
+        """
+        if not isinstance(conda_packages, list):
+            conda_packages = [conda_packages]
+        key = self.environment_key(conda_packages, copy=copy)
+        env_path = self.environment_path(key)
+        with self._lock(key):
+            if not os.path.exists(self._complete_path(key)):
+                if os.path.exists(env_path):
+                    # Left over by an interrupted build
+                    shutil.rmtree(env_path)
+                log.debug("Building pooled conda environment '%s' for %s", env_path, conda_packages)
+                _, exit_code = build_isolated_environment(conda_packages, self.conda_context, path=env_path, copy=copy, quiet=quiet)
+                if exit_code:
+                    shutil.rmtree(env_path, ignore_errors=True)
+                    return (reference, exit_code)
+                open(self._complete_path(key), "w").close()
+            _replace_with_symlink(env_path, reference)
+            refs_path = self._refs_path(key)
+            ref_name = hashlib.sha1(smart_str(os.path.abspath(reference))).hexdigest()
+            _replace_with_symlink(os.path.abspath(reference), os.path.join(refs_path, ref_name))
+        return (reference, 0)
+
+    def reference_count(self, key):
+        """Return the number of job links pointing to environment ``key``."""
+        with self._lock(key):
+            return len(self._live_references(key))
+
+    def prune(self):
+        """Remove environments no job links to anymore, return their keys."""
+        removed = []
+        names = os.listdir(self.path) if os.path.isdir(self.path) else []
+        for name in names:
+            if not os.path.isdir(os.path.join(self.path, name)) or name.endswith(".refs"):
+                continue
+            with self._lock(name):
+                if self._live_references(name):
+                    continue
+                log.debug("Removing unused pooled conda environment '%s'", name)
+                for path in (self._complete_path(name), self._refs_path(name)):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    elif os.path.exists(path):
+                        os.remove(path)
+                shutil.rmtree(self.environment_path(name), ignore_errors=True)
+                removed.append(name)
+        return removed
+
+    def _live_references(self, key):
+        refs_path = self._refs_path(key)
+        env_path = self.environment_path(key)
+        live = []
+        for ref_name in os.listdir(refs_path) if os.path.isdir(refs_path) else []:
+            ref_path = os.path.join(refs_path, ref_name)
+            reference = os.readlink(ref_path)
+            if os.path.islink(reference) and os.readlink(reference) == env_path:
+                live.append(reference)
+            else:
+                # The job directory has been cleaned up
+                os.remove(ref_path)
+        return live
+
+    def _complete_path(self, key):
+        return self.environment_path(key) + ".complete"
+
+    def _refs_path(self, key):
+        return self.environment_path(key) + ".refs"
+
+    @contextmanager
+    def _lock(self, key):
+        _makedirs(self.path)
+        with open(self.environment_path(key) + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _replace_with_symlink(target, path):
+    """Atomically make ``path`` a symlink to ``target``."""
+    if os.path.islink(path) and os.readlink(path) == target:
+        return
+    _makedirs(os.path.dirname(path))
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(target, tmp_path)
+    os.rename(tmp_path, path)
+
+
 def requirement_to_conda_targets(requirement):
     conda_target = None
     if requirement.type == "package":
@@ -637,6 +979,8 @@ def requirements_to_conda_targets(requirements):
 
 __all__ = (
     'CondaContext',
+    'CondaEnvironmentPool',
+    'CondaInstallPlanner',
     'CondaTarget',
     'install_conda',
     'install_conda_target',
@@ -4,6 +4,8 @@ import collections
 import logging
 import os
 import subprocess
+import threading
+import time
 
 import six
 
@@ -37,6 +39,8 @@ from ..requirements import (
 
 log = logging.getLogger(__name__)
 
+# Seconds the list of images cached by Docker is used before being refreshed
+DEFAULT_IMAGE_INVENTORY_TTL = 60
 
 CachedMulledImageSingleTarget = collections.namedtuple("CachedMulledImageSingleTarget", ["package_name", "version", "build", "image_identifier"])
 CachedV1MulledImageMultiTarget = collections.namedtuple("CachedV1MulledImageMultiTarget", ["hash", "build", "image_identifier"])
@@ -110,7 +114,7 @@ def identifier_to_cached_target(identifier, hash_func, namespace=None):
 
         if version and "-" in version:
             version_hash, build = version.rsplit("-", 1)
-        elif version.isdigit():
+        elif version and version.isdigit():
             version_hash, build = None, version
         elif version:
             log.debug("Unparsable mulled image tag encountered [%s]" % version)
@@ -186,12 +190,161 @@ def find_best_matching_cached_image(targets, cached_images, hash_func):
     return image
 
 
-def docker_cached_container_description(targets, namespace, hash_func="v2", shell=DEFAULT_CONTAINER_SHELL):
+class CachedImageIndex(object):
+    """
+    Cached images indexed by package name, v1 hash and v2 package/version
+    hashes. ``find`` returns the image ``find_best_matching_cached_image``
+    would pick among the indexed images, in constant time.
+    """
+
+    def __init__(self, cached_images):
+        self.single_by_package = {}
+        self.single_by_package_version = {}
+        self.v1_by_hash = {}
+        self.v2_by_package_hash = {}
+        self.v2_by_hashes = {}
+        # Keep the first of equivalent images, as a scan of cached_images would
+        for cached_image in cached_images:
+            if not cached_image.multi_target:
+                self.single_by_package.setdefault(cached_image.package_name, cached_image)
+                self.single_by_package_version.setdefault((cached_image.package_name, cached_image.version), cached_image)
+            elif cached_image.multi_target == "v1":
+                self.v1_by_hash.setdefault(cached_image.hash, cached_image)
+            elif cached_image.multi_target == "v2":
+                package_hash = cached_image.package_hash
+                self.v2_by_package_hash.setdefault(package_hash, cached_image)
+                self.v2_by_hashes.setdefault((package_hash, cached_image.version_hash), cached_image)
+
+    def find(self, targets, hash_func):
+        if len(targets) == 0:
+            return None
+        if len(targets) == 1:
+            target = targets[0]
+            if not target.version:
+                return self.single_by_package.get(target.package_name)
+            return self.single_by_package_version.get((target.package_name, target.version))
+        elif hash_func == "v2":
+            name = v2_image_name(targets)
+            if ":" in name:
+                package_hash, version_hash = name.split(":", 2)
+                return self.v2_by_hashes.get((package_hash, version_hash))
+            return self.v2_by_package_hash.get(name)
+        elif hash_func == "v1":
+            return self.v1_by_hash.get(v1_image_name(targets))
+        return None
+
+
+class CachedImageInventory(object):
+    """
+    ``CachedImageIndex`` of the images listed by ``list_images``, shared by
+    the resolvers of a process (see ``docker_image_inventory``).
+
+    Once older than the ``max_age`` given to ``index``, the current index
+    keeps being used while a background thread lists the images again. Call
+    ``invalidate`` after adding or removing images to list them again before
+    the next lookup.
+    """
+
+    def __init__(self, list_images):
+        self._list_images = list_images
+        self._lock = threading.Lock()
+        self._index = None
+        self._refreshed_at = None
+        self._refreshing = False
+        # Incremented by invalidate, listings started before are not kept
+        self._generation = 0
+
+    def index(self, max_age=DEFAULT_IMAGE_INVENTORY_TTL):
+        with self._lock:
+            index = self._index
+            if index is not None and max_age > 0:
+                if time.time() - self._refreshed_at > max_age and not self._refreshing:
+                    self._refreshing = True
+                    thread = threading.Thread(target=self._background_refresh, name="CachedImageInventory.refresh")
+                    thread.daemon = True
+                    thread.start()
+                return index
+        return self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            generation = self._generation
+        index = CachedImageIndex(self._list_images())
+        with self._lock:
+            if generation == self._generation:
+                self._index = index
+                self._refreshed_at = time.time()
+        return index
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._index = None
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            log.exception("Failed to refresh the list of cached container images")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+class CachedImageDirectoryInventory(CachedImageInventory):
+    """
+    ``CachedImageInventory`` of the images stored in a directory, listed
+    again whenever the modification time of the directory changes.
+    """
+
+    # Listings this close to the modification time may miss images added within the same clock tick
+    MTIME_RESOLUTION = 2
+
+    def __init__(self, directory):
+        super(CachedImageDirectoryInventory, self).__init__(lambda: list_cached_mulled_images_from_path(directory, hash_func=None))
+        self.directory = directory
+        self._directory_mtime = None
+
+    def index(self, max_age=None):
+        mtime = os.stat(self.directory).st_mtime
+        with self._lock:
+            if self._index is not None and mtime == self._directory_mtime and self._refreshed_at - mtime > self.MTIME_RESOLUTION:
+                return self._index
+        index = self.refresh()
+        with self._lock:
+            self._directory_mtime = mtime
+        return index
+
+
+_image_inventories = {}
+_image_inventories_lock = threading.Lock()
+
+
+def docker_image_inventory(namespace):
+    """Return the process wide inventory of the mulled images of `namespace` cached by Docker."""
+    return _image_inventory(("docker", namespace),
+                            lambda: CachedImageInventory(lambda: list_docker_cached_mulled_images(namespace, hash_func=None)))
+
+
+def singularity_image_inventory(cache_directory):
+    """Return the process wide inventory of the mulled images in `cache_directory`."""
+    cache_directory = os.path.abspath(cache_directory)
+    return _image_inventory(("singularity", cache_directory), lambda: CachedImageDirectoryInventory(cache_directory))
+
+
+def _image_inventory(key, build_inventory):
+    with _image_inventories_lock:
+        inventory = _image_inventories.get(key)
+        if inventory is None:
+            inventory = _image_inventories[key] = build_inventory()
+        return inventory
+
+
+def docker_cached_container_description(targets, namespace, hash_func="v2", shell=DEFAULT_CONTAINER_SHELL, max_age=DEFAULT_IMAGE_INVENTORY_TTL):
     if len(targets) == 0:
         return None
 
-    cached_images = list_docker_cached_mulled_images(namespace, hash_func=hash_func)
-    image = find_best_matching_cached_image(targets, cached_images, hash_func)
+    image = docker_image_inventory(namespace).index(max_age).find(targets, hash_func)
 
     container = None
     if image:
@@ -211,8 +364,7 @@ def singularity_cached_container_description(targets, cache_directory, hash_func
     if not os.path.exists(cache_directory):
         return None
 
-    cached_images = list_cached_mulled_images_from_path(cache_directory, hash_func=hash_func)
-    image = find_best_matching_cached_image(targets, cached_images, hash_func)
+    image = singularity_image_inventory(cache_directory).index().find(targets, hash_func)
 
     container = None
     if image:
@@ -291,13 +443,15 @@ class CachedMulledDockerContainerResolver(ContainerResolver):
         super(CachedMulledDockerContainerResolver, self).__init__(app_info)
         self.namespace = namespace
         self.hash_func = hash_func
+        self.image_inventory_ttl = _image_inventory_ttl(self, kwds)
 
     def resolve(self, enabled_container_types, tool_info, **kwds):
         if tool_info.requires_galaxy_python_environment or self.container_type not in enabled_container_types:
             return None
 
         targets = mulled_targets(tool_info)
-        return docker_cached_container_description(targets, self.namespace, hash_func=self.hash_func, shell=self.shell)
+        return docker_cached_container_description(targets, self.namespace, hash_func=self.hash_func, shell=self.shell,
+                                                   max_age=self.image_inventory_ttl)
 
     def __str__(self):
         return "CachedMulledDockerContainerResolver[namespace=%s]" % self.namespace
@@ -340,13 +494,17 @@ class MulledDockerContainerResolver(ContainerResolver):
         self.namespace = namespace
         self.hash_func = hash_func
         self.auto_install = string_as_bool(auto_install)
+        self.image_inventory_ttl = _image_inventory_ttl(self, kwds)
 
     def cached_container_description(self, targets, namespace, hash_func):
-        return docker_cached_container_description(targets, namespace, hash_func)
+        return docker_cached_container_description(targets, namespace, hash_func, max_age=self.image_inventory_ttl)
 
     def pull(self, container):
         command = container.build_pull_command()
-        shell(command)
+        try:
+            shell(command)
+        finally:
+            docker_image_inventory(self.namespace).invalidate()
 
     def resolve(self, enabled_container_types, tool_info, install=False, **kwds):
         if tool_info.requires_galaxy_python_environment or self.container_type not in enabled_container_types:
@@ -412,7 +570,10 @@ class MulledSingularityContainerResolver(MulledDockerContainerResolver):
 
     def pull(self, container):
         cmds = container.build_mulled_singularity_pull_command(cache_directory=self.cache_directory, namespace=self.namespace)
-        shell(cmds=cmds)
+        try:
+            shell(cmds=cmds)
+        finally:
+            singularity_image_inventory(self.cache_directory).invalidate()
 
     def __str__(self):
         return "MulledSingularityContainerResolver[namespace=%s]" % self.namespace
@@ -450,11 +611,14 @@ class BuildMulledDockerContainerResolver(ContainerResolver):
         if len(targets) == 0:
             return None
         if self.auto_install or install:
-            mull_targets(
-                targets,
-                involucro_context=self._get_involucro_context(),
-                **self._mulled_kwds
-            )
+            try:
+                mull_targets(
+                    targets,
+                    involucro_context=self._get_involucro_context(),
+                    **self._mulled_kwds
+                )
+            finally:
+                docker_image_inventory(self.namespace).invalidate()
         return docker_cached_container_description(targets, self.namespace, hash_func=self.hash_func, shell=self.shell)
 
     def _get_involucro_context(self):
@@ -500,11 +664,14 @@ class BuildMulledSingularityContainerResolver(ContainerResolver):
             return None
 
         if self.auto_install or install:
-            mull_targets(
-                targets,
-                involucro_context=self._get_involucro_context(),
-                **self._mulled_kwds
-            )
+            try:
+                mull_targets(
+                    targets,
+                    involucro_context=self._get_involucro_context(),
+                    **self._mulled_kwds
+                )
+            finally:
+                singularity_image_inventory(self.cache_directory).invalidate()
         return singularity_cached_container_description(targets, self.cache_directory, hash_func=self.hash_func, shell=self.shell)
 
     def _get_involucro_context(self):
@@ -520,6 +687,11 @@ def mulled_targets(tool_info):
     return requirements_to_mulled_targets(tool_info.requirements)
 
 
+def _image_inventory_ttl(resolver, kwds):
+    default = resolver._get_config_option("mulled_image_inventory_ttl", DEFAULT_IMAGE_INVENTORY_TTL)
+    return float(kwds.get("image_inventory_ttl", default))
+
+
 __all__ = (
     "CachedMulledDockerContainerResolver",
     "CachedMulledSingularityContainerResolver",
@@ -1,5 +1,6 @@
 from galaxy.tools.deps.requirements import ToolRequirements
 from galaxy.util import bunch
+from .container_resolvers.mulled import DEFAULT_IMAGE_INVENTORY_TTL
 from .mulled.mulled_build import DEFAULT_CHANNELS
 
 
@@ -17,6 +18,7 @@ class AppInfo(object):
         involucro_path=None,
         involucro_auto_init=True,
         mulled_channels=DEFAULT_CHANNELS,
+        mulled_image_inventory_ttl=DEFAULT_IMAGE_INVENTORY_TTL,
     ):
         self.galaxy_root_dir = galaxy_root_dir
         self.default_file_path = default_file_path
@@ -29,6 +31,7 @@ class AppInfo(object):
         self.involucro_path = involucro_path
         self.involucro_auto_init = involucro_auto_init
         self.mulled_channels = mulled_channels
+        self.mulled_image_inventory_ttl = mulled_image_inventory_ttl
 
 
 class ToolInfo(object):
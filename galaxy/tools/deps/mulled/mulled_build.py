@@ -10,7 +10,6 @@ Build a mulled image with:
 """
 from __future__ import print_function
 
-import json
 import os
 import shutil
 import string
@@ -37,6 +36,7 @@ from .util import (
     v2_image_name,
 )
 from ..conda_compat import MetaData
+from ..conda_index import CondaChannelIndex
 
 DIRNAME = os.path.dirname(__file__)
 DEFAULT_CHANNELS = ["conda-forge", "bioconda"]
@@ -47,6 +47,8 @@ IS_OS_X = _platform == "darwin"
 INVOLUCRO_VERSION = "1.1.2"
 DEST_BASE_IMAGE = os.environ.get('DEST_BASE_IMAGE', None)
 CONDA_IMAGE = os.environ.get('CONDA_IMAGE', None)
+# Indexes of repodata files, see conda_versions
+_REPODATA_INDEXES = {}
 
 SINGULARITY_TEMPLATE = """Bootstrap: docker
 From: bgruening/busybox-bash:0.1
@@ -125,12 +127,16 @@ def get_affected_packages(args):
 
 def conda_versions(pkg_name, file_name):
     """Return all conda version strings for a specified package name."""
-    j = json.load(open(file_name))
-    ret = list()
-    for pkg in j['packages'].values():
-        if pkg['name'] == pkg_name:
-            ret.append('%s--%s' % (pkg['version'], pkg['build']))
-    return ret
+    return ['%s--%s' % (record.version, record.build) for record in _repodata_index(file_name).records(pkg_name)]
+
+
+def _repodata_index(file_name):
+    """Return the CondaChannelIndex of repodata file ``file_name``, loaded once per modification."""
+    key = (os.path.abspath(file_name), os.path.getmtime(file_name))
+    if key not in _REPODATA_INDEXES:
+        _REPODATA_INDEXES.clear()
+        _REPODATA_INDEXES[key] = CondaChannelIndex.from_repodata(file_name)
+    return _REPODATA_INDEXES[key]
 
 
 class BuildExistsException(Exception):
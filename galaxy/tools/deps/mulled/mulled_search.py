@@ -3,16 +3,14 @@
 import argparse
 import json
 import logging
+import re
 import sys
 import tempfile
 
+from galaxy.tools.deps.conda_index import CondaChannelIndex
 from galaxy.tools.deps.mulled.mulled_list import get_singularity_containers
 from galaxy.tools.deps.mulled.util import build_target, v2_image_name
 
-try:
-    from conda.cli.python_api import run_command
-except ImportError:
-    run_command = None
 try:
     import requests
 except ImportError:
@@ -129,23 +127,22 @@ class CondaSearch():
     True
     """
 
-    def __init__(self, channel):
+    def __init__(self, channel, offline=False):
         self.channel = channel
+        self.index = CondaChannelIndex([channel], offline=offline)
 
     def get_json(self, search_string):
         """
         Function takes search_string variable and returns results from the bioconda channel in JSON format
 
         """
-        raw_out, err, exit_code = run_command(
-            'search', '-c',
-            self.channel,
-            search_string,
-            use_exception_handler=True)
-        if exit_code != 0:
-            logging.info('Search failed with: %s' % err)
-            return []
-        return [{'package': n.split()[0], 'version': n.split()[1], 'build': n.split()[2]} for n in raw_out.split('\n')[2:-1]]
+        results = []
+        for package in self.index.search(re.escape(search_string)):
+            for record in reversed(self.index.records(package)):
+                results.append({'package': package, 'version': record.version, 'build': record.build})
+        if not results:
+            logging.info('Search for %s found no packages in channel %s' % (search_string, self.channel))
+        return results
 
 
 class GitHubSearch():
@@ -340,7 +337,9 @@ def main(argv=None):
     parser.add_argument('-o', '--organization', dest='organization_string', default="biocontainers",
                         help='Change quay organization to search; default is biocontainers.')
     parser.add_argument('-c', '--channel', dest='channel_string', default="bioconda",
-                        help='Change conda channel to search; default is bioconda.')
+                        help='Change conda channel to search; default is bioconda. May be the path of a local mirror.')
+    parser.add_argument('--offline', dest='offline', action="store_true",
+                        help='Search conda channels using cached indexes and local mirrors only.')
     parser.add_argument('--non-strict', dest='non_strict', action="store_true",
                         help='Autocorrection of typos activated. Lists more results but can be confusing.\
                         For too many queries quay.io blocks the request and the results can be incomplete.')
@@ -359,7 +358,7 @@ def main(argv=None):
 
     if 'conda' in args.search_dest:
         conda_results = {}
-        conda = CondaSearch(args.channel_string)
+        conda = CondaSearch(args.channel_string, offline=args.offline)
 
         for item in args.search:
             conda_results[item] = conda.get_json(item)
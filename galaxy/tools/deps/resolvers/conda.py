@@ -6,6 +6,7 @@ incompatible changes coming.
 import logging
 import os
 import re
+from collections import OrderedDict
 
 import galaxy.tools.deps.installable
 import galaxy.tools.deps.requirements
@@ -20,12 +21,17 @@ from . import (
     NullDependency,
     SpecificationPatternDependencyResolver,
 )
+from ..conda_index import DEFAULT_INDEX_TTL
 from ..conda_util import (
     build_isolated_environment,
     cleanup_failed_install,
     cleanup_failed_install_of_environment,
     CondaContext,
+    CondaEnvironmentPool,
+    CondaInstallPlanner,
     CondaTarget,
+    DEFAULT_ENVIRONMENT_POOL_DIRECTORY,
+    DEFAULT_INSTALL_WORKERS,
     hash_conda_packages,
     install_conda,
     install_conda_target,
@@ -76,6 +82,10 @@ class CondaDependencyResolver(DependencyResolver, MultipleDependencyResolver, Li
         'auto_init': True,
         'copy_dependencies': False,
         'use_local': False,
+        'use_environment_pool': False,
+        'environment_pool_path': None,
+        'use_channel_index': False,
+        'channel_index_ttl': DEFAULT_INDEX_TTL,
     }
     _specification_pattern = re.compile(r"https\:\/\/anaconda.org\/\w+\/\w+")
 
@@ -116,6 +126,8 @@ class CondaDependencyResolver(DependencyResolver, MultipleDependencyResolver, Li
             use_path_exec = _string_as_bool(use_path_exec)
         if ensure_channels is None:
             ensure_channels = DEFAULT_ENSURE_CHANNELS
+        use_channel_index = _string_as_bool(get_option("use_channel_index"))
+        channel_index_ttl = int(get_option("channel_index_ttl"))
 
         conda_context = CondaContext(
             conda_prefix=conda_prefix,
@@ -126,6 +138,8 @@ class CondaDependencyResolver(DependencyResolver, MultipleDependencyResolver, Li
             use_path_exec=use_path_exec,
             copy_dependencies=copy_dependencies,
             use_local=use_local,
+            use_channel_index=use_channel_index,
+            channel_index_ttl=channel_index_ttl,
         )
         self.ensure_channels = ensure_channels
 
@@ -138,8 +152,16 @@ class CondaDependencyResolver(DependencyResolver, MultipleDependencyResolver, Li
             self.conda_context.ensure_conda_build_installed_if_needed()
         self.auto_install = auto_install
         self.copy_dependencies = copy_dependencies
+        self.environment_pool = None
+        if _string_as_bool(get_option("use_environment_pool")):
+            environment_pool_path = get_option("environment_pool_path")
+            if environment_pool_path is None:
+                environment_pool_path = os.path.join(conda_prefix, DEFAULT_ENVIRONMENT_POOL_DIRECTORY)
+            self.environment_pool = CondaEnvironmentPool(environment_pool_path, conda_context)
 
     def clean(self, **kwds):
+        if self.environment_pool is not None:
+            self.environment_pool.prune()
         return self.conda_context.exec_clean()
 
     def uninstall(self, requirements):
@@ -202,16 +224,9 @@ class CondaDependencyResolver(DependencyResolver, MultipleDependencyResolver, Li
         if not os.path.isdir(self.conda_context.conda_prefix):
             return []
 
-        for requirement in requirements:
-            if requirement.type != "package":
-                return []
-
-        ToolRequirements = galaxy.tools.deps.requirements.ToolRequirements
-        expanded_requirements = ToolRequirements([self._expand_requirement(r) for r in requirements])
-        if self.versionless:
-            conda_targets = [CondaTarget(r.name, version=None) for r in expanded_requirements]
-        else:
-            conda_targets = [CondaTarget(r.name, version=r.version) for r in expanded_requirements]
+        conda_targets = self._conda_targets(requirements)
+        if not conda_targets:
+            return []
 
         preserve_python_environment = kwds.get("preserve_python_environment", False)
 
@@ -243,6 +258,34 @@ class CondaDependencyResolver(DependencyResolver, MultipleDependencyResolver, Li
 
         return dependencies
 
+    def install_requirements(self, requirements_list, workers=DEFAULT_INSTALL_WORKERS, progress_callback=None):
+        """Install the environments ``resolve_all`` uses for each requirements of ``requirements_list``.
+
+        Environments are planned and installed together by a
+        ``CondaInstallPlanner``. Return a dict mapping environment names to
+        whether they are installed.
+        """
+        environments = OrderedDict()
+        for requirements in requirements_list:
+            conda_targets = self._conda_targets(requirements)
+            if conda_targets:
+                environments[self.merged_environment_name(conda_targets)] = conda_targets
+        planner = CondaInstallPlanner(self.conda_context, workers=workers, progress_callback=progress_callback)
+        return planner.install(planner.plan(environments))
+
+    def _conda_targets(self, requirements):
+        """Return the CondaTargets of ``requirements``, an empty list if some are not conda packages."""
+        for requirement in requirements:
+            if requirement.type != "package":
+                return []
+
+        ToolRequirements = galaxy.tools.deps.requirements.ToolRequirements
+        expanded_requirements = ToolRequirements([self._expand_requirement(r) for r in requirements])
+        if self.versionless:
+            return [CondaTarget(r.name, version=None) for r in expanded_requirements]
+        else:
+            return [CondaTarget(r.name, version=r.version) for r in expanded_requirements]
+
     def merged_environment_name(self, conda_targets):
         if len(conda_targets) > 1:
             # For continuity with mulled containers this is kind of nice.
@@ -305,6 +348,7 @@ class CondaDependencyResolver(DependencyResolver, MultipleDependencyResolver, Li
             name,
             version,
             preserve_python_environment=preserve_python_environment,
+            environment_pool=self.environment_pool if job_directory else None,
         )
 
     def _expand_requirement(self, requirement):
@@ -417,7 +461,7 @@ class CondaDependency(Dependency):
     dependency_type = 'conda'
     cacheable = True
 
-    def __init__(self, conda_context, environment_path, exact, name=None, version=None, preserve_python_environment=False):
+    def __init__(self, conda_context, environment_path, exact, name=None, version=None, preserve_python_environment=False, environment_pool=None):
         self.activate = conda_context.activate
         self.conda_context = conda_context
         self.environment_path = environment_path
@@ -426,6 +470,7 @@ class CondaDependency(Dependency):
         self._version = version
         self.cache_path = None
         self._preserve_python_environment = preserve_python_environment
+        self.environment_pool = environment_pool
 
     @property
     def exact(self):
@@ -448,12 +493,19 @@ class CondaDependency(Dependency):
         self.environment_path = cache_path
 
     def build_environment(self):
-        env_path, exit_code = build_isolated_environment(
-            CondaTarget(self.name, self.version),
-            conda_context=self.conda_context,
-            path=self.environment_path,
-            copy=self.conda_context.copy_dependencies,
-        )
+        if self._use_environment_pool():
+            env_path, exit_code = self.environment_pool.acquire(
+                CondaTarget(self.name, self.version),
+                reference=self.environment_path,
+                copy=self.conda_context.copy_dependencies,
+            )
+        else:
+            env_path, exit_code = build_isolated_environment(
+                CondaTarget(self.name, self.version),
+                conda_context=self.conda_context,
+                path=self.environment_path,
+                copy=self.conda_context.copy_dependencies,
+            )
         if exit_code:
             if len(os.path.abspath(self.environment_path)) > 79:
                 # TODO: remove this once conda_build version 2 is released and packages have been rebuilt.
@@ -462,6 +514,12 @@ class CondaDependency(Dependency):
                                           "You can try to shorten the path to the job_working_directory.")
             raise DependencyException("Conda dependency seemingly installed but failed to build job environment.")
 
+    def _use_environment_pool(self):
+        if self.environment_pool is None or self.cache_path:
+            return False
+        # An environment built in place, e.g. for a previous run of the job, is updated in place
+        return os.path.islink(self.environment_path) or not os.path.exists(self.environment_path)
+
     def shell_commands(self):
         if not self.cache_path:
             # Build an isolated environment if not using a cached dependency manager
@@ -16,8 +16,12 @@ class DependencyResolversView(object):
         return self._dependency_resolver(index).to_dict()
 
     def reload(self):
+        self._dependency_manager.invalidate_resolution_cache()
         self.toolbox.reload_dependency_manager()
 
+    def resolution_cache_stats(self):
+        return self._dependency_manager.resolution_cache_stats()
+
     def manager_requirements(self):
         requirements = []
         for index, resolver in enumerate(self._dependency_resolvers):
@@ -59,6 +63,12 @@ class DependencyResolversView(object):
         requirements = payload.get('requirements')
         if not requirements:
             return None
+        try:
+            return self._uninstall_dependencies(requirements, index=index, resolver_type=resolver_type)
+        finally:
+            self._dependency_manager.invalidate_resolution_cache()
+
+    def _uninstall_dependencies(self, requirements, index=None, resolver_type=None):
         if index:
             resolver = self._dependency_resolvers[index]
             if resolver.can_uninstall_dependencies:
@@ -98,6 +108,7 @@ class DependencyResolversView(object):
                 unused_dependencies = resolver.unused_dependency_paths(toolbox_requirements_status)
                 can_remove = envs_to_remove & set(unused_dependencies)
                 exit_code = resolver.uninstall_environments(can_remove)
+                self._dependency_manager.invalidate_resolution_cache()
                 if exit_code == 0:
                     removed_environments = removed_environments.union(can_remove)
                     envs_to_remove = envs_to_remove.difference(can_remove)
@@ -107,6 +118,32 @@ class DependencyResolversView(object):
         kwds['install'] = True
         return self._dependency_manager._requirements_to_dependencies_dict(requirements, **kwds)
 
+    def install_toolbox_dependencies(self, index=None, tool_ids=None, workers=None, progress_callback=None):
+        """
+        Install the requirements of all tools (or of the tools in ``tool_ids``) at once, using the
+        highest priority resolver that supports it (currently only the conda resolver) or the resolver
+        at ``index``. Environments are installed by a pool of ``workers`` concurrent installs.
+        Returns a dictionary mapping environment names to whether they are installed.
+        """
+        if index is not None:
+            resolvers = [self._dependency_resolver(index)]
+        else:
+            resolvers = [self._dependency_resolvers[i] for i in self.installable_resolvers]
+        resolvers = [resolver for resolver in resolvers if hasattr(resolver, "install_requirements")]
+        if not resolvers:
+            raise exceptions.NotImplemented()
+        if tool_ids is not None:
+            tool_ids = set(tool_ids)
+        requirements_list = [requirements.resolvable for requirements, tids in self.tool_ids_by_requirements.items()
+                             if tool_ids is None or tool_ids.intersection(tids)]
+        kwds = dict(progress_callback=progress_callback)
+        if workers:
+            kwds['workers'] = int(workers)
+        try:
+            return resolvers[0].install_requirements(requirements_list, **kwds)
+        finally:
+            self._dependency_manager.invalidate_resolution_cache()
+
     def install_dependency(self, index=None, **payload):
         """
         Installs dependency using highest priority resolver that supports dependency installation
@@ -135,12 +172,15 @@ class DependencyResolversView(object):
             raise exceptions.NotImplemented()
 
         name, version, type, extra_kwds = self._parse_dependency_info(payload)
-        return resolver.install_dependency(
-            name=name,
-            version=version,
-            type=type,
-            **extra_kwds
-        )
+        try:
+            return resolver.install_dependency(
+                name=name,
+                version=version,
+                type=type,
+                **extra_kwds
+            )
+        finally:
+            self._dependency_manager.invalidate_resolution_cache()
 
     def _dependency(self, index=None, **kwds):
         if index is not None:
@@ -228,6 +268,7 @@ class DependencyResolversView(object):
         return [d.to_dict() for d in flat_dependencies]
 
     def clean(self, index=None, **kwds):
+        self._dependency_manager.invalidate_resolution_cache()
         if index:
             resolver = self._dependency_resolver(index)
             if not hasattr(resolver, "clean"):
@@ -1,9 +1,14 @@
+import bisect
+import itertools
 import logging
 import os
 import string
+import threading
 import time
 from collections import namedtuple
 from errno import ENOENT
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from xml.etree.ElementTree import ParseError
 
 from markupsafe import escape
@@ -13,6 +18,7 @@ from six.moves.urllib.parse import urlparse
 from galaxy.exceptions import MessageException, ObjectNotFound
 from galaxy.tools.deps import build_dependency_manager
 from galaxy.tools.loader_directory import looks_like_a_tool
+from galaxy.tools.parser import get_tool_source
 from galaxy.util import (
     ExecutionTimer,
     listify,
@@ -21,7 +27,10 @@ from galaxy.util import (
 )
 from galaxy.util.bunch import Bunch
 from galaxy.util.dictifiable import Dictifiable
+from galaxy.util.json import safe_dumps
 from galaxy.util.odict import odict
+from galaxy.util.tool_version import remove_version_from_guid
+from .cache import ToolSourceCache
 from .filters import FilterFactory
 from .integrated_panel import ManagesIntegratedToolPanelMixin
 from .lineages import LineageMap
@@ -36,6 +45,13 @@ from .tags import tool_tag_manager
 
 log = logging.getLogger(__name__)
 
+# Number of filtered tool panel views kept before they are all discarded
+MAX_PANEL_VIEWS = 1000
+# Seconds without tool file changes in watched directories before the tool panel is rebuilt
+DEFAULT_TOOL_PANEL_UPDATE_DELAY = 1.0
+# The rebuild is postponed by further changes for at most this many delays
+TOOL_PANEL_UPDATE_MAX_DELAYS = 10
+
 # A fake ToolShedRepository constructed from a shed tool conf
 ToolConfRepository = namedtuple(
     'ToolConfRepository',
@@ -67,10 +83,29 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
         # so each will be present once in the above dictionary. The following
         # dictionary can instead hold multiple tools with different versions.
         self._tool_versions_by_id = {}
+        # Indexes maintained by register_tool and remove_tool_by_id for the
+        # inexact lookups of get_tool: tools of _tools_by_id by old id, sorted
+        # by version, and the registered tool shed tool ids by versionless id.
+        self._tools_by_old_id = {}
+        self._tool_sequence = itertools.count()
+        self._tool_sequence_by_id = {}
+        self._shed_tool_ids_by_versionless_id = {}
+        self._tool_shed_urls = None
         self._workflows_by_id = {}
         # Cache for tool's to_dict calls specific to toolbox. Invalidates on toolbox reload.
         self._tool_to_dict_cache = {}
         self._tool_to_dict_cache_admin = {}
+        # Filtered tool panels by filters in effect and user, see _panel_view
+        self._panel_views = {}
+        # Debounced tool panel rebuilds, see _schedule_tool_panel_update
+        self._tool_panel_update_delay = float(getattr(app.config, "tool_panel_update_delay", DEFAULT_TOOL_PANEL_UPDATE_DELAY))
+        self._tool_panel_update_lock = threading.Lock()
+        self._tool_panel_update_timer = None
+        self._tool_panel_update_requested_at = None
+        # Tool sources parsed ahead of their registration by _preload_tool_sources
+        self._preloaded_tool_sources = {}
+        tool_source_cache_dir = getattr(app.config, "tool_source_cache_dir", None)
+        self._tool_source_cache = ToolSourceCache(tool_source_cache_dir) if tool_source_cache_dir else None
         # In-memory dictionary that defines the layout of the tool panel.
         self._tool_panel = ToolPanelElements()
         self._index = 0
@@ -107,12 +142,34 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
     def create_tool(self, config_file, tool_shed_repository=None, guid=None, **kwds):
         raise NotImplementedError()
 
+    def get_tool_source(self, config_file):
+        """Return the ToolSource for `config_file`.
+
+        Implementations of `create_tool` should use this to benefit from the
+        tool sources parsed concurrently while the toolbox is loaded and from
+        the persistent tool source cache.
+        """
+        tool_source = self._preloaded_tool_sources.pop(config_file, None)
+        if tool_source is None and self._tool_source_cache is not None:
+            tool_source = self._tool_source_cache.get(config_file)
+        if tool_source is None:
+            tool_source = get_tool_source(config_file, enable_beta_formats=self._enable_beta_tool_formats)
+            if self._tool_source_cache is not None:
+                self._tool_source_cache.put(config_file, tool_source)
+        return tool_source
+
+    @property
+    def _enable_beta_tool_formats(self):
+        return getattr(self.app.config, "enable_beta_tool_formats", False)
+
     def _init_tools_from_configs(self, config_filenames):
         """ Read through all tool config files and initialize tools in each
         with init_tools_from_config below.
         """
         execution_timer = ExecutionTimer()
         self._tool_tag_manager.reset_tags()
+        if self._tool_source_cache is not None:
+            self._tool_source_cache.reset_stats()
         config_filenames = listify(config_filenames)
         for config_filename in config_filenames:
             if os.path.isdir(config_filename):
@@ -120,21 +177,93 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
                 directory_config_files = [config_file for config_file in directory_contents if config_file.endswith(".xml")]
                 config_filenames.remove(config_filename)
                 config_filenames.extend(directory_config_files)
-        for config_filename in config_filenames:
-            try:
-                self._init_tools_from_config(config_filename)
-            except ParseError:
-                # Occasionally we experience "Missing required parameter 'shed_tool_conf'."
-                # This happens if parsing the shed_tool_conf fails, so we just sleep a second and try again.
-                # TODO: figure out why this fails occasionally (try installing hundreds of tools in batch ...).
-                time.sleep(1)
+        self._preload_tool_sources(config_filenames)
+        try:
+            for config_filename in config_filenames:
                 try:
                     self._init_tools_from_config(config_filename)
+                except ParseError:
+                    # Occasionally we experience "Missing required parameter 'shed_tool_conf'."
+                    # This happens if parsing the shed_tool_conf fails, so we just sleep a second and try again.
+                    # TODO: figure out why this fails occasionally (try installing hundreds of tools in batch ...).
+                    time.sleep(1)
+                    try:
+                        self._init_tools_from_config(config_filename)
+                    except Exception:
+                        raise
                 except Exception:
-                    raise
+                    log.exception("Error loading tools defined in config %s", config_filename)
+        finally:
+            # Drop the sources of tools that were not created, e.g. deactivated repositories
+            self._preloaded_tool_sources = {}
+        if self._tool_source_cache is not None:
+            log.debug("Reading tools from config files finished %s (tool source cache: %d hits, %d misses)",
+                      execution_timer, self._tool_source_cache.hits, self._tool_source_cache.misses)
+        else:
+            log.debug("Reading tools from config files finished %s", execution_timer)
+
+    def _preload_tool_sources(self, config_filenames):
+        """
+        Parse the tool sources of the tools listed in `config_filenames` ahead
+        of their registration, concurrently on `tool_load_workers` threads (or
+        processes if `tool_load_pool` is `process`). Tools are still created
+        and registered one by one in config order by `_init_tools_from_config`,
+        picking up the parsed sources through `get_tool_source`.
+        """
+        workers = int(getattr(self.app.config, "tool_load_workers", 1) or 1)
+        if workers < 2:
+            return
+        execution_timer = ExecutionTimer()
+        paths = []
+        for config_filename in config_filenames:
+            try:
+                tool_conf_source = get_toolbox_parser(config_filename)
+                tool_path = self.__resolve_tool_path(tool_conf_source.parse_tool_path(), config_filename)
+                paths.extend(self._tool_paths_for_items(tool_conf_source.parse_items(), tool_path))
             except Exception:
-                log.exception("Error loading tools defined in config %s", config_filename)
-        log.debug("Reading tools from config files finished %s", execution_timer)
+                # Reported once the config is loaded
+                continue
+        seen = set()
+        paths = [path for path in paths if not (path in seen or seen.add(path))]
+        paths = [path for path in paths if os.path.exists(path) and not self.load_tool_from_cache(path)]
+        if self._tool_source_cache is not None:
+            for path in paths:
+                tool_source = self._tool_source_cache.get(path)
+                if tool_source is not None:
+                    self._preloaded_tool_sources[path] = tool_source
+            paths = [path for path in paths if path not in self._preloaded_tool_sources]
+        if not paths:
+            return
+        if getattr(self.app.config, "tool_load_pool", "thread") == "process":
+            pool = Pool(min(workers, len(paths)))
+        else:
+            pool = ThreadPool(min(workers, len(paths)))
+        try:
+            tool_sources = pool.map(_load_tool_source, [(path, self._enable_beta_tool_formats) for path in paths],
+                                    chunksize=max(len(paths) // (workers * 4), 1))
+        finally:
+            pool.close()
+            pool.join()
+        for path, tool_source in zip(paths, tool_sources):
+            if tool_source is not None:
+                self._preloaded_tool_sources[path] = tool_source
+                if self._tool_source_cache is not None:
+                    self._tool_source_cache.put(path, tool_source)
+        log.debug("Parsed %d tool sources with %d workers %s", len(self._preloaded_tool_sources), workers, execution_timer)
+
+    def _tool_paths_for_items(self, items, tool_path):
+        for item in items:
+            if item.type == 'tool':
+                yield self._tool_item_path(item, tool_path)
+            elif item.type == 'section':
+                for path in self._tool_paths_for_items(item.items, tool_path):
+                    yield path
+
+    def _tool_item_path(self, item, tool_path):
+        path_template = item.get("file")
+        template_kwds = self._path_template_kwds()
+        path = string.Template(path_template).safe_substitute(**template_kwds)
+        return os.path.join(tool_path, path)
 
     def _init_tools_from_config(self, config_filename):
         """
@@ -187,27 +316,30 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
 
     def load_item(self, item, tool_path, panel_dict=None, integrated_panel_dict=None, load_panel_dict=True, guid=None, index=None, internal=False):
         with self.app._toolbox_lock:
-            item = ensure_tool_conf_item(item)
-            item_type = item.type
-            if item_type not in ['tool', 'section'] and not internal:
-                # External calls from tool shed code cannot load labels or tool
-                # directories.
-                return
-
-            if panel_dict is None:
-                panel_dict = self._tool_panel
-            if integrated_panel_dict is None:
-                integrated_panel_dict = self._integrated_tool_panel
-            if item_type == 'tool':
-                self._load_tool_tag_set(item, panel_dict=panel_dict, integrated_panel_dict=integrated_panel_dict, tool_path=tool_path, load_panel_dict=load_panel_dict, guid=guid, index=index, internal=internal)
-            elif item_type == 'workflow':
-                self._load_workflow_tag_set(item, panel_dict=panel_dict, integrated_panel_dict=integrated_panel_dict, load_panel_dict=load_panel_dict, index=index)
-            elif item_type == 'section':
-                self._load_section_tag_set(item, tool_path=tool_path, load_panel_dict=load_panel_dict, index=index, internal=internal)
-            elif item_type == 'label':
-                self._load_label_tag_set(item, panel_dict=panel_dict, integrated_panel_dict=integrated_panel_dict, load_panel_dict=load_panel_dict, index=index)
-            elif item_type == 'tool_dir':
-                self._load_tooldir_tag_set(item, panel_dict, tool_path, integrated_panel_dict, load_panel_dict=load_panel_dict)
+            try:
+                item = ensure_tool_conf_item(item)
+                item_type = item.type
+                if item_type not in ['tool', 'section'] and not internal:
+                    # External calls from tool shed code cannot load labels or tool
+                    # directories.
+                    return
+
+                if panel_dict is None:
+                    panel_dict = self._tool_panel
+                if integrated_panel_dict is None:
+                    integrated_panel_dict = self._integrated_tool_panel
+                if item_type == 'tool':
+                    self._load_tool_tag_set(item, panel_dict=panel_dict, integrated_panel_dict=integrated_panel_dict, tool_path=tool_path, load_panel_dict=load_panel_dict, guid=guid, index=index, internal=internal)
+                elif item_type == 'workflow':
+                    self._load_workflow_tag_set(item, panel_dict=panel_dict, integrated_panel_dict=integrated_panel_dict, load_panel_dict=load_panel_dict, index=index)
+                elif item_type == 'section':
+                    self._load_section_tag_set(item, tool_path=tool_path, load_panel_dict=load_panel_dict, index=index, internal=internal)
+                elif item_type == 'label':
+                    self._load_label_tag_set(item, panel_dict=panel_dict, integrated_panel_dict=integrated_panel_dict, load_panel_dict=load_panel_dict, index=index)
+                elif item_type == 'tool_dir':
+                    self._load_tooldir_tag_set(item, panel_dict, tool_path, integrated_panel_dict, load_panel_dict=load_panel_dict)
+            finally:
+                self.invalidate_panel_views()
 
     def get_shed_config_dict_by_filename(self, filename, default=None):
         for shed_config_dict in self._dynamic_tool_confs:
@@ -342,46 +474,49 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
 
     def _load_tool_panel(self):
         execution_timer = ExecutionTimer()
-        for key, item_type, val in self._integrated_tool_panel.panel_items_iter():
-            if item_type == panel_item_types.TOOL:
-                tool_id = key.replace('tool_', '', 1)
-                if tool_id in self._tools_by_id:
-                    self.__add_tool_to_tool_panel(val, self._tool_panel, section=False)
-                    self._integrated_section_by_tool[tool_id] = '', ''
-            elif item_type == panel_item_types.WORKFLOW:
-                workflow_id = key.replace('workflow_', '', 1)
-                if workflow_id in self._workflows_by_id:
-                    workflow = self._workflows_by_id[workflow_id]
-                    self._tool_panel[key] = workflow
-                    log.debug("Loaded workflow: %s %s" % (workflow_id, workflow.name))
-            elif item_type == panel_item_types.LABEL:
-                self._tool_panel[key] = val
-            elif item_type == panel_item_types.SECTION:
-                section_dict = {
-                    'id': val.id or '',
-                    'name': val.name or '',
-                    'version': val.version or '',
-                }
-                section = ToolSection(section_dict)
-                log.debug("Loading section: %s" % section_dict.get('name'))
-                for section_key, section_item_type, section_val in val.panel_items_iter():
-                    if section_item_type == panel_item_types.TOOL:
-                        tool_id = section_key.replace('tool_', '', 1)
-                        if tool_id in self._tools_by_id:
-                            self.__add_tool_to_tool_panel(section_val, section, section=True)
-                            self._integrated_section_by_tool[tool_id] = key, val.name
-                    elif section_item_type == panel_item_types.WORKFLOW:
-                        workflow_id = section_key.replace('workflow_', '', 1)
-                        if workflow_id in self._workflows_by_id:
-                            workflow = self._workflows_by_id[workflow_id]
-                            section.elems[section_key] = workflow
-                            log.debug("Loaded workflow: %s %s" % (workflow_id, workflow.name))
-                    elif section_item_type == panel_item_types.LABEL:
-                        if section_val:
-                            section.elems[section_key] = section_val
-                            log.debug("Loaded label: %s" % (section_val.text))
-                self._tool_panel[key] = section
-        log.debug("Loading tool panel finished %s", execution_timer)
+        try:
+            for key, item_type, val in self._integrated_tool_panel.panel_items_iter():
+                if item_type == panel_item_types.TOOL:
+                    tool_id = key.replace('tool_', '', 1)
+                    if tool_id in self._tools_by_id:
+                        self.__add_tool_to_tool_panel(val, self._tool_panel, section=False)
+                        self._integrated_section_by_tool[tool_id] = '', ''
+                elif item_type == panel_item_types.WORKFLOW:
+                    workflow_id = key.replace('workflow_', '', 1)
+                    if workflow_id in self._workflows_by_id:
+                        workflow = self._workflows_by_id[workflow_id]
+                        self._tool_panel[key] = workflow
+                        log.debug("Loaded workflow: %s %s" % (workflow_id, workflow.name))
+                elif item_type == panel_item_types.LABEL:
+                    self._tool_panel[key] = val
+                elif item_type == panel_item_types.SECTION:
+                    section_dict = {
+                        'id': val.id or '',
+                        'name': val.name or '',
+                        'version': val.version or '',
+                    }
+                    section = ToolSection(section_dict)
+                    log.debug("Loading section: %s" % section_dict.get('name'))
+                    for section_key, section_item_type, section_val in val.panel_items_iter():
+                        if section_item_type == panel_item_types.TOOL:
+                            tool_id = section_key.replace('tool_', '', 1)
+                            if tool_id in self._tools_by_id:
+                                self.__add_tool_to_tool_panel(section_val, section, section=True)
+                                self._integrated_section_by_tool[tool_id] = key, val.name
+                        elif section_item_type == panel_item_types.WORKFLOW:
+                            workflow_id = section_key.replace('workflow_', '', 1)
+                            if workflow_id in self._workflows_by_id:
+                                workflow = self._workflows_by_id[workflow_id]
+                                section.elems[section_key] = workflow
+                                log.debug("Loaded workflow: %s %s" % (workflow_id, workflow.name))
+                        elif section_item_type == panel_item_types.LABEL:
+                            if section_val:
+                                section.elems[section_key] = section_val
+                                log.debug("Loaded label: %s" % (section_val.text))
+                    self._tool_panel[key] = section
+            log.debug("Loading tool panel finished %s", execution_timer)
+        finally:
+            self.invalidate_panel_views()
 
     def _load_integrated_tool_panel_keys(self):
         """
@@ -412,6 +547,10 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
             elif elem.tag == 'label':
                 self._integrated_tool_panel.stub_label(key)
 
+    def _is_shed_tool_id(self, tool_id):
+        """Whether a tool with this versioned or versionless tool shed id is registered."""
+        return tool_id in self._shed_tool_ids_by_versionless_id or remove_version_from_guid(tool_id) in self._shed_tool_ids_by_versionless_id
+
     def get_tool(self, tool_id, tool_version=None, get_all_versions=False, exact=False):
         """Attempt to locate a tool in the tool box. Note that `exact` only refers to the `tool_id`, not the `tool_version`."""
         if tool_version:
@@ -422,11 +561,9 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
 
         if "/repos/" in tool_id:  # test if tool came from a toolshed
             tool_id_without_tool_shed = tool_id.split("/repos/")[1]
-            available_tool_sheds = [urlparse(_) for _ in self.app.tool_shed_registry.tool_sheds.values()]
-            available_tool_sheds = [url.geturl().replace(url.scheme + "://", '', 1) for url in available_tool_sheds]
-            tool_ids = [tool_shed + "repos/" + tool_id_without_tool_shed for tool_shed in available_tool_sheds]
-            if tool_id in tool_ids:  # move original tool_id to the top of tool_ids
-                tool_ids.remove(tool_id)
+            tool_ids = [tool_shed + "repos/" + tool_id_without_tool_shed for tool_shed in self._available_tool_sheds()]
+            # Only the tool sheds a version of this tool was registered from can match
+            tool_ids = [_ for _ in tool_ids if _ != tool_id and self._is_shed_tool_id(_)]
             tool_ids.insert(0, tool_id)
         else:
             tool_ids = [tool_id]
@@ -452,13 +589,9 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
                     if lineage_tool:
                         rval.append(lineage_tool)
             if not rval:
-                # still no tool, do a deeper search and try to match by old ids
-                for tool in self._tools_by_id.values():
-                    if tool.old_id == tool_id:
-                        rval.append(tool)
-                # if we don't have a lineage_map for this tool we need to sort by version,
-                # so that the last tool in rval is the newest tool.
-                rval.sort(key=lambda t: t.version)
+                # still no tool, do a deeper search and try to match by old ids,
+                # indexed sorted by version so that the last tool in rval is the newest tool.
+                rval = [tool for _, _, tool in self._tools_by_old_id.get(tool_id, [])]
             if rval:
                 if get_all_versions:
                     return rval
@@ -479,6 +612,14 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
                     return self._tools_by_id[tool_id]
         return None
 
+    def _available_tool_sheds(self):
+        tool_shed_urls = tuple(self.app.tool_shed_registry.tool_sheds.values())
+        if self._tool_shed_urls is None or self._tool_shed_urls[0] != tool_shed_urls:
+            available_tool_sheds = [urlparse(_) for _ in tool_shed_urls]
+            available_tool_sheds = [url.geturl().replace(url.scheme + "://", '', 1) for url in available_tool_sheds]
+            self._tool_shed_urls = (tool_shed_urls, available_tool_sheds)
+        return self._tool_shed_urls[1]
+
     def has_tool(self, tool_id, tool_version=None, exact=False):
         return self.get_tool(tool_id, tool_version=tool_version, exact=exact) is not None
 
@@ -722,8 +863,7 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
                 integrated_elems[key] = tool
 
                 if async_load:
-                    self._load_tool_panel()
-                    self._save_integrated_tool_panel()
+                    self._schedule_tool_panel_update()
                 return tool.id
             except Exception:
                 log.exception("Failed to load potential tool %s.", tool_file)
@@ -743,6 +883,52 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
         if (tool_loaded or force_watch) and self._tool_watcher:
             self._tool_watcher.watch_directory(directory, quick_load)
 
+    def _schedule_tool_panel_update(self):
+        """
+        Rebuild the tool panel and save the integrated tool panel once the
+        burst of tool file changes in progress is over.
+
+        Each call postpones the update by `tool_panel_update_delay` seconds,
+        up to `TOOL_PANEL_UPDATE_MAX_DELAYS` times that since the first
+        pending call, so that tools dropped in a watched directory together
+        cost a single rebuild and write.
+        """
+        if self._tool_panel_update_delay <= 0:
+            self._update_tool_panel()
+            return
+        with self._tool_panel_update_lock:
+            now = time.time()
+            timer = self._tool_panel_update_timer
+            if timer is None:
+                self._tool_panel_update_requested_at = now
+            elif now - self._tool_panel_update_requested_at < self._tool_panel_update_delay * (TOOL_PANEL_UPDATE_MAX_DELAYS - 1):
+                timer.cancel()
+            else:
+                return
+            timer = threading.Timer(self._tool_panel_update_delay, self._update_tool_panel)
+            timer.daemon = True
+            self._tool_panel_update_timer = timer
+            timer.start()
+
+    def flush_tool_panel_update(self):
+        """Apply a tool panel update scheduled by `_schedule_tool_panel_update` now."""
+        with self._tool_panel_update_lock:
+            timer = self._tool_panel_update_timer
+            if timer is None:
+                return
+            timer.cancel()
+            self._tool_panel_update_timer = None
+        self._update_tool_panel()
+
+    def _update_tool_panel(self):
+        with self._tool_panel_update_lock:
+            # A timer firing while being replaced must not forget its replacement
+            if self._tool_panel_update_timer is threading.current_thread():
+                self._tool_panel_update_timer = None
+        with self.app._toolbox_lock:
+            self._load_tool_panel()
+            self._save_integrated_tool_panel()
+
     def load_tool(self, config_file, guid=None, tool_shed_repository=None, use_cached=False, **kwds):
         """Load a single tool from the file named by `config_file` and return an instance of `Tool`."""
         # Parse XML configuration file and get the root element
@@ -802,20 +988,44 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
         return tool
 
     def register_tool(self, tool):
-        tool_id = tool.id
-        version = tool.version or None
-        if tool_id not in self._tool_versions_by_id:
-            self._tool_versions_by_id[tool_id] = {version: tool}
-        else:
-            self._tool_versions_by_id[tool_id][version] = tool
-        if tool_id in self._tools_by_id:
-            related_tool = self._tools_by_id[tool_id]
-            # This one becomes the default un-versioned tool
-            # if newer.
-            if self._newer_tool(tool, related_tool):
+        try:
+            tool_id = tool.id
+            version = tool.version or None
+            if tool_id not in self._tool_versions_by_id:
+                self._tool_versions_by_id[tool_id] = {version: tool}
+            else:
+                self._tool_versions_by_id[tool_id][version] = tool
+            if "/repos/" in tool_id:
+                self._shed_tool_ids_by_versionless_id.setdefault(remove_version_from_guid(tool_id), set()).add(tool_id)
+            if tool_id in self._tools_by_id:
+                related_tool = self._tools_by_id[tool_id]
+                # This one becomes the default un-versioned tool
+                # if newer.
+                if self._newer_tool(tool, related_tool):
+                    self._unindex_tool(related_tool)
+                    self._tools_by_id[tool_id] = tool
+                    self._index_tool(tool)
+            else:
+                self._tool_sequence_by_id[tool_id] = next(self._tool_sequence)
                 self._tools_by_id[tool_id] = tool
-        else:
-            self._tools_by_id[tool_id] = tool
+                self._index_tool(tool)
+        finally:
+            self.invalidate_panel_views()
+
+    def _index_tool(self, tool):
+        old_id = getattr(tool, "old_id", None)
+        if old_id is not None:
+            # Ties are kept in _tools_by_id order
+            entry = (tool.version or '', self._tool_sequence_by_id[tool.id], tool)
+            bisect.insort(self._tools_by_old_id.setdefault(old_id, []), entry)
+
+    def _unindex_tool(self, tool):
+        old_id = getattr(tool, "old_id", None)
+        entries = self._tools_by_old_id.get(old_id)
+        if entries:
+            entries[:] = [entry for entry in entries if entry[2] is not tool]
+            if not entries:
+                del self._tools_by_old_id[old_id]
 
     def package_tool(self, trans, tool_id):
         """
@@ -882,6 +1092,14 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
         else:
             tool = self._tools_by_id[tool_id]
             del self._tools_by_id[tool_id]
+            self._unindex_tool(tool)
+            if "/repos/" in tool_id:
+                versionless_tool_id = remove_version_from_guid(tool_id)
+                shed_tool_ids = self._shed_tool_ids_by_versionless_id.get(versionless_tool_id, set())
+                shed_tool_ids.discard(tool_id)
+                if not shed_tool_ids:
+                    self._shed_tool_ids_by_versionless_id.pop(versionless_tool_id, None)
+            del self._tool_sequence_by_id[tool_id]
             tool_cache = getattr(self.app, 'tool_cache', None)
             if tool_cache:
                 tool_cache.expire_tool(tool_id)
@@ -897,6 +1115,7 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
                             break
                 if tool_id in self.data_manager_tools:
                     del self.data_manager_tools[tool_id]
+            self.invalidate_panel_views()
             # TODO: do we need to manually remove from the integrated panel here?
             message = "Removed the tool:<br/>"
             message += "<b>name:</b> %s<br/>" % escape(tool.name)
@@ -940,11 +1159,41 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
     def tool_panel_contents(self, trans, **kwds):
         """ Filter tool_panel contents for displaying for user.
         """
-        filter_method = self._build_filter_method(trans)
-        for _, item_type, elt in self._tool_panel.panel_items_iter():
-            elt = filter_method(elt, item_type)
-            if elt:
-                yield elt
+        for elt in self._panel_view(trans).contents:
+            yield elt
+
+    def invalidate_panel_views(self):
+        """Discard the filtered tool panels, call once a change to the tool panel is complete."""
+        self._panel_views = {}
+
+    def _panel_view(self, trans):
+        """
+        Return the tool panel filtered for `trans`. Views are shared by the
+        requests with the same filters and admin status, and also the same
+        user unless all filters are marked `user_independent`.
+        """
+        filters = self._filter_factory.build_filters(trans)
+        all_filters = filters['tool'] + filters['section'] + filters['label']
+        if all(getattr(filter_method, 'user_independent', False) for filter_method in all_filters):
+            user_key = trans.user is not None
+        else:
+            user_key = trans.user.id if trans.user else None
+        key = (tuple(filters['tool']), tuple(filters['section']), tuple(filters['label']), bool(trans.user_is_admin), user_key)
+        # Views computed while the panel changes end up in the dict discarded
+        # once the change is complete
+        views = self._panel_views
+        view = views.get(key)
+        if view is None:
+            if len(views) >= MAX_PANEL_VIEWS:
+                views.clear()
+            context = Bunch(toolbox=self, trans=trans)
+            contents = []
+            for _, item_type, elt in self._tool_panel.panel_items_iter():
+                elt = _filter_for_panel(elt, item_type, filters, context)
+                if elt:
+                    contents.append(elt)
+            view = views[key] = _PanelView(contents)
+        return view
 
     def get_tool_to_dict(self, trans, tool):
         """Return tool's to_dict.
@@ -970,14 +1219,17 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
         """
         rval = []
         if in_panel:
-            panel_elts = list(self.tool_panel_contents(trans, **kwds))
-            for elt in panel_elts:
-                # Only use cache for objects that are Tools.
-                if hasattr(elt, "tool_type"):
-                    rval.append(self.get_tool_to_dict(trans, elt))
-                else:
-                    kwargs = dict(trans=trans, link_details=True, toolbox=self)
-                    rval.append(elt.to_dict(**kwargs))
+            view = self._panel_view(trans)
+            if view.as_dict is None:
+                for elt in view.contents:
+                    # Only use cache for objects that are Tools.
+                    if hasattr(elt, "tool_type"):
+                        rval.append(self.get_tool_to_dict(trans, elt))
+                    else:
+                        kwargs = dict(trans=trans, link_details=True, toolbox=self)
+                        rval.append(elt.to_dict(**kwargs))
+                view.as_dict = rval
+            return list(view.as_dict)
         else:
             filter_method = self._build_filter_method(trans)
             for id, tool in self._tools_by_id.items():
@@ -987,6 +1239,18 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
                 rval.append(self.get_tool_to_dict(trans, tool))
         return rval
 
+    def to_json(self, trans, in_panel=True, **kwds):
+        """
+        Return the JSON encoding of `to_dict` as bytes, serialized once per
+        tool panel view if `in_panel`.
+        """
+        if not in_panel:
+            return safe_dumps(self.to_dict(trans, in_panel=False, **kwds)).encode('utf-8')
+        view = self._panel_view(trans)
+        if view.as_json is None:
+            view.as_json = safe_dumps(self.to_dict(trans, in_panel=True, **kwds)).encode('utf-8')
+        return view.as_json
+
     def _lineage_in_panel(self, panel_dict, tool=None, tool_lineage=None):
         """ If tool with same lineage already in panel (or section) - find
         and return it. Otherwise return None.
@@ -1023,6 +1287,27 @@ class AbstractToolBox(Dictifiable, ManagesIntegratedToolPanelMixin):
         return lambda element, item_type: _filter_for_panel(element, item_type, filters, context)
 
 
+class _PanelView(object):
+    """Tool panel filtered for a set of requests, with its serializations."""
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.as_dict = None
+        self.as_json = None
+
+
+def _load_tool_source(args):
+    """Parse a tool source in a `_preload_tool_sources` worker, `None` on errors.
+
+    Errors are reported when the tool is created, which parses it again.
+    """
+    config_file, enable_beta_formats = args
+    try:
+        return get_tool_source(config_file, enable_beta_formats=enable_beta_formats)
+    except Exception:
+        return None
+
+
 def _filter_for_panel(item, item_type, filters, context):
     """
     Filters tool panel elements so that only those that are compatible
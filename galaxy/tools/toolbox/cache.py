@@ -0,0 +1,137 @@
+"""
+Persistent cache of parsed tool sources, letting the toolbox skip the XML
+parsing and macro expansion of unchanged tools when Galaxy restarts.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from six.moves import cPickle as pickle
+
+from galaxy.util import sqlite
+from galaxy.util.hash_util import memory_bound_hexdigest, sha1
+
+log = logging.getLogger(__name__)
+
+TOOL_SOURCE_CACHE_FILENAME = "tool_source_cache.sqlite"
+# Bump when pickled tool sources of a previous version cannot be used anymore
+TOOL_SOURCE_CACHE_VERSION = 1
+
+TOOL_SOURCE_CACHE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS tool_sources (
+        path TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        stamps TEXT NOT NULL,
+        source BLOB NOT NULL
+    )""",
+]
+
+
+class ToolSourceCache(object):
+    """SQLite backed cache of pickled ``ToolSource`` objects.
+
+    Entries are keyed by tool path and record the modification time, size
+    and SHA-1 of the tool file and of the macro files it imports. An entry is
+    used if none of these files changed. Files are only hashed if their
+    modification time or size differs from the recorded one, and a file whose
+    modification time changed but not its contents (e.g. after a fresh
+    checkout) still counts as unchanged.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Macro files are shared by many tools, hash them once per version
+        self._digests = {}
+        self._connection = sqlite.connect(os.path.join(cache_dir, TOOL_SOURCE_CACHE_FILENAME),
+                                          check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            for statement in TOOL_SOURCE_CACHE_SCHEMA:
+                self._connection.execute(statement)
+
+    def get(self, config_file):
+        """Return the cached tool source for ``config_file``, ``None`` if missing or stale."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version, stamps, source FROM tool_sources WHERE path = ?", (config_file, )
+            ).fetchone()
+        if row is None or row["version"] != TOOL_SOURCE_CACHE_VERSION:
+            return self._miss()
+        stamps = json.loads(row["stamps"])
+        recorded = dict(((path, mtime, size), digest) for path, mtime, size, digest in stamps)
+        current_stamps = self._stamps([stamp[0] for stamp in stamps], recorded)
+        if current_stamps is None or [s[3] for s in stamps] != [s[3] for s in current_stamps]:
+            return self._miss()
+        try:
+            tool_source = pickle.loads(bytes(row["source"]))
+        except Exception:
+            log.debug("Discarding unreadable cached tool source for '%s'", config_file, exc_info=True)
+            self.remove(config_file)
+            return self._miss()
+        if current_stamps != [tuple(stamp) for stamp in stamps]:
+            with self._lock, self._connection:
+                self._connection.execute("UPDATE tool_sources SET stamps = ? WHERE path = ?",
+                                         (json.dumps(current_stamps), config_file))
+        with self._lock:
+            self.hits += 1
+        return tool_source
+
+    def put(self, config_file, tool_source):
+        paths = [config_file] + list(tool_source.macro_paths())
+        stamps = self._stamps(paths)
+        if stamps is None:
+            return
+        try:
+            source = pickle.dumps(tool_source, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            log.debug("Cannot cache tool source for '%s'", config_file, exc_info=True)
+            return
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO tool_sources (path, version, stamps, source) VALUES (?, ?, ?, ?)",
+                (config_file, TOOL_SOURCE_CACHE_VERSION, json.dumps(stamps), sqlite3.Binary(source))
+            )
+
+    def remove(self, config_file):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM tool_sources WHERE path = ?", (config_file, ))
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _miss(self):
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _stamps(self, paths, recorded=None):
+        """Return ``(path, mtime, size, sha1)`` tuples for ``paths``, ``None`` if one is missing.
+
+        ``recorded`` maps ``(path, mtime, size)`` to the SHA-1 stored with an
+        entry, files still matching these are not hashed again.
+        """
+        stamps = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                key = (path, stat.st_mtime, stat.st_size)
+                digest = self._digests.get(key) or (recorded or {}).get(key)
+                if digest is None:
+                    digest = memory_bound_hexdigest(sha1, path)
+                self._digests[key] = digest
+            except (IOError, OSError):
+                return None
+            stamps.append(key + (digest, ))
+        return stamps
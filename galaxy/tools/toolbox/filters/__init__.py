@@ -89,7 +89,20 @@ class FilterFactory(object):
         log.warning("Failed to load module for '%s.%s'.", module_name, function_name, exc_info=True)
 
 
+def user_independent(filter_function):
+    """Mark a filter as depending only on the filtered item, on whether a
+    user is logged in and on whether they are an admin. ``_handle_authorization``
+    is not, ``Tool.allow_user_access`` may be overridden to check the user.
+
+    Tool panel views filtered by such filters only are shared by all users,
+    otherwise they are computed and cached per user.
+    """
+    filter_function.user_independent = True
+    return filter_function
+
+
 # Stock Filter Functions
+@user_independent
 def _not_hidden(context, tool):
     return not tool.hidden
 
@@ -103,5 +116,6 @@ def _handle_authorization(context, tool):
     return True
 
 
+@user_independent
 def _has_trackster_conf(context, tool):
     return tool.trackster_conf
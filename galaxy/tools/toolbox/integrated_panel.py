@@ -2,8 +2,10 @@ import os
 import shutil
 import string
 import tempfile
+import threading
 import time
 import traceback
+from contextlib import contextmanager
 from xml.sax.saxutils import escape
 
 from .panel import (
@@ -37,6 +39,30 @@ class ManagesIntegratedToolPanelMixin(object):
         self._integrated_tool_panel_config_has_contents = os.path.exists(self._integrated_tool_panel_config) and os.stat(self._integrated_tool_panel_config).st_size > 0
         if self._integrated_tool_panel_config_has_contents:
             self._load_integrated_tool_panel_keys()
+        # Saves requested within batch_integrated_tool_panel_saves blocks are written once at the end
+        self._integrated_tool_panel_save_lock = threading.Lock()
+        self._integrated_tool_panel_batch_depth = 0
+        self._integrated_tool_panel_save_pending = False
+
+    @contextmanager
+    def batch_integrated_tool_panel_saves(self):
+        """Defer saving the integrated tool panel to the end of the block.
+
+        Wrap operations changing many tools (e.g. installing a repository
+        suite) to rewrite integrated_tool_panel.xml once instead of once per
+        change. Blocks may be nested, the file is written when the outermost
+        one exits.
+        """
+        with self._integrated_tool_panel_save_lock:
+            self._integrated_tool_panel_batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._integrated_tool_panel_save_lock:
+                self._integrated_tool_panel_batch_depth -= 1
+                save = not self._integrated_tool_panel_batch_depth and self._integrated_tool_panel_save_pending
+            if save:
+                self._save_integrated_tool_panel()
 
     def _save_integrated_tool_panel(self):
         if self.update_integrated_tool_panel:
@@ -44,7 +70,12 @@ class ManagesIntegratedToolPanelMixin(object):
             # This will cover cases where the Galaxy administrator manually edited one or more of the tool panel
             # config files, adding or removing locally developed tools or workflows.  The value of integrated_tool_panel
             # will be False when things like functional tests are the caller.
-            self._write_integrated_tool_panel_config_file()
+            with self._integrated_tool_panel_save_lock:
+                if self._integrated_tool_panel_batch_depth:
+                    self._integrated_tool_panel_save_pending = True
+                    return
+                self._integrated_tool_panel_save_pending = False
+                self._write_integrated_tool_panel_config_file()
 
     def _write_integrated_tool_panel_config_file(self):
         """
@@ -52,8 +83,11 @@ class ManagesIntegratedToolPanelMixin(object):
         use this file to manage the tool panel, we'll not use xml_to_string() since it doesn't write XML quite right.
         """
         tracking_directory = self._integrated_tool_panel_tracking_directory
+        destination = os.path.abspath(self._integrated_tool_panel_config)
         if not tracking_directory:
-            fd, filename = tempfile.mkstemp()
+            # Create the file next to its destination so that moving it in place is an atomic rename
+            fd, filename = tempfile.mkstemp(dir=os.path.dirname(destination), prefix=".integrated_tool_panel", suffix=".xml")
+            os.close(fd)
         else:
             if not os.path.exists(tracking_directory):
                 os.makedirs(tracking_directory)
@@ -103,7 +137,6 @@ $INTEGRATED_TOOL_PANEL
                                         INTEGRATED_TOOL_PANEL='\n'.join(integrated_tool_panel))
         with open(filename, "w") as integrated_tool_panel_file:
             integrated_tool_panel_file.write(tp_string)
-        destination = os.path.abspath(self._integrated_tool_panel_config)
         if tracking_directory:
             open(filename + ".stack", "w").write(''.join(traceback.format_stack()))
             shutil.copy(filename, filename + ".copy")
@@ -130,16 +130,13 @@ class ToolPanelElements(odict, HasPanelItems):
     def replace_tool(self, previous_tool_id, new_tool_id, tool):
         previous_key = 'tool_%s' % previous_tool_id
         new_key = 'tool_%s' % new_tool_id
-        index = self.keys().index(previous_key)
-        del self[previous_key]
-        self.insert(index, new_key, tool)
+        self.replace(previous_key, new_key, tool)
 
     def index_of_tool_id(self, tool_id):
         query_key = 'tool_%s' % tool_id
-        for index, target_key in enumerate(self.keys()):
-            if query_key == target_key:
-                return index
-        return None
+        if query_key not in self:
+            return None
+        return self.index(query_key)
 
     def insert_tool(self, index, tool):
         key = "tool_%s" % tool.id
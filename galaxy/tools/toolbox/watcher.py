@@ -14,7 +14,7 @@ except ImportError:
     PollingObserver = None
     can_watch = False
 
-from galaxy.util.hash_util import md5_hash_file
+from galaxy.util.hash_util import hash_files, md5_hash_file
 try:
     from galaxy.web.stack import register_postfork_function
 except ImportError:
@@ -25,6 +25,9 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# Seconds between two checks of the files watched by ToolConfWatcher
+TOOL_CONF_WATCHER_INTERVAL = 1
+
 
 def get_observer_class(config_value, default, monitor_what_str):
     """
@@ -54,8 +57,15 @@ def get_observer_class(config_value, default, monitor_what_str):
     return observer_class
 
 
-def get_tool_conf_watcher(reload_callback, tool_cache=None):
-    return ToolConfWatcher(reload_callback=reload_callback, tool_cache=tool_cache)
+def get_tool_conf_watcher(reload_callback, tool_cache=None, config=None):
+    """
+    Watch tool configuration and macro files, using filesystem events if the
+    ``watch_tool_conf`` option of ``config`` enables them and polling
+    otherwise.
+    """
+    config_value = getattr(config, "watch_tool_conf", None)
+    observer_class = get_observer_class(config_value, default="False", monitor_what_str="tool configuration files")
+    return ToolConfWatcher(reload_callback=reload_callback, tool_cache=tool_cache, observer_class=observer_class)
 
 
 def get_tool_data_dir_watcher(tool_data_tables, config):
@@ -78,81 +88,145 @@ def get_tool_watcher(toolbox, config):
 
 
 class ToolConfWatcher(object):
+    """
+    Call ``reload_callback`` when the contents of a watched file change.
+
+    Without ``observer_class`` every watched file is checked each
+    ``interval`` seconds with a single ``os.stat`` call. With an observer
+    class (see ``get_observer_class``) the directories of the watched files
+    are monitored and only the files filesystem events point at are checked.
+    In both cases a file is only hashed, block by block, when its size or
+    modification time changed, and a reload only happens if its hash did.
+    """
 
-    def __init__(self, reload_callback, tool_cache=None):
+    def __init__(self, reload_callback, tool_cache=None, observer_class=None, interval=TOOL_CONF_WATCHER_INTERVAL):
+        # Maps watched paths to the (mtime, size) of their last check, None if missing
         self.paths = {}
+        self.hashes = {}
         self.cache = tool_cache
+        self.interval = interval
         self._active = False
         self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # Paths pointed at by filesystem events since the last check
+        self._changed_paths = set()
         self.thread = threading.Thread(target=self.check, name="ToolConfWatcher.thread")
         self.thread.daemon = True
         self.reload_callback = reload_callback
+        self.monitored_dirs = {}
+        if observer_class is not None:
+            self.observer = observer_class()
+            self.event_handler = ToolConfFileEventHandler(self)
+        else:
+            self.observer = None
 
     def start(self):
         if not self._active:
             self._active = True
             register_postfork_function(self.thread.start)
+            if self.observer is not None:
+                register_postfork_function(self.observer.start)
 
     def shutdown(self):
         if self._active:
             self._active = False
+            self._wakeup.set()
             self.thread.join()
+            if self.observer is not None:
+                self.observer.stop()
+                self.observer.join()
 
     def check(self):
         """Check for changes in self.paths or self.cache and call the event handler."""
-        hashes = {key: None for key in self.paths.keys()}
         while self._active:
-            do_reload = False
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self._active:
+                break
             with self._lock:
-                paths = list(self.paths.keys())
-            for path in paths:
-                try:
-                    if not os.path.exists(path):
-                        continue
-                    mod_time = self.paths[path]
-                    if not hashes.get(path, None):
-                        hash = md5_hash_file(path)
-                        if hash:
-                            hashes[path] = md5_hash_file(path)
-                        else:
-                            continue
-                    new_mod_time = os.path.getmtime(path)
-                    if new_mod_time > mod_time:
-                        new_hash = md5_hash_file(path)
-                        if hashes[path] != new_hash:
-                            self.paths[path] = new_mod_time
-                            hashes[path] = new_hash
-                            log.debug("The file '%s' has changes.", path)
-                            do_reload = True
-                except IOError:
-                    # in rare cases `path` may be deleted between `os.path.exists` calls
-                    # and reading the file from the filesystem. We do not want the watcher
-                    # thread to die in these cases.
-                    try:
-                        del hashes[path]
-                        del paths[path]
-                    except KeyError:
-                        pass
-                    if self.cache:
-                        self.cache.cleanup()
-                    do_reload = True
+                if self.observer is None:
+                    paths = list(self.paths.keys())
+                else:
+                    paths = list(self._changed_paths)
+                    self._changed_paths.clear()
+            do_reload = bool(self._changed(paths))
             if not do_reload and self.cache:
                 removed_ids = self.cache.cleanup()
                 if removed_ids:
                     do_reload = True
             if do_reload:
                 self.reload_callback()
-            time.sleep(1)
+
+    def _changed(self, paths):
+        """Return the paths whose contents changed since last checked, recording their new state."""
+        stamps = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stamp = (stat.st_mtime, stat.st_size)
+            if stamp != self.paths.get(path) or not self.hashes.get(path):
+                stamps[path] = stamp
+        changed_paths = []
+        for path, hexdigests in hash_files(stamps.keys()).items():
+            if not hexdigests:
+                # in rare cases `path` may be deleted between `os.stat` and
+                # reading the file. Check it again next time.
+                continue
+            new_hash = hexdigests[0]
+            with self._lock:
+                previous_stamp = self.paths.get(path)
+                previous_hash = self.hashes.get(path)
+                self.paths[path] = stamps[path]
+                self.hashes[path] = new_hash
+            if previous_hash:
+                changed = previous_hash != new_hash
+            else:
+                # Changed before it could be hashed
+                changed = previous_stamp is not None and stamps[path] != previous_stamp
+            if changed:
+                log.debug("The file '%s' has changes.", path)
+                changed_paths.append(path)
+        return changed_paths
 
     def monitor(self, path):
-        mod_time = None
-        if os.path.exists(path):
-            mod_time = os.path.getmtime(path)
+        # Filesystem events carry absolute paths
+        path = os.path.abspath(path)
+        if path in self.paths:
+            # e.g. a macro file imported by many tools, keep its last checked state
+            if not self._active:
+                self.start()
+            return
+        stamp = None
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime, stat.st_size)
+        except OSError:
+            pass
         with self._lock:
-            self.paths[path] = mod_time
+            self.paths[path] = stamp
+            if self.observer is not None:
+                # Hash the file now, there may be no other check before it changes
+                self._changed_paths.add(path)
+        if self.observer is not None:
+            self._wakeup.set()
+            directory = os.path.dirname(path)
+            if directory not in self.monitored_dirs:
+                self.monitored_dirs[directory] = directory
+                self.observer.schedule(self.event_handler, directory, recursive=False)
         if not self._active:
             self.start()
 
+    def on_path_changed(self, path):
+        """Schedule a check of `path` if it is watched."""
+        path = os.path.abspath(path)
+        with self._lock:
+            if path not in self.paths:
+                return
+            self._changed_paths.add(path)
+        self._wakeup.set()
+
     def watch_file(self, tool_conf_file):
         self.monitor(tool_conf_file)
         if not self._active:
@@ -266,6 +340,17 @@ class LocFileEventHandler(FileSystemEventHandler):
                     self.loc_watcher.tool_data_tables.reload_tables(path=path)
 
 
+class ToolConfFileEventHandler(FileSystemEventHandler):
+
+    def __init__(self, tool_conf_watcher):
+        self.tool_conf_watcher = tool_conf_watcher
+
+    def on_any_event(self, event):
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path:
+                self.tool_conf_watcher.on_path_changed(os.path.abspath(path))
+
+
 class ToolFileEventHandler(FileSystemEventHandler):
 
     def __init__(self, tool_watcher):
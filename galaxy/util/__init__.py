@@ -8,6 +8,7 @@ from __future__ import absolute_import
 import binascii
 import collections
 import errno
+import heapq
 import importlib
 import json
 import os
@@ -706,6 +707,13 @@ def in_directory(file, directory, local_path_module=os.path):
 
 def merge_sorted_iterables(operator, *iterables):
     """
+    Lazily merge `iterables`, each sorted by `operator`, into a single
+    iterable sorted by `operator`. Elements with equal keys are yielded in
+    the order of the iterables they come from.
+
+    `operator` is called once per element and a heap holds the next element
+    of each iterable, so merging n elements from k iterables takes
+    O(n log k).
 
     >>> operator = lambda x: x
     >>> list( merge_sorted_iterables( operator, [1,2,3], [4,5] ) )
@@ -714,47 +722,31 @@ def merge_sorted_iterables(operator, *iterables):
     [1, 2, 3, 4, 5]
     >>> list( merge_sorted_iterables( operator, [1, 4, 5], [2], [3] ) )
     [1, 2, 3, 4, 5]
+    >>> list( merge_sorted_iterables( lambda x: x[0], [(1, 'a'), (2, 'a')], [], [(1, 'c'), (3, 'c')], [(1, 'd')] ) )
+    [(1, 'a'), (1, 'c'), (1, 'd'), (2, 'a'), (3, 'c')]
     """
-    first_iterable = iterables[0]
-    if len(iterables) == 1:
-        for el in first_iterable:
-            yield el
-    else:
-        for el in __merge_two_sorted_iterables(
-            operator,
-            iter(first_iterable),
-            merge_sorted_iterables(operator, *iterables[1:])
-        ):
-            yield el
-
-
-def __merge_two_sorted_iterables(operator, iterable1, iterable2):
-    unset = object()
-    continue_merge = True
-    next_1 = unset
-    next_2 = unset
-    while continue_merge:
-        try:
-            if next_1 is unset:
-                next_1 = next(iterable1)
-            if next_2 is unset:
-                next_2 = next(iterable2)
-            if operator(next_2) < operator(next_1):
-                yield next_2
-                next_2 = unset
-            else:
-                yield next_1
-                next_1 = unset
-        except StopIteration:
-            continue_merge = False
-    if next_1 is not unset:
-        yield next_1
-    if next_2 is not unset:
-        yield next_2
-    for el in iterable1:
+    # Entries are (key, iterable index, element, iterator), the index breaks
+    # ties between keys so elements themselves are never compared.
+    heap = []
+    for index, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for el in iterator:
+            heap.append((operator(el), index, el, iterator))
+            break
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        _, index, el, iterator = heap[0]
         yield el
-    for el in iterable2:
+        for el in iterator:
+            heapq.heapreplace(heap, (operator(el), index, el, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+    if heap:
+        _, _, el, iterator = heap[0]
         yield el
+        for el in iterator:
+            yield el
 
 
 class Params(object):
@@ -7,6 +7,7 @@ from __future__ import absolute_import
 import hashlib
 import hmac
 import logging
+from multiprocessing.pool import ThreadPool
 
 from . import smart_str
 
@@ -21,8 +22,20 @@ sha = sha1
 md5 = hashlib.md5
 
 
-def memory_bound_hexdigest(hash_func, path=None, file=None):
-    hasher = hash_func()
+# Number of threads used by hash_files
+DEFAULT_HASH_THREADS = 4
+
+
+def memory_bound_hexdigest(hash_func, path=None, file=None, block_size=BLOCK_SIZE):
+    return memory_bound_hexdigests([hash_func], path=path, file=file, block_size=block_size)[0]
+
+
+def memory_bound_hexdigests(hash_funcs, path=None, file=None, block_size=BLOCK_SIZE):
+    """
+    Return the hexdigests of a file for each of `hash_funcs` (e.g. `md5`,
+    `sha1`), reading it once, `block_size` bytes at a time.
+    """
+    hashers = [hash_func() for hash_func in hash_funcs]
     if file is None:
         assert path is not None
         file = open(path, "rb")
@@ -30,9 +43,10 @@ def memory_bound_hexdigest(hash_func, path=None, file=None):
         assert path is None, "Cannot specify path and path keyword arguments."
 
     try:
-        for block in iter(lambda: file.read(BLOCK_SIZE), b''):
-            hasher.update(block)
-        return hasher.hexdigest()
+        for block in iter(lambda: file.read(block_size), b''):
+            for hasher in hashers:
+                hasher.update(block)
+        return [hasher.hexdigest() for hasher in hashers]
     finally:
         file.close()
 
@@ -41,17 +55,38 @@ def md5_hash_file(path):
     """
     Return a md5 hashdigest for a file or None if path could not be read.
     """
-    hasher = hashlib.md5()
     try:
-        with open(path, 'rb') as afile:
-            buf = afile.read()
-            hasher.update(buf)
-            return hasher.hexdigest()
+        return memory_bound_hexdigest(md5, path)
     except IOError:
         # This may happen if path has been deleted
         return None
 
 
+def hash_files(paths, hash_funcs=(md5, ), threads=DEFAULT_HASH_THREADS, block_size=BLOCK_SIZE):
+    """
+    Return a dict mapping each of `paths` to the list of its hexdigests for
+    `hash_funcs`, or to None if it could not be read.
+
+    Files are hashed by a pool of `threads` threads, hashlib and file reads
+    release the GIL so large files are hashed in parallel.
+    """
+    paths = list(paths)
+
+    def hexdigests(path):
+        try:
+            return memory_bound_hexdigests(hash_funcs, path=path, block_size=block_size)
+        except (IOError, OSError):
+            return None
+
+    if threads <= 1 or len(paths) <= 1:
+        return dict((path, hexdigests(path)) for path in paths)
+    pool = ThreadPool(min(threads, len(paths)))
+    try:
+        return dict(zip(paths, pool.map(hexdigests, paths)))
+    finally:
+        pool.terminate()
+
+
 def new_secure_hash(text_type=None):
     """
     Returns either a sha1 hash object (if called with no arguments), or a
@@ -75,4 +110,5 @@ def is_hashable(value):
     return True
 
 
-__all__ = ('md5', 'hashlib', 'sha1', 'sha', 'new_secure_hash', 'hmac_new', 'is_hashable')
+__all__ = ('md5', 'hashlib', 'sha1', 'sha', 'new_secure_hash', 'hmac_new', 'is_hashable', 'hash_files',
+           'memory_bound_hexdigests')
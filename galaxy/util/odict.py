@@ -1,11 +1,26 @@
 """
 Ordered dictionary implementation.
 """
+from bisect import bisect_left, insort
 
 from six.moves import UserDict
 dict_alias = dict
 
 
+class _Deleted(object):
+    """Marks the slot of a deleted key in ``odict._keys``."""
+
+    def __reduce__(self):
+        # Keep the marker a singleton through copy, deepcopy and pickle
+        return "_DELETED"
+
+    def __repr__(self):
+        return "_DELETED"
+
+
+_DELETED = _Deleted()
+
+
 class odict(UserDict):
     """
     http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/107747
@@ -13,31 +28,62 @@ class odict(UserDict):
     This dictionary class extends UserDict to record the order in which items are
     added. Calling keys(), values(), items(), etc. will return results in this
     order.
+
+    Keys are kept in a list along with a mapping of each key to its slot in
+    that list, so that setting, deleting, testing and replacing keys take
+    constant (amortized) time. Deleted keys leave a ``_DELETED`` marker in
+    their slot, the list is compacted once markers make up half of it.
+    Locating a key (``index``) is logarithmic in the number of markers. ``insert`` and ``reverse`` move keys to other slots,
+    the slots of the moved keys are refreshed when one of them is next
+    needed.
     """
 
     def __init__(self, dict=None):
         item = dict
         self._keys = []
-        if isinstance(item, dict_alias):
-            UserDict.__init__(self, item)
-        else:
-            UserDict.__init__(self, None)
-        if isinstance(item, list):
-            for (key, value) in item:
-                self[key] = value
+        self._slots = {}
+        # Sorted slots holding _DELETED
+        self._deleted = []
+        # Slots from this one on may be out of date, see _slot
+        self._stale_from = None
+        UserDict.__init__(self, None)
+        if isinstance(item, (dict_alias, list)):
+            self.update(item)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "_slots" not in state:
+            # Pickled by a version of odict without the slot index
+            self._slots = {}
+            self._deleted = []
+            self._stale_from = 0
 
     def __delitem__(self, key):
         UserDict.__delitem__(self, key)
-        self._keys.remove(key)
+        slot = self._slot(key)
+        del self._slots[key]
+        if slot == len(self._keys) - 1:
+            self._keys.pop()
+            while self._keys and self._keys[-1] is _DELETED:
+                self._keys.pop()
+                self._deleted.pop()
+        else:
+            self._keys[slot] = _DELETED
+            insort(self._deleted, slot)
+            if len(self._deleted) * 2 > len(self._keys):
+                self._compact()
 
     def __setitem__(self, key, item):
+        if key not in self.data:
+            self._append_key(key)
         UserDict.__setitem__(self, key, item)
-        if key not in self._keys:
-            self._keys.append(key)
 
     def clear(self):
         UserDict.clear(self)
         self._keys = []
+        self._slots = {}
+        self._deleted = []
+        self._stale_from = None
 
     def copy(self):
         new = odict()
@@ -45,51 +91,124 @@ class odict(UserDict):
         return new
 
     def items(self):
-        return zip(self._keys, self.values())
+        return zip(self.keys(), self.values())
 
     def keys(self):
+        if self._deleted:
+            self._compact()
         return self._keys[:]
 
     def popitem(self):
-        try:
-            key = self._keys[-1]
-        except IndexError:
+        if not self.data:
             raise KeyError('dictionary is empty')
+        key = self._keys[-1]
         val = self[key]
         del self[key]
         return (key, val)
 
     def setdefault(self, key, failobj=None):
-        if key not in self._keys:
-            self._keys.append(key)
-        return UserDict.setdefault(self, key, failobj)
+        if key not in self.data:
+            self[key] = failobj
+        return self[key]
 
     def update(self, dict):
-        for (key, val) in dict.items():
+        items = dict if isinstance(dict, list) else dict.items()
+        for (key, val) in items:
             self.__setitem__(key, val)
 
     def values(self):
-        return map(self.get, self._keys)
+        return map(self.get, self.keys())
 
     def iterkeys(self):
-        return iter(self._keys)
+        for key in self._keys:
+            if key is not _DELETED:
+                yield key
 
     def itervalues(self):
-        for key in self._keys:
+        for key in self.iterkeys():
             yield self.get(key)
 
     def iteritems(self):
-        for key in self._keys:
+        for key in self.iterkeys():
             yield key, self.get(key)
 
     def __iter__(self):
-        for key in self._keys:
-            yield key
+        return self.iterkeys()
 
     def reverse(self):
+        self._compact()
         self._keys.reverse()
+        self._mark_stale(0)
 
     def insert(self, index, key, item):
-        if key not in self._keys:
-            self._keys.insert(index, key)
+        if key not in self.data:
+            # Normalize index the way list.insert does
+            if index < 0:
+                index += len(self.data)
+            index = min(max(index, 0), len(self.data))
+            slot = self._index_slot(index)
+            if slot < len(self._keys) and self._keys[slot] is _DELETED:
+                # Reuse the slot of a deleted key, e.g. when a tool is reloaded
+                self._keys[slot] = key
+                del self._deleted[bisect_left(self._deleted, slot)]
+            else:
+                self._keys.insert(slot, key)
+                first_moved = bisect_left(self._deleted, slot)
+                self._deleted[first_moved:] = [deleted + 1 for deleted in self._deleted[first_moved:]]
+                self._mark_stale(slot)
+            self._slots[key] = slot
             UserDict.__setitem__(self, key, item)
+
+    def index(self, key):
+        """Return the position of ``key``, raise ``ValueError`` if missing."""
+        if key not in self.data:
+            raise ValueError("%r is not in odict" % (key, ))
+        slot = self._slot(key)
+        return slot - bisect_left(self._deleted, slot)
+
+    def replace(self, key, new_key, item):
+        """Replace ``key`` by ``new_key`` mapped to ``item`` at the same position.
+
+        If ``new_key`` is already present elsewhere, ``key`` is only deleted.
+        """
+        if new_key != key and new_key in self.data:
+            del self[key]
+            return
+        UserDict.__delitem__(self, key)
+        slot = self._slot(key)
+        del self._slots[key]
+        self._keys[slot] = new_key
+        self._slots[new_key] = slot
+        UserDict.__setitem__(self, new_key, item)
+
+    def _append_key(self, key):
+        self._slots[key] = len(self._keys)
+        self._keys.append(key)
+
+    def _slot(self, key):
+        slot = self._slots[key]
+        if self._stale_from is not None and slot >= self._stale_from:
+            keys = self._keys
+            self._slots.update(zip(keys[self._stale_from:], range(self._stale_from, len(keys))))
+            self._stale_from = None
+            slot = self._slots[key]
+        return slot
+
+    def _index_slot(self, index):
+        """Return the first slot preceded by ``index`` keys."""
+        slot = index
+        while True:
+            next_slot = index + bisect_left(self._deleted, slot)
+            if next_slot == slot:
+                return slot
+            slot = next_slot
+
+    def _mark_stale(self, start):
+        if self._stale_from is None or start < self._stale_from:
+            self._stale_from = start
+
+    def _compact(self):
+        if self._deleted:
+            self._keys = [key for key in self._keys if key is not _DELETED]
+            self._deleted = []
+            self._mark_stale(0)
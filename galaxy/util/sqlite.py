@@ -22,7 +22,7 @@ except ImportError:
         return False
 
 
-def connect(path):
-    connection = sqlite3.connect(path)
+def connect(path, **kwds):
+    connection = sqlite3.connect(path, **kwds)
     connection.row_factory = sqlite3.Row
     return connection
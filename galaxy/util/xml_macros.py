@@ -1,10 +1,17 @@
 import os
+import threading
 from copy import deepcopy
 from xml.etree import ElementInclude, ElementTree
 
 
 REQUIRED_PARAMETER = object()
 
+# Macro files shared by many tools are parsed once per process, keyed by path
+# and tool directory (imports are relative to the latter) and checked against
+# the modification time and size of the file and of the files it imports.
+_macro_file_cache = {}
+_macro_file_cache_lock = threading.Lock()
+
 
 def load_with_references(path):
     """Load XML documentation from file system and preprocesses XML macros.
@@ -115,16 +122,34 @@ def _expand_macros(elements, macros, tokens):
         return
 
     for element in elements:
-        while True:
-            expand_el = element.find('.//expand')
-            if expand_el is None:
-                break
-            _expand_macro(element, expand_el, macros, tokens)
-
+        _expand_macros_in_children(element, macros, tokens)
         _expand_tokens_for_el(element, tokens)
 
 
-def _expand_macro(element, expand_el, macros, tokens):
+def _expand_macros_in_children(parent, macros, tokens):
+    """Expand the macros below ``parent`` in a single pass in document order.
+
+    The content of an expanded macro has its own nested macros expanded
+    already, only ``expand`` elements at its top level (expanded after the
+    macro's tokens are substituted in them) are left to process.
+    """
+    index = 0
+    expanded_end = 0
+    while index < len(parent):
+        child = parent[index]
+        if child.tag == 'expand':
+            expanded_elements = _expand_macro(child, macros, tokens)
+            del parent[index]
+            for offset, expanded_el in enumerate(expanded_elements):
+                parent.insert(index + offset, expanded_el)
+            expanded_end = max(expanded_end, index + 1) + len(expanded_elements) - 1
+        else:
+            if index >= expanded_end:
+                _expand_macros_in_children(child, macros, tokens)
+            index += 1
+
+
+def _expand_macro(expand_el, macros, tokens):
     macro_name = expand_el.get('macro')
     macro_def = macros[macro_name]
     expanded_elements = deepcopy(macro_def.elements)
@@ -136,13 +161,7 @@ def _expand_macro(element, expand_el, macros, tokens):
     macro_tokens = macro_def.macro_tokens(expand_el)
     if macro_tokens:
         _expand_tokens(expanded_elements, macro_tokens)
-
-    # HACK for elementtree, newer implementations (etree/lxml) won't
-    # require this parent_map data structure but elementtree does not
-    # track parents or recongnize .find('..').
-    # TODO fix this now that we're not using elementtree
-    parent_map = dict((c, p) for p in element.iter() for c in p)
-    _xml_replace(expand_el, expanded_elements, parent_map)
+    return expanded_elements
 
 
 def _expand_yield_statements(macro_def, expand_el):
@@ -233,9 +252,32 @@ def _imported_macro_paths_from_el(macros_el):
 
 
 def _load_macro_file(path, xml_base_dir):
+    key = (path, xml_base_dir)
+    with _macro_file_cache_lock:
+        cached = _macro_file_cache.get(key)
+    if cached is not None:
+        stamps, macros, macro_paths = cached
+        if stamps == _file_stamps([path] + macro_paths):
+            # Callers insert the macros into their tree and expand tokens in place
+            return deepcopy(macros), list(macro_paths)
+    stamp = _file_stamps([path])
     tree = _parse_xml(path)
     root = tree.getroot()
-    return _load_macros(root, xml_base_dir)
+    macros, macro_paths = _load_macros(root, xml_base_dir)
+    if stamp is not None:
+        stamps = _file_stamps(macro_paths)
+        if stamps is not None:
+            with _macro_file_cache_lock:
+                _macro_file_cache[key] = (stamp + stamps, deepcopy(macros), list(macro_paths))
+    return macros, macro_paths
+
+
+def _file_stamps(paths):
+    try:
+        stats = [os.stat(path) for path in paths]
+    except OSError:
+        return None
+    return tuple((stat.st_mtime, stat.st_size) for stat in stats)
 
 
 def _xml_set_children(element, new_children):
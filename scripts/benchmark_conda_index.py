@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Time conda requirement resolution against ``galaxy.tools.deps.conda_index``.
+
+A synthetic channel is written as a local mirror. Resolving targets with
+``best_search_result`` against a ``CondaChannelIndex`` is compared to parsing
+and sorting ``conda search --json`` output for each target, which is what
+``best_search_result`` did for each target before (without counting the
+``conda search`` process itself, which takes seconds per call).
+
+Usage: python scripts/benchmark_conda_index.py [number_of_packages] [versions_per_package]
+"""
+from __future__ import print_function
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import packaging.version  # noqa: I100,E402
+
+from galaxy.tools.deps.conda_index import CondaChannelIndex  # noqa: I100,E402
+from galaxy.tools.deps.conda_util import best_search_result, CondaTarget  # noqa: E402
+
+SUBDIRS = ("linux-64", )
+
+
+def write_mirror(path, number_of_packages, versions_per_package):
+    records = {}
+    search_output = {}
+    for i in range(number_of_packages):
+        name = "package-%d" % i
+        hits = []
+        for j in range(versions_per_package):
+            version = "%d.%d.%d" % (j // 10, j % 10, i % 7)
+            record = {"name": name, "version": version, "build": "0", "build_number": 0, "channel": "mirror"}
+            records["%s-%s-0.tar.bz2" % (name, version)] = record
+            hits.append(record)
+        search_output[name] = json.dumps({name: hits})
+    os.makedirs(os.path.join(path, "linux-64"))
+    with open(os.path.join(path, "linux-64", "repodata.json"), "w") as f:
+        json.dump({"packages": records}, f)
+    return search_output
+
+
+def parse_search_output(target, search_output):
+    hits = json.loads(search_output[target.package]).get(target.package, [])
+    return sorted(hits, key=lambda hit: packaging.version.parse(hit['version']), reverse=True)
+
+
+def best_of(function, repeat=3):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main(argv):
+    number_of_packages = int(argv[1]) if len(argv) > 1 else 20000
+    versions_per_package = int(argv[2]) if len(argv) > 2 else 20
+    temp_directory = tempfile.mkdtemp()
+    try:
+        mirror = os.path.join(temp_directory, "mirror")
+        cache_directory = os.path.join(temp_directory, "cache")
+        search_output = write_mirror(mirror, number_of_packages, versions_per_package)
+        rand = random.Random(42)
+        targets = [CondaTarget("package-%d" % rand.randrange(number_of_packages), "1.%d.0" % rand.randrange(10)) for _ in range(2000)]
+
+        def new_index():
+            return CondaChannelIndex([mirror], cache_directory=cache_directory, subdirs=SUBDIRS)
+
+        def cold_load():
+            shutil.rmtree(cache_directory, ignore_errors=True)
+            new_index().search("^package-0$")
+
+        index = new_index()
+
+        def resolve_all():
+            for target in targets:
+                best_search_result(target, None, index=index)
+
+        def resolve_all_from_search_output():
+            for target in targets:
+                parse_search_output(target, search_output)
+
+        print("Channel with %d packages, %d versions each, resolving %d targets" % (number_of_packages, versions_per_package, len(targets)))
+        print("%-45s %10.4fs" % ("load index from mirror", best_of(cold_load)))
+        print("%-45s %10.4fs" % ("load index from cache", best_of(lambda: new_index().search("^package-0$"))))
+        first = best_of(lambda: (index._records.clear(), resolve_all()))
+        sorted_time = best_of(resolve_all)
+        search_time = best_of(resolve_all_from_search_output)
+        for name, elapsed in [("resolve, first lookups (sorting)", first),
+                              ("resolve, sorted packages", sorted_time),
+                              ("resolve, parsing search output", search_time)]:
+            print("%-45s %10.4fs %12d targets/s" % (name, elapsed, len(targets) / elapsed))
+    finally:
+        shutil.rmtree(temp_directory)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
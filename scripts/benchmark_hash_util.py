@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Time hashing files with ``galaxy.util.hash_util`` for various block sizes.
+
+Usage: python scripts/benchmark_hash_util.py [file_size_in_mb] [number_of_files]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from galaxy.util import hash_util  # noqa: I100,E402
+
+BLOCK_SIZES = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+HASH_FUNCS = [("md5", [hash_util.md5]), ("sha1", [hash_util.sha1]), ("sha256", [hash_util.sha256]),
+              ("md5+sha1+sha256", [hash_util.md5, hash_util.sha1, hash_util.sha256])]
+
+
+def best_of(function, repeat=3):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main(argv):
+    size_mb = int(argv[1]) if len(argv) > 1 else 256
+    number_of_files = int(argv[2]) if len(argv) > 2 else 8
+    temp_directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_directory, "data")
+        with open(path, "wb") as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+        print("Hashing a %d MB file" % size_mb)
+        print("%-18s" % "block size" + "".join("%18s" % name for name, _ in HASH_FUNCS))
+        for block_size in BLOCK_SIZES:
+            timings = [best_of(lambda: hash_util.memory_bound_hexdigests(funcs, path=path, block_size=block_size))
+                       for _, funcs in HASH_FUNCS]
+            print("%-18s" % ("%d KB" % (block_size // 1024)) + "".join("%17.3fs" % t for t in timings))
+        # Compare with one pass per digest, as separate memory_bound_hexdigest calls would do
+        separate = best_of(lambda: [hash_util.memory_bound_hexdigest(func, path=path) for func in HASH_FUNCS[-1][1]])
+        print("md5, sha1 and sha256 in separate passes: %.3fs" % separate)
+
+        paths = [path]
+        for i in range(1, number_of_files):
+            paths.append(os.path.join(temp_directory, "data_%d" % i))
+            shutil.copy(path, paths[-1])
+        print("Hashing %d files of %d MB with hash_files (md5)" % (number_of_files, size_mb))
+        for threads in [1, 2, 4, 8]:
+            print("%2d threads %17.3fs" % (threads, best_of(lambda: hash_util.hash_files(paths, threads=threads))))
+    finally:
+        shutil.rmtree(temp_directory)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
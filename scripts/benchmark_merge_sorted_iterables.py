@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Time ``galaxy.util.merge_sorted_iterables`` on many sorted record streams.
+
+Streams hold (timestamp, job_id, value) records like job metrics or log
+lines, sorted by timestamp.
+
+Usage: python scripts/benchmark_merge_sorted_iterables.py [number_of_records]
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from galaxy.util import merge_sorted_iterables  # noqa: I100,E402
+
+NUMBERS_OF_STREAMS = [2, 8, 64, 256, 512]
+
+
+def streams(number_of_records, number_of_streams, rand):
+    records = [[] for _ in range(number_of_streams)]
+    for i in range(number_of_records):
+        job_id = rand.randrange(number_of_streams)
+        records[job_id].append((rand.random(), job_id, i))
+    return [sorted(stream) for stream in records]
+
+
+def merge(sorted_streams):
+    count = 0
+    for _ in merge_sorted_iterables(lambda record: record[0], *[iter(stream) for stream in sorted_streams]):
+        count += 1
+    return count
+
+
+def main(argv):
+    number_of_records = int(argv[1]) if len(argv) > 1 else 200000
+    rand = random.Random(1)
+    print("Merging %d records" % number_of_records)
+    for number_of_streams in NUMBERS_OF_STREAMS:
+        sorted_streams = streams(number_of_records, number_of_streams, rand)
+        best = min(timeit.repeat(lambda: merge(sorted_streams), number=1, repeat=3))
+        print("%4d streams %10.3fs" % (number_of_streams, best))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Time building and updating a large tool panel (``galaxy.util.odict``).
+
+Usage: python scripts/benchmark_tool_panel.py [number_of_tools]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from galaxy.tools.toolbox.panel import ToolPanelElements  # noqa: I100,E402
+from galaxy.util.bunch import Bunch  # noqa: E402
+
+DEFAULT_NUMBER_OF_TOOLS = 10000
+
+
+def build(tools):
+    panel = ToolPanelElements()
+    for tool in tools:
+        panel.append_tool(tool)
+    return panel
+
+
+def locate(panel, tools):
+    for tool in tools:
+        panel.index_of_tool_id(tool.id)
+
+
+def replace(panel, tools):
+    for tool in tools:
+        panel.replace_tool(tool.id, tool.id + "_new", tool)
+        panel.replace_tool(tool.id + "_new", tool.id, tool)
+
+
+def remove_and_restore(panel, tools):
+    for tool in tools:
+        index = panel.index_of_tool_id(tool.id)
+        del panel["tool_%s" % tool.id]
+        panel.insert_tool(index, tool)
+
+
+def main(argv):
+    number_of_tools = int(argv[1]) if len(argv) > 1 else DEFAULT_NUMBER_OF_TOOLS
+    tools = [Bunch(id="tool_%d" % i) for i in range(number_of_tools)]
+    # Update a sample of tools spread over the panel
+    sample = tools[::max(number_of_tools // 100, 1)]
+    panel = build(tools)
+    timings = [
+        ("build panel", lambda: build(tools)),
+        ("index_of_tool_id (all tools)", lambda: locate(panel, tools)),
+        ("replace_tool (%d tools)" % len(sample), lambda: replace(panel, sample)),
+        ("delete and insert_tool (%d tools)" % len(sample), lambda: remove_and_restore(panel, sample)),
+    ]
+    print("Tool panel with %d tools" % number_of_tools)
+    for name, function in timings:
+        best = min(timeit.repeat(function, number=1, repeat=3))
+        print("%-40s %10.4fs" % (name, best))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
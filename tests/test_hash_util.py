@@ -0,0 +1,41 @@
+import hashlib
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from galaxy.util import hash_util
+
+
+def test_memory_bound_hexdigests():
+    temp_directory = mkdtemp()
+    try:
+        path = os.path.join(temp_directory, "data")
+        contents = os.urandom(100000)
+        with open(path, "wb") as f:
+            f.write(contents)
+        expected = [hashlib.md5(contents).hexdigest(), hashlib.sha256(contents).hexdigest()]
+        assert hash_util.memory_bound_hexdigests([hash_util.md5, hash_util.sha256], path=path, block_size=4096) == expected
+        assert hash_util.memory_bound_hexdigest(hash_util.md5, path=path) == expected[0]
+        assert hash_util.md5_hash_file(path) == expected[0]
+        assert hash_util.md5_hash_file(os.path.join(temp_directory, "missing")) is None
+    finally:
+        rmtree(temp_directory)
+
+
+def test_hash_files():
+    temp_directory = mkdtemp()
+    try:
+        paths = []
+        for i in range(10):
+            path = os.path.join(temp_directory, "data_%d" % i)
+            with open(path, "wb") as f:
+                f.write(("data %d" % i).encode())
+            paths.append(path)
+        missing = os.path.join(temp_directory, "missing")
+        for threads in [1, 4]:
+            hexdigests = hash_util.hash_files(paths + [missing], hash_funcs=[hash_util.sha1], threads=threads)
+            assert hexdigests[missing] is None
+            for i, path in enumerate(paths):
+                assert hexdigests[path] == [hashlib.sha1(("data %d" % i).encode()).hexdigest()]
+    finally:
+        rmtree(temp_directory)
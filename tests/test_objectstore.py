@@ -1,4 +1,6 @@
 import os
+import threading
+import time
 from contextlib import contextmanager
 from shutil import rmtree
 from string import Template
@@ -7,14 +9,29 @@ from uuid import uuid4
 from xml.etree import ElementTree
 
 import yaml
-from six import StringIO
+from six import BytesIO, StringIO
 
 from galaxy import objectstore
 from galaxy.exceptions import ObjectInvalid
 from galaxy.objectstore.azure_blob import AzureBlobObjectStore
+from galaxy.objectstore.caching import (
+    BlockCache,
+    CacheIndex,
+    download_atomically,
+    LocationCache,
+    MappedFileCache,
+    SingleFlight,
+    UploadQueue,
+)
 from galaxy.objectstore.cloud import Cloud
 from galaxy.objectstore.pithos import PithosObjectStore
+from galaxy.objectstore.placement import PlacementEngine, WeightedSampler
 from galaxy.objectstore.s3 import S3ObjectStore
+from galaxy.objectstore.transfers import (
+    MIN_PART_SIZE,
+    MultipartUploader,
+    MultipartUploadError,
+)
 from galaxy.util import directory_hash_id
 
 
@@ -58,6 +75,11 @@ def test_disk_store():
             assert object_store.exists(hello_world_dataset)
             assert not object_store.empty(hello_world_dataset)
 
+            # Test batched probing, datasets 2 and 3 share a directory
+            datasets = [absent_dataset, empty_dataset, hello_world_dataset, MockDataset(1001)]
+            assert object_store.exists_many(datasets) == [False, True, True, False]
+            assert object_store.size_many(datasets) == [0, 0, len("Hello World!"), 0]
+
             # Test get_data
             data = object_store.get_data(hello_world_dataset)
             assert data == "Hello World!"
@@ -65,6 +87,17 @@ def test_disk_store():
             data = object_store.get_data(hello_world_dataset, start=1, count=6)
             assert data == "ello W"
 
+            # Test get_data_view
+            view = object_store.get_data_view(hello_world_dataset, start=1, count=6)
+            assert bytes(view) == b"ello W"
+            assert bytes(object_store.get_data_view(hello_world_dataset)) == b"Hello World!"
+            assert bytes(object_store.get_data_view(empty_dataset)) == b""
+            view.release()
+            # Rewritten files are mapped again
+            directory.write("Goodbye World!", "files1/000/dataset_3.dat")
+            assert bytes(object_store.get_data_view(hello_world_dataset, count=7)) == b"Goodbye"
+            directory.write("Hello World!", "files1/000/dataset_3.dat")
+
             # Test Size
 
             # Test absent and empty datasets yield size of 0.
@@ -259,6 +292,12 @@ def test_hierarchical_store():
             directory.write("Hello World!", "files1/000/dataset_3.dat")
             assert object_store.exists(MockDataset(3))
             assert not object_store.empty(MockDataset(3))
+            assert bytes(object_store.get_data_view(MockDataset(3), start=6)) == b"World!"
+
+            # Test batched probing across backends.
+            datasets = [MockDataset(i) for i in [1, 2, 3]]
+            assert object_store.exists_many(datasets) == [False, True, True]
+            assert object_store.size_many(datasets) == [0, 0, len("Hello World!")]
 
             # Assert creation always happens in first backend.
             for i in range(100):
@@ -271,6 +310,80 @@ def test_hierarchical_store():
             _assert_key_has_value(as_dict, "type", "hierarchical")
 
 
+def test_nested_location_cache():
+    config_str = HIERARCHICAL_TEST_CONFIG.replace("<backends>", '<backends probe_threads="2" location_cache_size="10">')
+    with TestConfig(config_str) as (directory, object_store):
+        assert object_store.probe_threads == 2
+        # Missing objects are remembered until they are created
+        assert not object_store.exists(MockDataset(1))
+        directory.write("", "files1/000/dataset_1.dat")
+        assert not object_store.exists(MockDataset(1))
+        object_store.create(MockDataset(1))
+        assert object_store.exists(MockDataset(1))
+
+        # Found objects are looked up in the backend they were found in, other
+        # backends are checked again if they are no longer there
+        directory.write("", "files2/000/dataset_4.dat")
+        assert object_store.exists(MockDataset(4))
+        assert object_store.get_filename(MockDataset(4)).find("files2") > 0
+        os.remove(os.path.join(directory.temp_directory, "files2/000/dataset_4.dat"))
+        directory.write("", "files1/000/dataset_4.dat")
+        assert object_store.get_filename(MockDataset(4)).find("files1") > 0
+        assert object_store.exists_many([MockDataset(4), MockDataset(5)]) == [True, False]
+
+        object_store.delete(MockDataset(4))
+        assert not object_store.exists(MockDataset(4))
+        assert len(object_store.location_cache) <= 10
+        _assert_key_has_value(object_store.to_dict(), "probe_threads", 2)
+
+
+def test_mapped_file_cache():
+    directory = mkdtemp()
+    try:
+        paths = []
+        for i in range(3):
+            path = os.path.join(directory, "dataset_%d.dat" % i)
+            with open(path, "w") as f:
+                f.write("Dataset %d" % i)
+            paths.append(path)
+        mapped_files = MappedFileCache(max_files=0)
+        # Views stay valid when their mapping is evicted right away
+        view = mapped_files.view(paths[0], start=8)
+        assert bytes(view) == b"0"
+        view.release()
+        mapped_files = MappedFileCache(max_files=2)
+        views = [mapped_files.view(path) for path in paths]
+        assert [bytes(view) for view in views] == [b"Dataset 0", b"Dataset 1", b"Dataset 2"]
+        for view in views:
+            view.release()
+        mapped_files.close()
+    finally:
+        rmtree(directory)
+
+
+def test_location_cache():
+    cache = LocationCache(max_entries=3, negative_ttl=0.05)
+    cache.set(("Dataset", 1), "files1")
+    cache.set((("Dataset", 1), (("alt_name", "a.txt"),)), "files2")
+    assert cache.get(("Dataset", 1)) == (True, "files1")
+    cache.set(("Dataset", 2), None)
+    assert cache.get(("Dataset", 2)) == (True, None)
+    time.sleep(0.1)
+    # Negative entries expire
+    assert cache.get(("Dataset", 2)) == (False, None)
+
+    cache = LocationCache(max_entries=2)
+    cache.set((("Dataset", 1), ()), "files1")
+    cache.set((("Dataset", 1), (("extra_dir", "x"),)), "files1")
+    cache.set((("Dataset", 2), ()), "files2")
+    # Least recently used entry evicted
+    assert len(cache) == 2
+    assert cache.get((("Dataset", 1), ()))[0] is False
+    cache.invalidate(("Dataset", 1))
+    assert cache.get((("Dataset", 1), (("extra_dir", "x"),)))[0] is False
+    assert cache.get((("Dataset", 2), ())) == (True, "files2")
+
+
 DISTRIBUTED_TEST_CONFIG = """<?xml version="1.0"?>
 <object_store type="distributed">
     <backends>
@@ -329,6 +442,12 @@ def test_distributed_store():
             assert backend_2_count > 0
             assert backend_1_count > backend_2_count
 
+            datasets = [MockDataset(100 + i) for i in range(100)]
+            for dataset in datasets:
+                dataset.object_store_id = persisted_ids[dataset.id]
+            assert object_store.exists_many(datasets + [MockDataset(1)]) == [True] * 100 + [False]
+            assert object_store.size_many(datasets[:2]) == [0, 0]
+
             as_dict = object_store.to_dict()
             _assert_has_keys(as_dict, ["backends", "extra_dirs", "type"])
             _assert_key_has_value(as_dict, "type", "distributed")
@@ -337,6 +456,65 @@ def test_distributed_store():
             assert len(extra_dirs) == 2
 
 
+class MockSpaceBackend(object):
+
+    def __init__(self, total_bytes, free_bytes):
+        self.total_bytes = total_bytes
+        self.free_bytes = free_bytes
+
+    def get_store_space(self):
+        return self.total_bytes, self.free_bytes
+
+
+def test_weighted_sampler():
+    sampler = WeightedSampler(["a", "b", "c"], [1, 0, 3])
+    assert sampler.total == 4
+    assert sampler.sample(rand=lambda: 0.0) == "a"
+    assert sampler.sample(rand=lambda: 0.24) == "a"
+    assert sampler.sample(rand=lambda: 0.26) == "c"
+    assert sampler.sample(rand=lambda: 0.999) == "c"
+    sampler.update("a", 0)
+    assert sampler.sample(rand=lambda: 0.0) == "c"
+    sampler.update("c", 0)
+    assert sampler.sample() is None
+
+
+def test_placement_engine():
+    backends = {"small": MockSpaceBackend(1000, 500), "large": MockSpaceBackend(4000, 2000)}
+    engine = PlacementEngine(backends, {"small": 1, "large": 1}, {"small": 90, "large": 0}, poll_interval=120)
+    # Configured weights are used until usage is known
+    assert engine.effective_weight("small") == engine.effective_weight("large") == 1
+    engine.poll()
+    assert engine.percent_full("small") == 50.0
+    # Free bytes below the max_percent_full limit scale the weights, relative to their mean
+    assert abs(engine.effective_weight("small") - 400 / 1200.0) < 1e-9
+    assert abs(engine.effective_weight("large") - 2000 / 1200.0) < 1e-9
+
+    for _ in range(10):
+        assert engine.allocate() in backends
+    backends["small"].free_bytes = 200
+    engine.poll()
+    # Writes since the last poll are expected to continue, small has no room left for them
+    assert engine.effective_weight("small") == 0
+    assert all(engine.allocate() == "large" for _ in range(20))
+
+    backends["large"].free_bytes = 0
+    engine.poll()
+    assert engine.allocate() is None
+
+    # Backends equally full get writes proportional to their free bytes
+    backends = {"small": MockSpaceBackend(1000, 500), "large": MockSpaceBackend(100000, 50000)}
+    engine = PlacementEngine(backends, {"small": 1, "large": 1}, {}, poll_interval=120)
+    engine.poll()
+    assert abs(engine.effective_weight("large") / engine.effective_weight("small") - 100) < 1e-9
+    # In-flight objects are part of the measured write rate, not counted on top of it
+    usage = engine._usage["large"]
+    usage.write_rate, usage.object_size, usage.in_flight = 10.0, 100.0, 5
+    assert engine._projected("large") == 50000 - 1200
+    usage.in_flight = 20
+    assert engine._projected("large") == 50000 - 2000
+
+
 # Unit testing the cloud and advanced infrastructure object stores is difficult, but
 # we can at least stub out initializing and test the configuration of these things from
 # XML and dicts.
@@ -508,6 +686,92 @@ def test_config_parse_s3():
             assert len(extra_dirs) == 2
 
 
+def test_s3_parallel_download():
+    with TestConfig(S3_TEST_CONFIG, clazz=UnitializeS3ObjectStore) as (directory, object_store):
+        contents = os.urandom(1024 * 10 + 7)
+        object_store.bucket = MockS3Bucket({"000/dataset_1.dat": contents})
+        object_store.download_threads = 4
+        cache_path = os.path.join(directory.temp_directory, "dataset_1.dat")
+        key = object_store.bucket.get_key("000/dataset_1.dat")
+        assert object_store._download_parts(key, cache_path, 1024)
+        with open(cache_path, "rb") as f:
+            assert f.read() == contents
+
+        # A truncated range response must not leave a partial file behind.
+        object_store.bucket.truncate_reads = True
+        assert not object_store._download_parts(key, cache_path, 1024)
+        assert not os.path.exists(cache_path)
+
+
+def test_s3_exists_many_upload_pending():
+    with TestConfig(S3_TEST_CONFIG, clazz=UnitializeS3ObjectStore) as (directory, object_store):
+        object_store.staging_path = directory.temp_directory
+        pushed = []
+        object_store._push_to_os = lambda rel_path, source_file=None: pushed.append(rel_path)
+        object_store._list_remote_sizes = lambda prefix: {}
+        object_store.upload_queue = UploadQueue(object_store.staging_path, lambda rel_path, source_file: True, workers=0)
+        try:
+            directory.write("queued", "000/dataset_1.dat")
+            object_store.upload_queue.enqueue("000/dataset_1.dat", os.path.join(object_store.staging_path, "000/dataset_1.dat"))
+            # Queued objects exist without being pushed again synchronously
+            assert object_store.exists_many([MockDataset(1)]) == [True]
+            assert pushed == []
+        finally:
+            object_store.upload_queue.shutdown()
+
+
+def test_s3_get_data_ranges_in_bytes():
+    with TestConfig(S3_TEST_CONFIG, clazz=UnitializeS3ObjectStore) as (directory, object_store):
+        object_store.staging_path = directory.temp_directory
+        contents = u"h\u00e9llo w\u00f6rld".encode("utf-8")
+        object_store._fetch_remote_range = lambda rel_path, start, end: contents[start:end + 1]
+        cache_path = object_store._get_cache_path("000/dataset_1.dat")
+        os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path, "wb") as f:
+            f.write(contents)
+        # Cached and remote reads agree on offsets past multi-byte characters
+        for start, count in [(0, 4), (3, 5), (2, 1), (7, 3)]:
+            cached = object_store._get_cached_data("000/dataset_1.dat", start, count)
+            assert cached == object_store._get_remote_data("000/dataset_1.dat", start, count)
+        assert object_store._get_cached_data("000/dataset_1.dat", 3, 5) == "llo w"
+        assert object_store._get_cached_data("000/dataset_1.dat", 10, -1) == "rld"
+
+
+class MockS3Bucket(object):
+
+    def __init__(self, contents):
+        self.name = "mock_bucket"
+        self.contents = contents
+        self.truncate_reads = False
+
+    def get_key(self, name):
+        return self.new_key(name)
+
+    def new_key(self, name):
+        return MockS3Key(self, name)
+
+
+class MockS3Key(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = len(bucket.contents[name])
+        self.data = None
+
+    def open_read(self, headers=None):
+        start, end = headers["Range"][len("bytes="):].split("-")
+        self.data = BytesIO(self.bucket.contents[self.name][int(start):int(end) + 1])
+        if self.bucket.truncate_reads:
+            self.data = BytesIO(self.data.getvalue()[:-1])
+
+    def read(self, size=0):
+        return self.data.read(size)
+
+    def close(self):
+        self.data = None
+
+
 CLOUD_TEST_CONFIG = """<object_store type="cloud">
      <auth access_key="access_moo" secret_key="secret_cow" />
      <bucket name="unique_bucket_name_all_lowercase" use_reduced_redundancy="False" />
@@ -559,6 +823,8 @@ def test_config_parse_cloud():
             assert object_store.staging_path == "database/object_store_cache"
             assert object_store.extra_dirs["job_work"] == "database/job_working_directory_cloud"
             assert object_store.extra_dirs["temp"] == "database/tmp_cloud"
+            assert object_store.write_behind is False
+            assert object_store.upload_threads == 2
 
             as_dict = object_store.to_dict()
             _assert_has_keys(as_dict, ["auth", "bucket", "connection", "cache", "extra_dirs", "type"])
@@ -583,6 +849,7 @@ def test_config_parse_cloud():
 
             _assert_key_has_value(cache_dict, "size", 1000)
             _assert_key_has_value(cache_dict, "path", "database/object_store_cache")
+            _assert_key_has_value(cache_dict, "write_behind", False)
 
             extra_dirs = as_dict["extra_dirs"]
             assert len(extra_dirs) == 2
@@ -656,6 +923,270 @@ def test_config_parse_azure():
             assert len(extra_dirs) == 2
 
 
+def test_cache_index():
+    staging_path = mkdtemp()
+    try:
+        pre_existing = os.path.join(staging_path, "000", "dataset_1.dat")
+        os.makedirs(os.path.dirname(pre_existing))
+        open(pre_existing, "w").write("Hello")
+        # A new index picks up files already in the cache.
+        cache_index = CacheIndex(staging_path)
+        assert cache_index.total_size() == 5
+
+        cache_index.touch("000/dataset_2.dat", size=10)
+        cache_index.touch("000/dataset_3_files/a.txt", size=20)
+        cache_index.touch("000/dataset_3_files/b.txt", size=30)
+        assert cache_index.total_size() == 65
+
+        # Access dataset 1 again so dataset 2 becomes least recently used.
+        cache_index.touch("000/dataset_1.dat")
+        popped = cache_index.pop_least_recently_used(5)
+        assert popped == [("000/dataset_2.dat", 10)], popped
+        assert cache_index.total_size() == 55
+
+        # Accesses within the touch interval are not written again
+        a_path = os.path.normpath("000/dataset_3_files/a.txt")
+        cache_index._connection.execute("UPDATE cache_entries SET atime = 0 WHERE path = ?", (a_path,))
+        cache_index.touch(a_path)
+        assert cache_index.pop_least_recently_used(1) == [(a_path, 20)]
+        cache_index.touch(a_path, size=20)
+        cache_index._connection.execute("UPDATE cache_entries SET atime = 0 WHERE path = ?", (a_path,))
+        cache_index.touch_interval = 0
+        cache_index.touch(a_path)
+        assert cache_index.pop_least_recently_used(1) == [(os.path.normpath("000/dataset_3_files/b.txt"), 30)]
+
+        cache_index.remove_dir("000/dataset_3_files")
+        assert cache_index.total_size() == 5
+        cache_index.remove("000/dataset_1.dat")
+        assert cache_index.total_size() == 0
+        assert cache_index.pop_least_recently_used(100) == []
+        cache_index.close()
+    finally:
+        rmtree(staging_path)
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def pull(key):
+        calls.append(key)
+        started.set()
+        release.wait()
+        return key.upper()
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(single_flight.do("a", pull, "a")))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(single_flight.do("a", pull, "a"))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    # Give the followers a chance to block on the call in flight.
+    time.sleep(.2)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert calls == ["a"]
+    assert results == ["A"] * 4
+    # Once completed the next call for a key runs again.
+    assert single_flight.do("a", pull, "a") == "A"
+    assert calls == ["a", "a"]
+
+
+def test_download_atomically():
+    cache_dir = mkdtemp()
+    try:
+        cache_path = os.path.join(cache_dir, "dataset_1.dat")
+
+        def failed_download(path):
+            open(path, "w").write("Hel")
+            assert not os.path.exists(cache_path)
+            return False
+
+        assert not download_atomically(failed_download, cache_path)
+        assert os.listdir(cache_dir) == []
+
+        def download(path):
+            open(path, "w").write("Hello")
+            return True
+
+        assert download_atomically(download, cache_path)
+        assert os.listdir(cache_dir) == ["dataset_1.dat"]
+        assert open(cache_path).read() == "Hello"
+    finally:
+        rmtree(cache_dir)
+
+
+def test_upload_queue():
+    staging_path = mkdtemp()
+    try:
+        source_file = os.path.join(staging_path, "dataset_1.dat")
+        open(source_file, "w").write("Hello")
+        uploaded = []
+        failures = [True]
+
+        def upload(rel_path, source_file):
+            if failures:
+                failures.pop()
+                return False
+            uploaded.append(rel_path)
+            return True
+
+        # Pending uploads survive a shutdown...
+        upload_queue = UploadQueue(staging_path, upload, workers=0)
+        upload_queue.enqueue("000/dataset_1.dat", source_file)
+        upload_queue.enqueue("000/dataset_2.dat", os.path.join(staging_path, "missing.dat"))
+        assert upload_queue.is_pending("000/dataset_1.dat")
+        upload_queue.shutdown()
+        upload_queue = UploadQueue(staging_path, upload, workers=0)
+        assert upload_queue.pending_count() == 2
+        upload_queue.shutdown()
+
+        # ... and are retried after a failure once the queue is started with workers.
+        upload_queue = UploadQueue(staging_path, upload, workers=2, backoff=.1)
+        for _ in range(50):
+            if not upload_queue.pending_count():
+                break
+            time.sleep(.1)
+        assert upload_queue.pending_count() == 0
+        # Uploads whose source file vanished are dropped.
+        assert uploaded == ["000/dataset_1.dat"]
+        upload_queue.shutdown()
+    finally:
+        rmtree(staging_path)
+
+
+def test_multipart_uploader():
+    staging_path = mkdtemp()
+    try:
+        source_file = os.path.join(staging_path, "dataset_1.dat")
+        contents = os.urandom(MIN_PART_SIZE * 3 + 11)
+        open(source_file, "wb").write(contents)
+        state_dir = os.path.join(staging_path, "state")
+        uploader = MultipartUploader(MIN_PART_SIZE, threads=2, attempts=2, backoff=0, state_dir=state_dir)
+
+        # Part 2 fails on every attempt, the upload fails but can be resumed.
+        target = MockUploadTarget(failing_parts={2: 2})
+        try:
+            uploader.upload(target, source_file)
+            raise AssertionError("Upload should have failed")
+        except MultipartUploadError:
+            pass
+        assert not target.completed
+        assert sorted(target.parts) == [1, 3, 4]
+        assert os.listdir(state_dir)
+
+        # The second run only sends the missing part.
+        target.failing_parts = {}
+        uploader.upload(target, source_file)
+        assert target.completed
+        assert target.initiated == 1
+        assert target.sends[2] == 3 and target.sends[1] == 1
+        assert b"".join(target.parts[i] for i in sorted(target.parts)) == contents
+        assert not os.listdir(state_dir)
+        assert uploader.stats.transfers == 1
+        assert uploader.stats.bytes_per_second > 0
+
+        # Once its resumes are used up a failing upload is aborted for good.
+        uploader.resumes = 1
+        target = MockUploadTarget(failing_parts={2: 4})
+        for _ in range(2):
+            try:
+                uploader.upload(target, source_file)
+                raise AssertionError("Upload should have failed")
+            except MultipartUploadError:
+                pass
+            assert target.initiated == 1
+        assert target.aborted == ["upload-1"]
+        assert not os.listdir(state_dir)
+
+        # Discarding a resumable upload aborts it and drops its state.
+        target = MockUploadTarget(failing_parts={2: 2})
+        try:
+            uploader.upload(target, source_file)
+        except MultipartUploadError:
+            pass
+        assert os.listdir(state_dir)
+        uploader.discard(target)
+        assert target.aborted == ["upload-1"]
+        assert not os.listdir(state_dir)
+
+        # Small files and targets without multipart support use one request.
+        single_target = MockUploadTarget()
+        single_target.supports_multipart = False
+        uploader.upload(single_target, source_file)
+        assert single_target.whole == contents
+    finally:
+        rmtree(staging_path)
+
+
+class MockUploadTarget(object):
+    name = "000/dataset_1.dat"
+    supports_multipart = True
+
+    def __init__(self, failing_parts=None):
+        self.failing_parts = failing_parts or {}
+        self.parts = {}
+        self.sends = {}
+        self.initiated = 0
+        self.completed = False
+        self.whole = None
+        self.aborted = []
+
+    def upload_file(self, source_file):
+        self.whole = open(source_file, "rb").read()
+
+    def initiate(self):
+        self.initiated += 1
+        return "upload-%d" % self.initiated
+
+    def upload_part(self, upload_id, part_number, fh, size):
+        self.sends[part_number] = self.sends.get(part_number, 0) + 1
+        if self.failing_parts.get(part_number):
+            self.failing_parts[part_number] -= 1
+            raise IOError("Connection reset")
+        self.parts[part_number] = fh.read(size)
+
+    def uploaded_parts(self, upload_id):
+        return list(self.parts.keys())
+
+    def complete(self, upload_id):
+        self.completed = True
+
+    def abort(self, upload_id):
+        self.aborted.append(upload_id)
+        self.parts = {}
+
+
+def test_block_cache():
+    contents = b"".join(b"%03d" % i for i in range(100))
+    fetches = []
+
+    def fetch(start, end):
+        fetches.append((start, end))
+        return contents[start:end + 1]
+
+    block_cache = BlockCache(block_size=16, max_size=64)
+    assert block_cache.read("a", 5, 20, fetch) == contents[5:25]
+    assert fetches == [(0, 31)]
+    # Served from the cached blocks.
+    assert block_cache.read("a", 0, 32, fetch) == contents[0:32]
+    assert len(fetches) == 1
+    # Only the missing blocks are fetched, reads past the end are truncated.
+    assert block_cache.read("a", 290, 100, fetch) == contents[290:]
+    assert fetches[-1] == (288, 399)
+    assert block_cache.read("a", 295, 100, fetch) == contents[295:]
+    assert len(fetches) == 2
+    # The cache is bounded and invalidated per path.
+    assert len(block_cache._blocks) <= 4
+    block_cache.invalidate("a")
+    assert block_cache.read("a", 290, 4, fetch) == contents[290:294]
+    assert len(fetches) == 3
+
+
 class TestConfig(object):
     def __init__(self, config_str, clazz=None):
         self.temp_directory = mkdtemp()
@@ -0,0 +1,99 @@
+import copy
+import pickle
+import random
+
+from galaxy.util.odict import odict
+
+
+def test_odict_order():
+    d = odict([("b", 1), ("a", 2)])
+    d["c"] = 3
+    d["b"] = 4
+    assert d.keys() == ["b", "a", "c"]
+    assert list(d.values()) == [4, 2, 3]
+    assert list(d.iteritems()) == [("b", 4), ("a", 2), ("c", 3)]
+    d.insert(1, "d", 5)
+    d.insert(0, "a", 6)
+    assert d.keys() == ["b", "d", "a", "c"]
+    assert d["a"] == 2
+    del d["d"]
+    assert list(d) == ["b", "a", "c"]
+    assert d.index("c") == 2
+    d.reverse()
+    assert d.keys() == ["c", "a", "b"]
+    assert d.popitem() == ("b", 4)
+    assert d.setdefault("e", 7) == 7
+    assert d.setdefault("e", 8) == 7
+    assert d.keys() == ["c", "a", "e"]
+    assert d.copy().keys() == d.keys()
+    assert copy.deepcopy(d).keys() == d.keys()
+    try:
+        d.index("b")
+        raise AssertionError("index of missing key should raise")
+    except ValueError:
+        pass
+
+
+def test_odict_against_list():
+    rand = random.Random(42)
+    d = odict()
+    keys = []
+    for _ in range(5000):
+        key = rand.randint(0, 200)
+        operation = rand.random()
+        if operation < 0.5:
+            d[key] = key
+            if key not in keys:
+                keys.append(key)
+        elif operation < 0.8:
+            if key in keys:
+                del d[key]
+                keys.remove(key)
+        elif operation < 0.95:
+            index = rand.randint(-5, len(keys) + 5)
+            d.insert(index, key, key)
+            if key not in keys:
+                keys.insert(index, key)
+        else:
+            d.reverse()
+            keys.reverse()
+        if key in keys:
+            assert d.index(key) == keys.index(key)
+        assert list(d) == keys
+    assert d.keys() == keys
+    assert pickle.loads(pickle.dumps(d)).keys() == keys
+
+
+def test_odict_insert_then_delete():
+    d = odict()
+    d["x"] = 1
+    d["y"] = 2
+    d.insert(0, "z", 3)
+    del d["x"]
+    assert list(d.iterkeys()) == ["z", "y"]
+    assert d.keys() == ["z", "y"]
+
+
+def test_odict_insert_delete_against_list():
+    for seed in range(300):
+        rand = random.Random(seed)
+        d = odict()
+        keys = []
+        for _ in range(50):
+            key = rand.randint(0, 15)
+            operation = rand.random()
+            if operation < 0.3:
+                d[key] = key
+                if key not in keys:
+                    keys.append(key)
+            elif operation < 0.6:
+                index = rand.randint(0, len(keys))
+                d.insert(index, key, key)
+                if key not in keys:
+                    keys.insert(index, key)
+            elif key in keys:
+                del d[key]
+                keys.remove(key)
+            assert list(d.iterkeys()) == keys
+            assert sorted(d.data) == sorted(keys)
+        assert d.keys() == keys
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import threading
+from shutil import rmtree
+
+import packaging.version
+
+from galaxy.tools.deps.conda_util import (
+    CondaEnvironmentPool,
+    CondaTarget,
+)
+
+
+def test_environments_are_shared():
+    with _FakeCondaContext() as conda_context:
+        pool = CondaEnvironmentPool(os.path.join(conda_context.conda_prefix, "envs_pool"), conda_context)
+        target = CondaTarget("samtools", "1.3")
+        job_envs = [os.path.join(conda_context.conda_prefix, "jobs", str(i), "conda-env") for i in range(4)]
+        threads = [threading.Thread(target=pool.acquire, args=(target, job_env)) for job_env in job_envs]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        assert len(conda_context.created) == 1
+        key = pool.environment_key([target])
+        assert all(os.readlink(job_env) == pool.environment_path(key) for job_env in job_envs)
+        assert pool.reference_count(key) == 4
+        assert pool.environment_key([CondaTarget("samtools", "1.4")]) != key
+        assert pool.environment_key([target], copy=True) != key
+
+        # Removing job directories releases their references
+        rmtree(os.path.dirname(job_envs[0]))
+        assert pool.reference_count(key) == 3
+        assert pool.prune() == []
+        [rmtree(os.path.dirname(job_env)) for job_env in job_envs[1:]]
+        assert pool.prune() == [key]
+        assert not os.path.exists(pool.environment_path(key))
+
+        # Pruned environments are rebuilt on demand
+        pool.acquire(target, job_envs[0])
+        assert len(conda_context.created) == 2
+        assert os.path.isdir(job_envs[0])
+
+
+def test_failed_builds_are_not_pooled():
+    with _FakeCondaContext(exit_code=1) as conda_context:
+        pool = CondaEnvironmentPool(os.path.join(conda_context.conda_prefix, "envs_pool"), conda_context)
+        target = CondaTarget("samtools", "1.3")
+        job_env = os.path.join(conda_context.conda_prefix, "jobs", "1", "conda-env")
+        assert pool.acquire(target, job_env) == (job_env, 1)
+        assert not os.path.lexists(job_env)
+        assert not os.path.exists(pool.environment_path(pool.environment_key([target])))
+
+
+class _FakeCondaContext(object):
+    conda_version = packaging.version.parse("4.3.33")
+
+    def __init__(self, exit_code=0):
+        self.exit_code = exit_code
+        self.created = []
+
+    def __enter__(self):
+        self.conda_prefix = tempfile.mkdtemp()
+        return self
+
+    def __exit__(self, *args):
+        rmtree(self.conda_prefix)
+
+    def env_path(self, env_name):
+        return os.path.join(self.conda_prefix, "envs", env_name)
+
+    def export_list(self, name, path):
+        open(path, "w").close()
+        return 0
+
+    def exec_create(self, args, stdout_path=None):
+        path = args[args.index("--prefix") + 1]
+        self.created.append(path)
+        os.makedirs(os.path.join(path, "conda-meta"))
+        return self.exit_code
+
+    def exec_clean(self, quiet=False):
+        return 0
@@ -0,0 +1,154 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from shutil import rmtree
+
+from galaxy.tools.deps import conda_index
+from galaxy.tools.deps.conda_index import (
+    CondaChannelIndex,
+    platform_subdir,
+)
+from galaxy.tools.deps.conda_util import (
+    best_search_result,
+    CondaContext,
+    CondaInstallPlanner,
+    CondaTarget,
+)
+from galaxy.tools.deps.mulled.mulled_build import conda_versions
+
+SUBDIRS = ("linux-64", "noarch")
+
+
+def test_local_mirror():
+    with _temp_directory() as directory:
+        mirror = _write_channel(directory, "mirror", {
+            "linux-64": [("samtools", "1.3.1", "0", 0), ("samtools", "1.10", "0", 0), ("samtools", "1.3.1", "1", 1)],
+            "noarch": [("multiqc", "1.5", "py_0", 0)],
+        })
+        other = _write_channel(directory, "other", {"linux-64": [("samtools", "1.10", "h1", 0), ("bwa", "0.7.17", "0", 0)]})
+        index = CondaChannelIndex([mirror, other], cache_directory=os.path.join(directory, "cache"), subdirs=SUBDIRS, offline=True)
+        records = index.records("samtools")
+        assert [(r.version, r.build, r.channel) for r in records] == [
+            ("1.10", "0", mirror), ("1.10", "h1", other), ("1.3.1", "1", mirror), ("1.3.1", "0", mirror),
+        ]
+        assert index.versions("samtools") == ["1.10", "1.3.1"]
+        assert index.search("sam|qc") == ["multiqc", "samtools"]
+        assert "bwa" in index and "missing" not in index
+        assert index.get("missing") is None
+
+        hit, exact = best_search_result(CondaTarget("samtools", "1.3.1"), None, index=index)
+        assert (hit["version"], hit["build"], exact) == ("1.3.1", "1", True)
+        assert best_search_result(CondaTarget("samtools"), None, index=index)[0]["version"] == "1.10"
+
+
+def test_cache_ttl_and_offline():
+    with _temp_directory() as directory:
+        channel = _write_channel(directory, "channel", {"linux-64": [("bwa", "0.7.15", "0", 0)]})
+        cache_directory = os.path.join(directory, "cache")
+        index = CondaChannelIndex([channel], cache_directory=cache_directory, subdirs=SUBDIRS)
+        assert index.versions("bwa") == ["0.7.15"]
+        _write_channel(directory, "channel", {"linux-64": [("bwa", "0.7.15", "0", 0), ("bwa", "0.7.17", "0", 0)]})
+        # Still within the TTL of the in-memory and cached index
+        assert index.versions("bwa") == ["0.7.15"]
+        assert CondaChannelIndex([channel], cache_directory=cache_directory, subdirs=SUBDIRS).versions("bwa") == ["0.7.15"]
+        assert CondaChannelIndex([channel], cache_directory=cache_directory, subdirs=SUBDIRS, channel_ttls={channel: 0}).versions("bwa") == ["0.7.17", "0.7.15"]
+        index.refresh()
+        assert index.versions("bwa") == ["0.7.17", "0.7.15"]
+
+        # Unreachable channels are served from their cache
+        remote = "http://127.0.0.1:1/remote"
+        cached_path = CondaChannelIndex([remote], cache_directory=cache_directory)._cache_path(remote, "linux-64")
+        os.makedirs(os.path.dirname(cached_path))
+        with open(cached_path, "w") as f:
+            json.dump({"bwa": [["0.7.12", "1", 1]]}, f)
+        offline = CondaChannelIndex([remote], cache_directory=cache_directory, subdirs=("linux-64", ), offline=True)
+        assert offline.versions("bwa") == ["0.7.12"]
+        stale = CondaChannelIndex([remote], cache_directory=cache_directory, subdirs=("linux-64", ), ttl=0)
+        assert stale.versions("bwa") == ["0.7.12"]
+
+
+def test_platform_subdir():
+    assert platform_subdir("linux", "x86_64") in ("linux-64", "linux-32")
+    assert platform_subdir("linux2", "aarch64") == "linux-aarch64"
+    assert platform_subdir("linux", "arm64") == "linux-aarch64"
+    assert platform_subdir("linux", "ppc64le") == "linux-ppc64le"
+    assert platform_subdir("darwin", "arm64") == "osx-arm64"
+    assert platform_subdir("win32", "AMD64").startswith("win-")
+
+
+def test_context_channel_index():
+    with _temp_directory() as directory:
+        condarc = os.path.join(directory, "condarc")
+        with open(condarc, "w") as f:
+            f.write("channel_alias: https://mirror.example.org/conda\n")
+        conda_context = CondaContext(conda_prefix=directory, conda_exec="conda", ensure_channels="bioconda", condarc_override=condarc)
+        index = CondaChannelIndex(["bioconda"], channel_alias=conda_context.channel_alias)
+        assert index._channel_url("bioconda") == "https://mirror.example.org/conda/bioconda/"
+        assert CondaContext(conda_prefix=directory, conda_exec="conda").channel_alias == "https://conda.anaconda.org/"
+        # Disabled by default
+        assert conda_context.channel_index() is None
+
+        mirror = _write_channel(directory, "mirror", {"linux-64": [("bwa", "0.7.17", "0", 0)]})
+        conda_context = CondaContext(conda_prefix=directory, conda_exec="conda", ensure_channels=[mirror], use_channel_index=True)
+        index = conda_context.channel_index()
+        assert index.versions("bwa") == ["0.7.17"]
+        assert conda_context.channel_index() is index
+        # conda create cannot reuse the repodata cache of conda search then
+        plan = CondaInstallPlanner(conda_context).plan({"__bwa@0.7.17": [CondaTarget("bwa", "0.7.17")]}, index=index)
+        assert list(plan.environments) == ["__bwa@0.7.17"]
+        assert not plan.use_index_cache
+
+        # Channels that cannot be loaded fall back to conda search
+        remote = "http://127.0.0.1:1/remote"
+        conda_context = CondaContext(conda_prefix=directory, conda_exec="conda", ensure_channels=[mirror, remote], use_channel_index=True)
+        assert conda_context.channel_index() is None
+
+
+def test_failed_load_retried():
+    with _temp_directory() as directory:
+        remote = "http://127.0.0.1:1/remote"
+        index = CondaChannelIndex([remote], cache_directory=os.path.join(directory, "cache"), subdirs=SUBDIRS)
+        assert not index.loaded()
+        assert index.get("bwa") is None
+        assert remote in index._failed_channels
+        assert not os.path.exists(index._cache_path(remote, "linux-64"))
+        # Not fetched again until FAILED_LOAD_RETRY passed
+        failed_at = index._failed_channels[remote] = index._failed_channels[remote] - 1
+        assert not index.loaded()
+        assert index._failed_channels[remote] == failed_at
+        index._failed_channels[remote] -= conda_index.FAILED_LOAD_RETRY
+        assert not index.loaded()
+        assert index._failed_channels[remote] > failed_at
+
+
+def test_conda_versions():
+    with _temp_directory() as directory:
+        channel = _write_channel(directory, "channel", {"linux-64": [("bwa", "0.7.15", "0", 0), ("bwa", "0.7.17", "1", 1), ("samtools", "1.9", "0", 0)]})
+        repodata = os.path.join(channel, "linux-64", "repodata.json")
+        assert conda_versions("bwa", repodata) == ["0.7.17--1", "0.7.15--0"]
+
+
+def _write_channel(directory, name, subdirs):
+    channel = os.path.join(directory, name)
+    for subdir, packages in subdirs.items():
+        subdir_path = os.path.join(channel, subdir)
+        if not os.path.exists(subdir_path):
+            os.makedirs(subdir_path)
+        records = {}
+        for package, version, build, build_number in packages:
+            records["%s-%s-%s.tar.bz2" % (package, version, build)] = {
+                "name": package, "version": version, "build": build, "build_number": build_number,
+            }
+        with open(os.path.join(subdir_path, "repodata.json"), "w") as f:
+            json.dump({"info": {"subdir": subdir}, "packages": records}, f)
+    return channel
+
+
+@contextmanager
+def _temp_directory():
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        rmtree(directory)
@@ -0,0 +1,78 @@
+import threading
+
+from galaxy.tools.deps.conda_util import (
+    best_search_result,
+    CondaInstallPlanner,
+    CondaTarget,
+)
+
+INDEX = {
+    "samtools": [{"version": "1.3.1"}, {"version": "1.4"}],
+    "bwa": [{"version": "0.7.15"}],
+}
+
+
+def test_plan_and_install():
+    conda_context = _FakeCondaContext(installed=["__bwa@0.7.15"], failing=["__samtools@1.4"])
+    progress = []
+    planner = CondaInstallPlanner(conda_context, workers=2, progress_callback=lambda *args: progress.append(args))
+    environments = {
+        "__bwa@0.7.15": [CondaTarget("bwa", "0.7.15")],
+        "__samtools@1.3": [CondaTarget("samtools", "1.3")],
+        "__samtools@1.4": [CondaTarget("samtools", "1.4")],
+        "__samtools@_uv_": [CondaTarget("samtools")],
+        "__samtools@2.0": [CondaTarget("samtools", "2.0")],
+        "__missing@_uv_": [CondaTarget("missing")],
+    }
+    plan = planner.plan(environments, index=INDEX)
+    assert plan.installed == ["__bwa@0.7.15"]
+    assert sorted(plan.unavailable) == ["__missing@_uv_", "__samtools@2.0"]
+    assert sorted(plan.environments) == ["__samtools@1.3", "__samtools@1.4", "__samtools@_uv_"]
+
+    results = planner.install(plan)
+    assert results == {
+        "__bwa@0.7.15": True,
+        "__missing@_uv_": False,
+        "__samtools@2.0": False,
+        "__samtools@1.3": True,
+        "__samtools@1.4": False,
+        "__samtools@_uv_": True,
+    }
+    assert all("--use-index-cache" in args for args in conda_context.created)
+    assert conda_context.removed == ["__samtools@1.4"]
+    assert sorted(p[0] for p in progress) == [1, 2, 3]
+    assert all(p[1] == 3 for p in progress)
+
+
+def test_best_search_result_from_index():
+    hit, exact = best_search_result(CondaTarget("samtools", "1.3.1"), None, index=INDEX)
+    assert (hit["version"], exact) == ("1.3.1", True)
+    hit, exact = best_search_result(CondaTarget("samtools", "2.0"), None, index=INDEX)
+    assert (hit["version"], exact) == ("1.4", False)
+    assert best_search_result(CondaTarget("missing"), None, index=INDEX) == (None, None)
+
+
+class _FakeCondaContext(object):
+
+    def __init__(self, installed=[], failing=[]):
+        self.envs = set(installed)
+        self.failing = failing
+        self.created = []
+        self.removed = []
+        self._lock = threading.Lock()
+
+    def has_env(self, env_name):
+        return env_name in self.envs
+
+    def exec_create(self, args, allow_local=True, stdout_path=None):
+        env = args[args.index("--name") + 1]
+        with self._lock:
+            self.created.append(args)
+            # Failed installs may leave a partial environment behind
+            self.envs.add(env)
+        return 1 if env in self.failing else 0
+
+    def exec_remove(self, args):
+        self.removed.extend(args)
+        self.envs.difference_update(args)
+        return 0
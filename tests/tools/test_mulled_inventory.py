@@ -0,0 +1,92 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from galaxy.tools.deps.container_resolvers import mulled
+from galaxy.tools.deps.container_resolvers.mulled import (
+    CachedImageDirectoryInventory,
+    CachedImageIndex,
+    CachedImageInventory,
+    CachedMulledDockerContainerResolver,
+    find_best_matching_cached_image,
+    identifier_to_cached_target,
+)
+from galaxy.tools.deps.dependencies import AppInfo
+from galaxy.tools.deps.mulled.util import build_target, v1_image_name, v2_image_name
+
+IDENTIFIERS = [
+    "quay.io/biocontainers/samtools:1.3.1--4",
+    "quay.io/biocontainers/samtools:1.6--0",
+    "quay.io/biocontainers/bwa:0.7.17--1",
+]
+
+
+def _targets():
+    return [
+        [build_target("samtools")],
+        [build_target("samtools", version="1.6")],
+        [build_target("samtools", version="1.9")],
+        [build_target("bwa", version="0.7.17")],
+        [build_target("bwa"), build_target("samtools")],
+        [build_target("bwa", version="0.7.17"), build_target("samtools", version="1.6")],
+    ]
+
+
+def test_cached_image_index():
+    targets_list = _targets()
+    identifiers = list(IDENTIFIERS)
+    multi_targets = targets_list[-1]
+    package_hash, version_hash = v2_image_name(multi_targets).split(":")
+    identifiers.append("quay.io/biocontainers/%s:%s-0" % (package_hash, version_hash))
+    identifiers.append("quay.io/biocontainers/%s:0" % v2_image_name(targets_list[-2]))
+    identifiers.append("quay.io/biocontainers/%s:0" % v1_image_name(multi_targets))
+    cached_images = [identifier_to_cached_target(i, None, namespace="biocontainers") for i in identifiers]
+    index = CachedImageIndex(cached_images)
+    for hash_func in ["v1", "v2"]:
+        for targets in targets_list:
+            expected = find_best_matching_cached_image(targets, cached_images, hash_func)
+            assert index.find(targets, hash_func) == expected
+    assert index.find(multi_targets, "v2").image_identifier == identifiers[3]
+
+
+def test_cached_image_inventory():
+    listings = []
+
+    def list_images():
+        listings.append(True)
+        return [identifier_to_cached_target(i, None, namespace="biocontainers") for i in IDENTIFIERS]
+
+    inventory = CachedImageInventory(list_images)
+    samtools = [build_target("samtools", version="1.6")]
+    for _ in range(3):
+        assert inventory.index(60).find(samtools, "v2").image_identifier == IDENTIFIERS[1]
+    assert len(listings) == 1
+    inventory.invalidate()
+    inventory.index(60)
+    assert len(listings) == 2
+    # A max age of 0 lists the images on each lookup
+    inventory.index(0)
+    assert len(listings) == 3
+
+
+def test_image_inventory_ttl():
+    assert CachedMulledDockerContainerResolver(AppInfo()).image_inventory_ttl == mulled.DEFAULT_IMAGE_INVENTORY_TTL
+    assert CachedMulledDockerContainerResolver(AppInfo(mulled_image_inventory_ttl=5)).image_inventory_ttl == 5
+    assert CachedMulledDockerContainerResolver(AppInfo(), image_inventory_ttl="10").image_inventory_ttl == 10
+
+
+def test_cached_image_directory_inventory():
+    cache_directory = mkdtemp()
+    try:
+        open(os.path.join(cache_directory, "samtools:1.6--0"), "w").close()
+        inventory = CachedImageDirectoryInventory(cache_directory)
+        samtools = [build_target("samtools", version="1.6")]
+        bwa = [build_target("bwa", version="0.7.17")]
+        assert inventory.index().find(samtools, "v2").image_identifier == "samtools:1.6--0"
+        assert inventory.index().find(bwa, "v2") is None
+        open(os.path.join(cache_directory, "bwa:0.7.17--1"), "w").close()
+        assert inventory.index().find(bwa, "v2").image_identifier == "bwa:0.7.17--1"
+        description = mulled.singularity_cached_container_description(bwa, cache_directory)
+        assert description.identifier == os.path.join(cache_directory, "bwa:0.7.17--1")
+    finally:
+        rmtree(cache_directory)
@@ -61,6 +61,55 @@ def test_tool_dependencies():
         assert dependency.version == "2.0"  # 2.0 is defined as default_version
 
 
+def test_resolution_cache():
+    with __test_base_path() as base_path:
+        __setup_galaxy_package_dep(base_path, TEST_REPO_NAME, TEST_VERSION)
+        dm = __dependency_manager_for_base_path(default_base_path=base_path)
+        requirements = ToolRequirements([{'type': 'package', 'version': TEST_VERSION, 'name': TEST_REPO_NAME}])
+        dependency = dm.requirements_to_dependencies(requirements)[requirements.resolvable[0]]
+        assert dependency.version == TEST_VERSION
+        rmtree(os.path.join(base_path, TEST_REPO_NAME))
+        cached = dm.requirements_to_dependencies(requirements)[requirements.resolvable[0]]
+        assert cached.path == dependency.path
+        assert cached is not dependency
+        stats = dm.resolution_cache_stats()
+        assert (stats["hits"], stats["misses"], stats["size"]) == (1, 1, 1)
+        dm.invalidate_resolution_cache()
+        assert not dm.requirements_to_dependencies(requirements)
+        assert dm.resolution_cache_stats()["size"] == 1
+
+
+def test_resolution_cache_job_directory():
+    with __test_base_path() as base_path:
+        dm = __dependency_manager_for_base_path(default_base_path=base_path)
+        resolver = _JobDirectoryDependencyResolver()
+        dm.dependency_resolvers = [resolver]
+        requirements = ToolRequirements([{'type': 'package', 'version': "1.0", 'name': "foo"}])
+        requirement = requirements.resolvable[0]
+        for job_directory in ("/jobs/1", "/jobs/2"):
+            dependency = dm.requirements_to_dependencies(requirements, job_directory=job_directory)[requirement]
+            assert dependency.environment_path == os.path.join(job_directory, "env")
+        dependency = dm.requirements_to_dependencies(requirements)[requirement]
+        assert dependency.environment_path == "/envs/foo"
+        assert resolver.calls == 2
+        dm.requirements_to_dependencies(requirements, install=True)
+        assert resolver.calls == 3
+        assert dm.resolution_cache_stats()["size"] == 0
+
+
+class _JobDirectoryDependencyResolver(object):
+    resolver_type = "job_directory"
+
+    def __init__(self):
+        self.calls = 0
+
+    def resolve(self, requirement, **kwds):
+        self.calls += 1
+        job_directory = kwds.get("job_directory")
+        environment_path = os.path.join(job_directory, "env") if job_directory else "/envs/foo"
+        return Bunch(environment_path=environment_path, exact=True, resolver_msg="resolved", version=requirement.version)
+
+
 TEST_REPO_USER = "devteam"
 TEST_REPO_NAME = "bwa"
 TEST_REPO_CHANGESET = "12abcd41223da"
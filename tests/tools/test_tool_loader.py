@@ -276,3 +276,39 @@ def test_loader():
         assert input_els[0].text == "hello"
         assert input_els[1].text == "world"
         assert input_els[2].text == "the_default"
+
+    # Test tokens of enclosing macros reach nested macros
+    with TestToolDirectory() as tool_dir:
+        tool_dir.write('''
+<tool>
+    <expand macro="outer" which="inner_b" />
+    <macros>
+        <xml name="outer" tokens="which">
+            <expand macro="inner" name="@WHICH@" />
+            <outputs>
+                <expand macro="inner" name="@WHICH@_out" />
+            </outputs>
+        </xml>
+        <xml name="inner" tokens="name">
+            <inputs name="@NAME@" />
+        </xml>
+    </macros>
+</tool>
+''')
+        xml = tool_dir.load()
+        input_els = xml.findall("inputs")
+        assert len(input_els) == 1
+        assert input_els[0].get("name") == "inner_b"
+        assert xml.find("outputs").find("inputs").get("name") == "inner_b_out"
+
+    # Test parsed macro files are reused without leaking changes between tools
+    # and reloaded once modified.
+    with TestToolDirectory() as tool_dir:
+        tool_dir.write(SIMPLE_TOOL_WITH_MACRO)
+        tool_dir.write(SIMPLE_TOOL_WITH_MACRO.replace("@WRAPPER_VERSION@", "@WRAPPER_VERSION@+galaxy1"), name="tool2.xml")
+        tool_dir.write(SIMPLE_MACRO.substitute(tool_version="2.0"), name="external.xml")
+        assert tool_dir.load().getroot().get("version") == "2.0"
+        assert tool_dir.load(name="tool2.xml").getroot().get("version") == "2.0+galaxy1"
+        assert tool_dir.load().getroot().get("version") == "2.0"
+        tool_dir.write(SIMPLE_MACRO.substitute(tool_version="3.0.1"), name="external.xml")
+        assert tool_dir.load().getroot().get("version") == "3.0.1"
@@ -0,0 +1,335 @@
+import os
+import threading
+import time
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from galaxy.tools.toolbox import AbstractToolBox, cache
+from galaxy.tools.toolbox.filters import _handle_authorization, _not_hidden
+from galaxy.util.bunch import Bunch
+
+TOOL_TEMPLATE = """<tool id="%s" name="%s" version="1.0">
+    <macros>
+        <import>macros.xml</import>
+    </macros>
+    <expand macro="inputs" />
+</tool>
+"""
+
+PLAIN_TOOL_TEMPLATE = """<tool id="%s" name="%s" version="1.0">
+    <inputs />
+</tool>
+"""
+
+MACROS = """<macros>
+    <xml name="inputs">
+        <inputs />
+    </xml>
+</macros>
+"""
+
+
+class SimpleTool(object):
+
+    def __init__(self, config_file, tool_source):
+        self.config_file = config_file
+        self.tool_source = tool_source
+        self.id = tool_source.parse_id()
+        self.name = tool_source.parse_name()
+        self.version = tool_source.parse_version()
+        self._macro_paths = tool_source.macro_paths()
+        self.hidden = False
+        self.require_login = False
+        self.tool_type = "default"
+        self.to_dict_calls = 0
+        self.allowed_user_ids = None
+        self.guid = None
+        self.tool_shed = None
+        self.repository_name = None
+        self.repository_owner = None
+        self.installed_changeset_revision = None
+        self.tool_shed_repository = None
+
+    @property
+    def lineage(self):
+        return self._lineage
+
+    def allow_user_access(self, user, attempting_access=True):
+        return self.allowed_user_ids is None or (user is not None and user.id in self.allowed_user_ids)
+
+    def to_dict(self, trans, link_details=False, **kwds):
+        self.to_dict_calls += 1
+        return {"model_class": "Tool", "id": self.id, "name": self.name}
+
+
+class SimpleToolBox(AbstractToolBox):
+
+    def __init__(self, config_filenames, tool_root_dir, app):
+        self.created = []
+        super(SimpleToolBox, self).__init__(config_filenames, tool_root_dir, app)
+
+    def create_tool(self, config_file, tool_shed_repository=None, guid=None, **kwds):
+        preloaded = config_file in self._preloaded_tool_sources
+        self.created.append((config_file, preloaded))
+        return SimpleTool(config_file, self.get_tool_source(config_file))
+
+
+def _app(temp_directory, **config):
+    config.setdefault("update_integrated_tool_panel", False)
+    config.setdefault("integrated_tool_panel_config", os.path.join(temp_directory, "integrated_tool_panel.xml"))
+    return Bunch(name="galaxy", config=Bunch(**config), _toolbox_lock=threading.RLock())
+
+
+def _write_tools(temp_directory, count):
+    with open(os.path.join(temp_directory, "macros.xml"), "w") as f:
+        f.write(MACROS)
+    items = []
+    for i in range(count):
+        name = "tool_%d.xml" % i
+        with open(os.path.join(temp_directory, name), "w") as f:
+            f.write(TOOL_TEMPLATE % ("tool_%d" % i, "Tool %d" % i))
+        items.append('<tool file="%s" />' % name)
+    tool_conf = os.path.join(temp_directory, "tool_conf.xml")
+    with open(tool_conf, "w") as f:
+        f.write('<toolbox><section id="first" name="First">%s</section>%s<tool file="missing.xml" /></toolbox>'
+                % ("".join(items[:count // 2]), "".join(items[count // 2:])))
+    return tool_conf
+
+
+def _panel_tool_ids(toolbox):
+    ids = []
+    for key, item_type, item in toolbox._tool_panel.panel_items_iter():
+        if hasattr(item, "elems"):
+            ids.extend(tool.id for _, _, tool in item.elems.panel_items_iter())
+        else:
+            ids.append(item.id)
+    return ids
+
+
+def test_parallel_tool_loading():
+    temp_directory = mkdtemp()
+    try:
+        tool_conf = _write_tools(temp_directory, 20)
+        serial = SimpleToolBox([tool_conf], temp_directory, _app(temp_directory))
+        assert not any(preloaded for _, preloaded in serial.created)
+        assert len(_panel_tool_ids(serial)) == 20
+
+        for pool in ["thread", "process"]:
+            app = _app(temp_directory, tool_load_workers=4, tool_load_pool=pool)
+            parallel = SimpleToolBox([tool_conf], temp_directory, app)
+            assert all(preloaded for _, preloaded in parallel.created)
+            # Tools are registered in config order, the panel is unchanged
+            assert [path for path, _ in parallel.created] == [path for path, _ in serial.created]
+            assert _panel_tool_ids(parallel) == _panel_tool_ids(serial)
+            assert parallel.get_tool("tool_3").tool_source.parse_name() == "Tool 3"
+            assert parallel._preloaded_tool_sources == {}
+    finally:
+        rmtree(temp_directory)
+
+
+def test_tool_source_cache():
+    temp_directory = mkdtemp()
+    try:
+        tool_conf = _write_tools(temp_directory, 6)
+        cache_dir = os.path.join(temp_directory, "cache")
+        for workers in [1, 3]:
+            app = _app(temp_directory, tool_source_cache_dir=cache_dir, tool_load_workers=workers)
+            cold = SimpleToolBox([tool_conf], temp_directory, app)
+            warm = SimpleToolBox([tool_conf], temp_directory, app)
+            if workers == 1:
+                assert (cold._tool_source_cache.hits, cold._tool_source_cache.misses) == (0, 6)
+            assert (warm._tool_source_cache.hits, warm._tool_source_cache.misses) == (6, 0)
+            assert _panel_tool_ids(warm) == _panel_tool_ids(cold)
+            assert warm.get_tool("tool_1").tool_source.parse_name() == "Tool 1"
+
+            # Files unchanged since they were cached are not hashed again
+            hashed = []
+            memory_bound_hexdigest = cache.memory_bound_hexdigest
+            cache.memory_bound_hexdigest = lambda *args: hashed.append(args) or memory_bound_hexdigest(*args)
+            try:
+                toolbox = SimpleToolBox([tool_conf], temp_directory, app)
+            finally:
+                cache.memory_bound_hexdigest = memory_bound_hexdigest
+            assert toolbox._tool_source_cache.hits == 6
+            assert hashed == []
+
+            # Touching a file without changing it keeps the entries valid
+            macros_path = os.path.join(temp_directory, "macros.xml")
+            os.utime(macros_path, (0, 0))
+            toolbox = SimpleToolBox([tool_conf], temp_directory, app)
+            assert toolbox._tool_source_cache.misses == 0
+
+            # Changing an imported macro file invalidates the tools using it
+            with open(macros_path, "w") as f:
+                f.write(MACROS.replace("<inputs />", "<inputs><param name=\"changed\" /></inputs>"))
+            toolbox = SimpleToolBox([tool_conf], temp_directory, app)
+            assert (toolbox._tool_source_cache.hits, toolbox._tool_source_cache.misses) == (0, 6)
+            assert toolbox.get_tool("tool_1").tool_source.root.find("inputs/param") is not None
+            with open(macros_path, "w") as f:
+                f.write(MACROS)
+    finally:
+        rmtree(temp_directory)
+
+
+def test_get_tool_by_old_id_and_tool_shed():
+    temp_directory = mkdtemp()
+    try:
+        tool_conf = _write_tools(temp_directory, 0)
+        app = _app(temp_directory)
+        app.tool_shed_registry = Bunch(tool_sheds={
+            "main": "https://toolshed.g2.bx.psu.edu/",
+            "test": "https://testtoolshed.g2.bx.psu.edu/",
+        })
+        toolbox = app.toolbox = SimpleToolBox([tool_conf], temp_directory, app)
+        guid = "toolshed.g2.bx.psu.edu/repos/devteam/bwa/bwa/%s"
+        for version in ["0.7.17", "0.10.0", "0.7.15"]:
+            toolbox.register_tool(Bunch(id=guid % version, old_id="bwa", version=version, name="BWA"))
+
+        assert toolbox.get_tool("bwa").version == "0.7.17"
+        assert toolbox.get_tool("bwa", tool_version="0.7.15").version == "0.7.15"
+        assert [t.version for t in toolbox.get_tool("bwa", get_all_versions=True)] == ["0.10.0", "0.7.15", "0.7.17"]
+        assert toolbox.get_tool("bwa", exact=True) is None
+        # Tool shed ids are matched against the tool sheds the tool was installed from
+        assert toolbox.get_tool("testtoolshed.g2.bx.psu.edu/repos/devteam/bwa/bwa/0.10.0").id == guid % "0.10.0"
+        assert toolbox.get_tool("testtoolshed.g2.bx.psu.edu/repos/devteam/bowtie/bowtie/1.0") is None
+
+        toolbox.remove_tool_by_id(guid % "0.7.17")
+        assert toolbox.get_tool("bwa").version == "0.7.15"
+        toolbox.remove_tool_by_id(guid % "0.7.15")
+        toolbox.remove_tool_by_id(guid % "0.10.0")
+        assert toolbox.get_tool("bwa") is None
+        assert toolbox.get_tool("testtoolshed.g2.bx.psu.edu/repos/devteam/bwa/bwa/0.10.0") is None
+    finally:
+        rmtree(temp_directory)
+
+
+def test_get_tool_by_versionless_tool_shed_id():
+    temp_directory = mkdtemp()
+    try:
+        tool_conf = _write_tools(temp_directory, 0)
+        app = _app(temp_directory)
+        app.tool_shed_registry = Bunch(tool_sheds={
+            "main": "https://toolshed.g2.bx.psu.edu/",
+            "test": "https://testtoolshed.g2.bx.psu.edu/",
+        })
+        toolbox = app.toolbox = SimpleToolBox([tool_conf], temp_directory, app)
+        tool = Bunch(id="toolshed.g2.bx.psu.edu/repos/devteam/bwa/bwa/0.7.17", old_id="bwa", version="0.7.17", name="BWA")
+        toolbox.register_tool(tool)
+        toolbox._lineage_map.register(tool)
+        assert toolbox.get_tool("testtoolshed.g2.bx.psu.edu/repos/devteam/bwa/bwa").id == tool.id
+    finally:
+        rmtree(temp_directory)
+
+
+def test_panel_views():
+    temp_directory = mkdtemp()
+    try:
+        tool_conf = _write_tools(temp_directory, 4)
+        toolbox = SimpleToolBox([tool_conf], temp_directory, _app(temp_directory))
+        toolbox.get_tool("tool_3").require_login = True
+        toolbox.get_tool("tool_1").allowed_user_ids = [2]
+        anonymous = Bunch(user=None, user_is_admin=False)
+        user = Bunch(user=Bunch(id=1, preferences={}), user_is_admin=False)
+        other_user = Bunch(user=Bunch(id=2, preferences={}), user_is_admin=False)
+
+        panel = toolbox.to_dict(anonymous)
+        assert [item["id"] for item in panel] == ["first", "tool_2"]
+        assert toolbox.to_dict(anonymous) == panel
+        assert toolbox.get_tool("tool_2").to_dict_calls == 1
+        assert [item["id"] for item in toolbox.to_dict(user)] == ["first", "tool_2", "tool_3"]
+        assert toolbox._panel_view(user) is not toolbox._panel_view(other_user)
+        assert toolbox.to_json(user) is toolbox.to_json(user)
+        assert b'"tool_3"' in toolbox.to_json(user)
+        assert b'"tool_1"' not in toolbox.to_json(user)
+        assert b'"tool_1"' in toolbox.to_json(other_user)
+
+        # Filters marked user independent only depend on whether a user is logged in
+        toolbox._filter_factory.default_filters["tool"] = [_not_hidden]
+        toolbox.invalidate_panel_views()
+        assert toolbox._panel_view(user) is toolbox._panel_view(other_user)
+        toolbox._filter_factory.default_filters["tool"] = [_not_hidden, _handle_authorization]
+
+        # Changes to the panel discard the views
+        toolbox.remove_tool_by_id("tool_2")
+        assert toolbox._panel_views == {}
+        assert [item["id"] for item in toolbox.to_dict(user)] == ["first", "tool_3"]
+
+        # Views computed while the panel changes are discarded once it is complete
+        index_tool = toolbox._index_tool
+
+        def index_tool_and_build_view(tool):
+            index_tool(tool)
+            toolbox._panel_view(user)
+
+        toolbox._index_tool = index_tool_and_build_view
+        toolbox.register_tool(Bunch(id="tool_5", version="1.0", name="Tool 5"))
+        assert toolbox._panel_views == {}
+    finally:
+        rmtree(temp_directory)
+
+
+class FakeToolWatcher(object):
+
+    def __init__(self):
+        self.directory_callbacks = {}
+
+    def watch_file(self, tool_file, tool_id):
+        pass
+
+    def watch_directory(self, tool_dir, callback):
+        self.directory_callbacks[tool_dir] = callback
+
+
+def test_watched_directory_updates_are_batched():
+    temp_directory = mkdtemp()
+    try:
+        tool_dir = os.path.join(temp_directory, "tools")
+        os.mkdir(tool_dir)
+        tool_conf = os.path.join(temp_directory, "tool_conf.xml")
+        with open(tool_conf, "w") as f:
+            f.write('<toolbox><tool_dir dir="%s" /></toolbox>' % tool_dir)
+        app = _app(temp_directory, update_integrated_tool_panel=True, tool_panel_update_delay=0.2)
+        tool_watcher = FakeToolWatcher()
+        app.watchers = Bunch(tool_watcher=tool_watcher, tool_config_watcher=None)
+        toolbox = SimpleToolBox([tool_conf], temp_directory, app)
+        writes = []
+        write_integrated_tool_panel = toolbox._write_integrated_tool_panel_config_file
+
+        def count_writes():
+            writes.append(True)
+            write_integrated_tool_panel()
+
+        toolbox._write_integrated_tool_panel_config_file = count_writes
+        quick_load = tool_watcher.directory_callbacks[tool_dir]
+
+        def add_tool(i):
+            tool_file = os.path.join(tool_dir, "tool_%d.xml" % i)
+            with open(tool_file, "w") as f:
+                f.write(PLAIN_TOOL_TEMPLATE % ("tool_%d" % i, "Tool %d" % i))
+            assert quick_load(tool_file) == "tool_%d" % i
+
+        for i in range(5):
+            add_tool(i)
+        assert writes == []
+        deadline = time.time() + 10
+        while not writes and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.3)
+        assert writes == [True]
+        with open(app.config.integrated_tool_panel_config) as f:
+            integrated_tool_panel = f.read()
+        assert all('<tool id="tool_%d" />' % i in integrated_tool_panel for i in range(5))
+
+        # Installs can batch their saves explicitly
+        with toolbox.batch_integrated_tool_panel_saves():
+            with toolbox.batch_integrated_tool_panel_saves():
+                toolbox._save_integrated_tool_panel()
+            toolbox._save_integrated_tool_panel()
+            assert len(writes) == 1
+        assert len(writes) == 2
+        add_tool(5)
+        toolbox.flush_tool_panel_update()
+        assert len(writes) == 3
+        assert toolbox._tool_panel_update_timer is None
+    finally:
+        rmtree(temp_directory)
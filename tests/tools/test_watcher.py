@@ -1,3 +1,4 @@
+import os
 import tempfile
 import time
 from contextlib import contextmanager
@@ -86,3 +87,71 @@ def __test_directory():
         yield base_path
     finally:
         rmtree(base_path)
+
+
+def test_tool_conf_watcher_polling():
+    with __test_directory() as t:
+        macros_path = path.join(t, "macros.xml")
+        open(macros_path, "w").write("a")
+        callback = CallbackRecorder()
+        conf_watcher = watcher.ToolConfWatcher(callback.call, interval=0.05)
+        conf_watcher.watch_file(macros_path)
+        conf_watcher.thread.start()
+        try:
+            wait_for_reload(lambda: macros_path in conf_watcher.hashes)
+            # Touching the file without changing it does not reload
+            os.utime(macros_path, (0, 0))
+            wait_for_reload(lambda: conf_watcher.paths[macros_path][0] == 0)
+            assert not callback.called
+            open(macros_path, "w").write("b")
+            wait_for_reload(lambda: callback.called)
+        finally:
+            conf_watcher.shutdown()
+        assert not conf_watcher.thread.is_alive()
+
+
+def test_tool_conf_watcher_events():
+    with __test_directory() as t:
+        macros_path = path.join(t, "macros.xml")
+        other_path = path.join(t, "other.xml")
+        open(macros_path, "w").write("a")
+        callback = CallbackRecorder()
+        conf_watcher = watcher.ToolConfWatcher(callback.call, observer_class=Observer, interval=0.05)
+        # Watched paths are matched against the absolute paths of events
+        conf_watcher.watch_file(path.relpath(macros_path))
+        assert conf_watcher.observer.scheduled == [t]
+        conf_watcher.thread.start()
+        try:
+            wait_for_reload(lambda: macros_path in conf_watcher.hashes)
+            # Without events watched files are not checked
+            open(macros_path, "w").write("b")
+            time.sleep(0.2)
+            assert not callback.called
+            handler = conf_watcher.event_handler
+            handler.on_any_event(bunch.Bunch(src_path=other_path))
+            time.sleep(0.2)
+            assert not callback.called
+            handler.on_any_event(bunch.Bunch(src_path=macros_path))
+            wait_for_reload(lambda: callback.called)
+        finally:
+            conf_watcher.shutdown()
+        assert conf_watcher.observer.stopped
+
+
+class Observer(object):
+
+    def __init__(self):
+        self.scheduled = []
+        self.stopped = False
+
+    def schedule(self, event_handler, directory, recursive=False):
+        self.scheduled.append(directory)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+    def join(self):
+        pass